@@ -0,0 +1,103 @@
+"""
+Async facade over database.py.
+
+python-telegram-bot runs every handler on one asyncio event loop, so calling the
+blocking pyodbc functions directly freezes every other chat until the query
+returns. The coroutines below run the same functions on a bounded thread pool
+(sized like the connection pool) and stop waiting after DB_CALL_TIMEOUT seconds.
+
+On timeout a read returns the same "failure" value the synchronous function
+returns when it cannot connect ([] / None / False), so handlers keep their
+existing error paths. Writes (create / update / cancel / payment) have no
+deadline: the worker thread can't be stopped, so a write we gave up on could
+still commit after the user was told it failed (duplicate or ghost
+appointments). The handler waits for the real result; connection checkout
+is still bounded by DB_POOL_TIMEOUT.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+from config import DB_EXECUTOR_WORKERS, DB_CALL_TIMEOUT
+
+_executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="db")
+
+async def run_db(func, *args, default=None, timeout=DB_CALL_TIMEOUT):
+    """
+    Runs a blocking database function on the DB executor.
+    Note: a timed-out call keeps running in its worker thread; we just stop
+    waiting for it. Only use a timeout for reads (writes pass timeout=None).
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return await asyncio.wait_for(
+            loop.run_in_executor(_executor, functools.partial(func, *args)),
+            timeout
+        )
+    except asyncio.TimeoutError:
+        print(f"Database Timeout: {func.__name__} took longer than {timeout}s")
+        return default
+
+# --- SERVICES ---
+
+async def get_services():
+    return await run_db(database.get_services, default=[])
+
+async def get_service_by_id(service_id):
+    return await run_db(database.get_service_by_id, service_id)
+
+async def get_services_by_ids(service_ids):
+    return await run_db(database.get_services_by_ids, service_ids, default=[])
+
+async def get_catalog_version():
+    return await run_db(database.get_catalog_version, default=0)
+
+async def refresh_service_catalog():
+    return await run_db(database.refresh_service_catalog, default=0)
+
+# --- APPOINTMENTS ---
+
+async def create_appointment(patient_name, patient_id, patient_phone, service_id, date, time):
+    return await run_db(database.create_appointment, patient_name, patient_id, patient_phone, service_id, date, time, timeout=None)
+
+async def get_appointments_by_patient(patient_id):
+    return await run_db(database.get_appointments_by_patient, patient_id, default=[])
+
+async def get_appointment_by_id(appointment_id):
+    return await run_db(database.get_appointment_by_id, appointment_id)
+
+async def get_appointment_by_payment_proof(payment_proof):
+    return await run_db(database.get_appointment_by_payment_proof, payment_proof)
+
+async def cancel_appointment(appointment_id):
+    return await run_db(database.cancel_appointment, appointment_id, default=False, timeout=None)
+
+async def check_availability(date, time):
+    return await run_db(database.check_availability, date, time, default=False)
+
+async def get_booked_slots(date):
+    return await run_db(database.get_booked_slots, date, default=[])
+
+async def update_appointment(appointment_id, new_date, new_time):
+    return await run_db(database.update_appointment, appointment_id, new_date, new_time, default=False, timeout=None)
+
+async def update_payment_status(appointment_id, status, method, proof_path, amount):
+    return await run_db(database.update_payment_status, appointment_id, status, method, proof_path, amount, default=False, timeout=None)
+
+# --- REPORTING ---
+
+async def get_daily_appointments(date):
+    return await run_db(database.get_daily_appointments, date, default=[])
+
+async def get_appointments_by_range(start_date, end_date):
+    return await run_db(database.get_appointments_by_range, start_date, end_date, default=[])
+
+async def get_report_summary(start_date, end_date):
+    return await run_db(database.get_report_summary, start_date, end_date)
+
+async def get_payment_method_totals(start_date, end_date):
+    return await run_db(database.get_payment_method_totals, start_date, end_date, default=[])
+
+async def get_service_counts(start_date, end_date):
+    return await run_db(database.get_service_counts, start_date, end_date, default=[])
@@ -0,0 +1,105 @@
+"""
+Benchmark: concurrent-chat latency with blocking vs async database access.
+
+Simulates N chats hitting the bot at the same time. Each chat runs a handler
+that performs a few database calls (like a calendar click: get_booked_slots +
+check_availability). The database round trip is simulated with time.sleep so
+the benchmark runs without SQL Server.
+
+- "sync":  handler calls database.* directly (old behaviour, blocks the loop)
+- "async": handler awaits async_database.* (runs on the DB executor)
+
+Usage:
+    python benchmark_async_db.py --chats 20 --calls 3 --latency 0.05
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import database
+import async_database
+
+def install_fake_latency(latency):
+    """Replaces the real queries with sleeps of the given duration."""
+    def fake_booked_slots(date):
+        time.sleep(latency)
+        return ["09:00", "15:00"]
+
+    def fake_check_availability(date, time_):
+        time.sleep(latency)
+        return True
+
+    database.get_booked_slots = fake_booked_slots
+    database.check_availability = fake_check_availability
+
+async def sync_handler(calls):
+    for i in range(calls):
+        if i % 2 == 0:
+            database.get_booked_slots("2030-01-02")
+        else:
+            database.check_availability("2030-01-02", "10:00")
+
+async def async_handler(calls):
+    for i in range(calls):
+        if i % 2 == 0:
+            await async_database.get_booked_slots("2030-01-02")
+        else:
+            await async_database.check_availability("2030-01-02", "10:00")
+
+async def run_scenario(handler, chats, calls):
+    """Returns (per-chat latencies, wall time, max event-loop lag)."""
+    max_lag = 0.0
+    stop = asyncio.Event()
+
+    async def ticker():
+        # Measures how long the loop is unable to run other tasks
+        nonlocal max_lag
+        interval = 0.005
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            await asyncio.sleep(interval)
+            max_lag = max(max_lag, time.perf_counter() - t0 - interval)
+
+    async def chat():
+        # All chats "arrive" at `start`; latency includes time spent queued behind other chats
+        await handler(calls)
+        return time.perf_counter() - start
+
+    tick_task = asyncio.create_task(ticker())
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    latencies = await asyncio.gather(*(chat() for _ in range(chats)))
+    wall = time.perf_counter() - start
+
+    stop.set()
+    await tick_task
+    return latencies, wall, max_lag
+
+def report(name, latencies, wall, max_lag):
+    latencies = sorted(latencies)
+    p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+    print(
+        f"{name:<6} | p50 {statistics.median(latencies) * 1000:8.1f} ms"
+        f" | p95 {p95 * 1000:8.1f} ms"
+        f" | wall {wall * 1000:8.1f} ms"
+        f" | max loop lag {max_lag * 1000:8.1f} ms"
+    )
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chats", type=int, default=20, help="Concurrent chats")
+    parser.add_argument("--calls", type=int, default=3, help="DB calls per handler")
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated DB round trip (seconds)")
+    args = parser.parse_args()
+
+    install_fake_latency(args.latency)
+
+    print(f"{args.chats} chats x {args.calls} calls, {args.latency * 1000:.0f} ms per query, "
+          f"{async_database.DB_EXECUTOR_WORKERS} DB workers\n")
+    report("sync", *await run_scenario(sync_handler, args.chats, args.calls))
+    report("async", *await run_scenario(async_handler, args.chats, args.calls))
+
+if __name__ == "__main__":
+    asyncio.run(main())
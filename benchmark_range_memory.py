@@ -0,0 +1,104 @@
+"""
+Benchmark: peak memory of get_appointments_by_range (list) vs
+iter_appointments_by_range (streamed with fetchmany) over a large table.
+
+Builds a synthetic SQLite database (DB_BACKEND=sqlite) with N appointments,
+then aggregates the same totals both ways and reports the tracemalloc peak.
+The database file is reused between runs if it already has enough rows.
+
+Usage:
+    python benchmark_range_memory.py --rows 1000000
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+# Must be set before database/config are imported
+DEFAULT_DB = os.path.join(tempfile.gettempdir(), "benchmark_range.db")
+os.environ["DB_BACKEND"] = "sqlite"
+os.environ.setdefault("SQLITE_PATH", DEFAULT_DB)
+
+import database
+
+START = date(2020, 1, 1)
+
+def populate(rows):
+    conn = database.get_db_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM Appointments")
+        existing = cursor.fetchone()[0]
+        if existing >= rows:
+            return existing
+
+        print(f"Populating {rows - existing:,} synthetic appointments...")
+        batch = []
+        for i in range(existing, rows):
+            # One appointment per minute keeps (date, time) unique for the slot index
+            day, minute = divmod(i, 24 * 60)
+            batch.append((
+                f"bench-{i}", f"Paciente {i}", str(1000000 + i % 5000), "3000000000",
+                i % 11 + 1,
+                (START + timedelta(days=day)).isoformat(),
+                f"{minute // 60:02d}:{minute % 60:02d}:00",
+                "cancelled" if i % 10 == 0 else "confirmed",
+                "paid" if i % 3 == 0 else "pending",
+                "nequi" if i % 3 == 0 else None,
+                65000 if i % 3 == 0 else 0,
+            ))
+            if len(batch) == 50000:
+                _insert(cursor, batch)
+                batch = []
+        if batch:
+            _insert(cursor, batch)
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+def _insert(cursor, batch):
+    cursor.executemany("""
+        INSERT INTO Appointments (id, patient_name, patient_id, patient_phone, service_id, appointment_date, appointment_time, status, payment_status, payment_method, payment_amount)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, batch)
+
+def aggregate(appointments):
+    count = 0
+    expected = 0
+    collected = 0
+    for app in appointments:
+        count += 1
+        collected += app.payment_amount
+        if app.status != 'cancelled':
+            expected += app.price
+    return count, expected, collected
+
+def measure(name, fn):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn()
+    elapsed = time.perf_counter() - t0
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<8} | rows {result[0]:>10,} | peak {peak / 1024 / 1024:10.1f} MiB | {elapsed:6.1f} s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000, help="Synthetic appointments in the table")
+    parser.add_argument("--batch-size", type=int, default=database.DB_FETCH_BATCH_SIZE, help="fetchmany batch size")
+    args = parser.parse_args()
+
+    total = populate(args.rows)
+    end = START + timedelta(days=total // (24 * 60) + 1)
+    print(f"Database: {os.environ['SQLITE_PATH']} ({total:,} rows), batch size {args.batch_size}\n")
+
+    listed = measure("list", lambda: aggregate(database.get_appointments_by_range(START, end)))
+    streamed = measure("stream", lambda: aggregate(database.iter_appointments_by_range(START, end, batch_size=args.batch_size)))
+    assert listed == streamed, "Both strategies must produce the same totals"
+
+if __name__ == "__main__":
+    main()
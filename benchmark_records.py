@@ -0,0 +1,113 @@
+"""
+Benchmark: dict rows (old behaviour) vs __slots__ record objects.
+
+Builds N fake cursor rows with native date / time / Decimal values (what
+pyodbc and the SQLite backend return), then converts them both ways:
+
+- "dict":   one dict per row with str() dates/times and float() prices, and
+            the bot's datetime.strptime(f"{date} {time}") to get them back.
+- "record": database.DailyAppointment / Appointment, keeping native values
+            and using Appointment.starts_at.
+
+Reports the tracemalloc peak of holding the converted rows and the time spent
+converting + parsing. No database connection is needed.
+
+Usage:
+    python benchmark_records.py --rows 200000
+"""
+import argparse
+import collections
+import time
+import tracemalloc
+from datetime import date, datetime, time as dtime, timedelta
+from decimal import Decimal
+
+import database
+
+Row = collections.namedtuple("Row", [
+    "id", "patient_name", "patient_id", "nombre", "service_name", "precio",
+    "appointment_date", "appointment_time", "status", "payment_status",
+    "payment_method", "payment_amount",
+])
+
+def make_rows(n):
+    start = date(2030, 1, 1)
+    rows = []
+    for i in range(n):
+        day, slot = divmod(i, 8)
+        rows.append(Row(
+            f"{i:08d}-0000-0000-0000-000000000000", f"Paciente {i}", str(1000000 + i),
+            "Consulta General", "Consulta General", Decimal("65000.00"),
+            start + timedelta(days=day), dtime(9 + slot), "confirmed",
+            "paid" if i % 3 == 0 else "pending", "nequi" if i % 3 == 0 else None,
+            Decimal("65000.00") if i % 3 == 0 else None,
+        ))
+    return rows
+
+def as_dicts(rows):
+    converted = []
+    for row in rows:
+        converted.append({
+            "id": row.id,
+            "patient_name": row.patient_name,
+            "patient_id": row.patient_id,
+            "service_name": row.service_name,
+            "price": float(row.precio),
+            "date": str(row.appointment_date),
+            "time": str(row.appointment_time),
+            "status": row.status,
+            "payment_status": row.payment_status,
+            "payment_method": row.payment_method,
+            "payment_amount": float(row.payment_amount) if row.payment_amount else 0.0
+        })
+    return converted
+
+def as_records(rows):
+    return [database.DailyAppointment.from_row(row) for row in rows]
+
+def parse_dicts(rows):
+    # What receive_id_for_management / back_to_list did for every listed appointment
+    appointments = [{"date": str(row.appointment_date), "time": str(row.appointment_time)} for row in rows]
+    return [datetime.strptime(f"{app['date']} {app['time']}", "%Y-%m-%d %H:%M:%S") for app in appointments]
+
+def parse_records(rows):
+    appointments = [database.Appointment.from_row(row) for row in rows]
+    return [app.starts_at for app in appointments]
+
+def measure_memory(name, fn, rows):
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    result = fn(rows)
+    elapsed = time.perf_counter() - t0
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    per_row = current / len(rows)
+    print(f"{name:<8} | held {current / 1024 / 1024:8.1f} MiB ({per_row:6.0f} B/row) | convert {elapsed:6.2f} s")
+    return result
+
+def measure_time(name, fn, rows):
+    t0 = time.perf_counter()
+    result = fn(rows)
+    elapsed = time.perf_counter() - t0
+    print(f"{name:<8} | list + datetime for {len(rows):,} rows: {elapsed:6.2f} s")
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=200_000, help="Synthetic rows to convert")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    print(f"Rows: {args.rows:,}\n")
+
+    print("Report rows (DailyAppointment):")
+    measure_memory("dict", as_dicts, rows)
+    measure_memory("record", as_records, rows)
+
+    print("\nManagement list (Appointment.starts_at vs strptime):")
+    parsed = measure_time("dict", parse_dicts, rows)
+    native = measure_time("record", parse_records, rows)
+    assert parsed == native, "Both strategies must produce the same datetimes"
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,25 @@
+import asyncio
+import copy
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, CallbackQueryHandler, ConversationHandler
 from telegram import constants
-from config import TELEGRAM_TOKEN, CLINIC_INFO
-from gemini_service import send_message_to_gemini
-import database
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from config import TELEGRAM_TOKEN, CLINIC_INFO, ADMIN_CHAT_IDS, BOT_CONCURRENT_UPDATES, GEMINI_SDK_THREADS, SERVICE_EMOJIS, GEMINI_STREAMING, STREAM_EDIT_INTERVAL, HISTORY_ENABLED
+from gemini_service import send_message_to_gemini_async, send_message_to_gemini_stream, get_response_cache_stats, get_token_stats, get_coalescing_stats, get_transport_stats, is_fallback
+from intent_classifier import get_fast_path_stats
+import async_database
+from database import SlotTaken, get_query_metrics
 import holidays
 from datetime import datetime, timedelta
-from cachetools import TTLCache
 from utils import create_calendar, create_time_slots_keyboard
 import reports
+import media
+import transcription_cache
+import invoice_cache
+import conversation_memory
+from update_processor import PerChatUpdateProcessor
+from concurrent.futures import ThreadPoolExecutor
 import os
 import re
 
@@ -28,16 +38,6 @@ logging.basicConfig(
 # Initialize Holidays (Colombia)
 co_holidays = holidays.Colombia()
 
-# In-Memory Slot Lock
-slot_locks = TTLCache(maxsize=100, ttl=600)
-
-# Emoji Mapping
-SERVICE_EMOJIS = {
-    1: "🩺", 2: "📷", 3: "💆‍♂️", 4: "⚡", 5: "📦", 
-    6: "🏋️", 7: "🧖", 8: "🏃", 9: "🤰", 10: "🧘", 
-    11: "🩸", 13: "🧖‍♀️"
-}
-
 # Conversation States
 (
     CHOOSING_SERVICE,
@@ -58,20 +58,148 @@ def is_holiday(date_str):
     except ValueError:
         return False
 
+async def ask_gemini(update: Update, context: ContextTypes.DEFAULT_TYPE, text_message, image_base64=None, audio_base64=None, on_message=None, record=True):
+    """
+    Runs the Gemini call as a task tracked per chat. A newer message from the
+    same chat (the user moved on, see on_busy in main) or /cancel cancels it;
+    the superseded handler then gets None and should stop without replying.
+    With on_message the answer is streamed (see
+    gemini_service.send_message_to_gemini_stream).
+    The chat's recent conversation (conversation_memory.py) goes along as
+    history, and the new exchange is added to it unless record=False (the
+    caller won't show Gemini's answer, e.g. a voice note only transcribed).
+    """
+    previous = context.chat_data.get('gemini_task')
+    if previous and not previous.done():
+        previous.cancel()
+    
+    seq = context.chat_data.get('gemini_seq', 0) + 1
+    context.chat_data['gemini_seq'] = seq
+    chat_id = update.effective_chat.id
+    history = conversation_memory.get(chat_id) if HISTORY_ENABLED else []
+    if on_message:
+        call = send_message_to_gemini_stream(history, text_message, on_message, image_base64=image_base64, audio_base64=audio_base64)
+    else:
+        call = send_message_to_gemini_async(history, text_message, image_base64=image_base64, audio_base64=audio_base64)
+    task = asyncio.create_task(call)
+    context.chat_data['gemini_task'] = task
+    
+    try:
+        ai_response = await task
+        if HISTORY_ENABLED and record and not is_fallback(ai_response):
+            user_text = text_message or ai_response.get('audioTranscription') or ("[Imagen]" if image_base64 else "")
+            conversation_memory.record(chat_id, user_text, ai_response.get('message', ''))
+        return ai_response
+    except asyncio.CancelledError:
+        if context.chat_data.get('gemini_seq') != seq or context.chat_data.get('gemini_cancelled') == seq:
+            return None  # Superseded or cancelled by the user
+        raise  # The handler itself is being cancelled (shutdown)
+    finally:
+        if context.chat_data.get('gemini_task') is task:
+            context.chat_data.pop('gemini_task', None)
+
+def cancel_gemini(context: ContextTypes.DEFAULT_TYPE):
+    """Cancels the chat's in-flight Gemini call, if any."""
+    _cancel_gemini_task(context.chat_data)
+
+def _cancel_gemini_task(chat_data):
+    task = chat_data.get('gemini_task')
+    if task and not task.done():
+        chat_data['gemini_cancelled'] = chat_data.get('gemini_seq')
+        task.cancel()
+
+class StreamingReply:
+    """
+    Shows a streamed answer as one Telegram message: sent on the first chunk,
+    then edited as more text arrives, at most once every STREAM_EDIT_INTERVAL
+    seconds (Telegram rate-limits edits). Partial text is sent without
+    Markdown since it may cut a formatting mark in half; process_ai_response
+    makes the final edit with formatting and buttons.
+    """
+
+    def __init__(self, update: Update):
+        self.update = update
+        self.message = None
+        self._last_edit = 0.0
+
+    async def __call__(self, text):
+        loop = asyncio.get_running_loop()
+        if self.message is None:
+            self.message = await self.update.message.reply_text(text + " ✍️")
+        elif loop.time() - self._last_edit >= STREAM_EDIT_INTERVAL:
+            try:
+                await self.message.edit_text(text + " ✍️")
+            except RetryAfter as e:
+                # Flood control: skip edits until Telegram allows them again
+                self._last_edit = loop.time() + e.retry_after
+                return
+            except TelegramError as e:
+                print(f"Streaming edit failed: {e}")
+        else:
+            return
+        self._last_edit = loop.time()
+
+    async def abandon(self):
+        """Deletes the half-written answer of a superseded or cancelled call."""
+        message, self.message = self.message, None
+        if message is None:
+            return
+        try:
+            await message.delete()
+        except TelegramError as e:
+            print(f"Could not delete streamed message: {e}")
+
+async def send_reply(update: Update, placeholder, text, **kwargs):
+    """Replies with `text`, or turns the streamed placeholder message into it."""
+    if placeholder is None:
+        return await update.message.reply_text(text, **kwargs)
+    try:
+        return await placeholder.edit_text(text, **kwargs)
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return placeholder
+        raise
+
+async def ask_gemini_voice(update: Update, context: ContextTypes.DEFAULT_TYPE, need_response=True):
+    """
+    Gemini response (with 'audioTranscription') for the message's voice note.
+    Notes already transcribed (same file_unique_id, e.g. forwarded or resent)
+    skip the download and the audio call. With need_response, a transcription
+    cached on an earlier day is re-asked as text, since the answer may depend
+    on today's date.
+    """
+    voice = update.message.voice
+    cached = await transcription_cache.get(voice.file_unique_id)
+    if cached:
+        if not need_response or cached['date'] == datetime.now().date().isoformat():
+            if HISTORY_ENABLED and need_response:  # Without need_response the user never sees the answer
+                conversation_memory.record(update.effective_chat.id, cached['transcription'], cached['response'].get('message', ''))
+            return cached['response']
+        ai_response = await ask_gemini(update, context, cached['transcription'])
+        if ai_response is not None:
+            ai_response['audioTranscription'] = cached['transcription']
+        return ai_response
+    
+    voice_file = await voice.get_file()
+    voice_bytes = await voice_file.download_as_bytearray()
+    
+    # Send "Typing..."
+    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
+    
+    ai_response = await ask_gemini(update, context, "", audio_base64=voice_bytes, record=need_response)
+    if ai_response is not None:
+        await transcription_cache.put(voice.file_unique_id, ai_response)
+    return ai_response
+
 async def get_text_or_transcription(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """
     Helper to get text from a text message OR transcription from a voice message.
     """
     if update.message.voice:
-        # It's a voice message, process it first
-        voice_file = await update.message.voice.get_file()
-        voice_bytes = await voice_file.download_as_bytearray()
-        
-        # Send "Typing..."
-        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
-        
-        # Transcribe
-        ai_response = send_message_to_gemini([], "", audio_base64=voice_bytes)
+        # It's a voice message, transcribe it first
+        ai_response = await ask_gemini_voice(update, context, need_response=False)
+        if ai_response is None:
+            return None
         transcription = ai_response.get('audioTranscription', '')
         
         if transcription:
@@ -85,14 +213,17 @@ async def get_text_or_transcription(update: Update, context: ContextTypes.DEFAUL
         return update.message.text
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    conversation_memory.clear(update.effective_chat.id)  # /start begins a fresh conversation
     await update.message.reply_text(
         f"Hola, soy {CLINIC_INFO['botName']}, asistente virtual del {CLINIC_INFO['name']}. ¿En qué puedo ayudarte hoy?"
     )
 
-async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE, ai_response: dict):
+async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE, ai_response: dict, placeholder=None):
     """
     Unified logic to handle AI responses (text, buttons, intents)
-    Used by handle_message, handle_voice, and handle_photo
+    Used by handle_message, handle_voice, and handle_photo.
+    `placeholder` is the message a streamed answer was shown in; it is edited
+    into the final reply instead of sending a new one.
     """
     message_text = ai_response.get('message', '')
     intent = ai_response.get('intent', 'general')
@@ -114,23 +245,22 @@ async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE
             
             keyboard = []
             
-            for s_id in suggested_ids:
-                service = database.get_service_by_id(s_id)
-                if service:
-                    emoji = SERVICE_EMOJIS.get(s_id, "🏥")
-                    btn_text = f"{emoji} {service['nombre']}"
-                    keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s_id}")])
+            for service in await async_database.get_services_by_ids(suggested_ids):
+                s_id = service.id
+                emoji = SERVICE_EMOJIS.get(s_id, "🏥")
+                btn_text = f"{emoji} {service.nombre}"
+                keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s_id}")])
             
             keyboard.append([InlineKeyboardButton("📋 Ver todos los servicios", callback_data="show_all_services")])
             reply_markup = InlineKeyboardMarkup(keyboard)
         else:
             # Show all services if none suggested
-            services = database.get_services()
+            services = await async_database.get_services()
             keyboard = []
             for s in services:
-                emoji = SERVICE_EMOJIS.get(s['id'], "🏥")
-                btn_text = f"{emoji} {s['nombre']}"
-                keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s['id']}")])
+                emoji = SERVICE_EMOJIS.get(s.id, "🏥")
+                btn_text = f"{emoji} {s.nombre}"
+                keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s.id}")])
             reply_markup = InlineKeyboardMarkup(keyboard)
         
         # Escape the message text to prevent Markdown parsing errors
@@ -142,16 +272,16 @@ async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Let's use a try-except block for the send, and if it fails, send as plain text.
         
         try:
-            await update.message.reply_text(message_text, reply_markup=reply_markup, parse_mode='Markdown')
+            await send_reply(update, placeholder, message_text, reply_markup=reply_markup, parse_mode='Markdown')
         except Exception as e:
             print(f"Markdown Error: {e}. Falling back to plain text.")
-            await update.message.reply_text(message_text, reply_markup=reply_markup)
+            await send_reply(update, placeholder, message_text, reply_markup=reply_markup)
             
         return CHOOSING_SERVICE
 
     # 2. Management / Cancellation
     elif intent == 'check_appointment' or intent == 'cancellation' or intent == 'reschedule':
-        await update.message.reply_text(
+        await send_reply(update, placeholder,
             "🆔 **Gestión de Citas**\n\n"
             "Para **modificar tu horario**, cancelar o consultar tus citas, por favor ingresa tu **número de cédula**:\n"
             "_(Solo números, sin puntos ni guiones)_",
@@ -168,7 +298,7 @@ async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE
         context.user_data['payment_amount'] = amount
         context.user_data['payment_date'] = date
         
-        await update.message.reply_text(
+        await send_reply(update, placeholder,
             f"💰 **Pago Detectado**\n\nValor: ${amount:,.0f}\nFecha: {date}\n\n"
             f"¿A qué cita corresponde este pago? 🤔 Por favor escribe el número de cédula del paciente para buscar sus citas:",
             parse_mode='Markdown'
@@ -177,12 +307,12 @@ async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE
 
     # 4. Greeting (No Buttons - Just Friendly Response)
     elif intent == 'greeting':
-        await update.message.reply_text(message_text, parse_mode='Markdown')
+        await send_reply(update, placeholder, message_text, parse_mode='Markdown')
         return ConversationHandler.END
 
     # 5. Location Inquiry (No Buttons)
     elif intent == 'location_inquiry':
-        await update.message.reply_text(message_text, parse_mode='Markdown')
+        await send_reply(update, placeholder, message_text, parse_mode='Markdown')
         return ConversationHandler.END
 
     # 6. General / Other
@@ -190,14 +320,12 @@ async def process_ai_response(update: Update, context: ContextTypes.DEFAULT_TYPE
         reply_markup = None
         if suggested_ids:
             keyboard = []
-            for s_id in suggested_ids:
-                service = database.get_service_by_id(s_id)
-                if service:
-                    keyboard.append([InlineKeyboardButton(service['nombre'], callback_data=f"view_service_{s_id}")])
+            for service in await async_database.get_services_by_ids(suggested_ids):
+                keyboard.append([InlineKeyboardButton(service.nombre, callback_data=f"view_service_{service.id}")])
             keyboard.append([InlineKeyboardButton("📋 Ver todos los servicios", callback_data="show_all_services")])
             reply_markup = InlineKeyboardMarkup(keyboard)
 
-        await update.message.reply_text(message_text, reply_markup=reply_markup)
+        await send_reply(update, placeholder, message_text, reply_markup=reply_markup)
         return ConversationHandler.END
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -206,36 +334,93 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Send Typing Action
     await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
     
-    # Send to Gemini
-    ai_response = send_message_to_gemini([], user_text)
+    # Send to Gemini (streamed: the answer appears while it is generated)
+    stream = StreamingReply(update) if GEMINI_STREAMING else None
+    try:
+        ai_response = await ask_gemini(update, context, user_text, on_message=stream)
+    except asyncio.CancelledError:
+        if stream:
+            await stream.abandon()
+        raise
+    if ai_response is None:
+        if stream:
+            await stream.abandon()  # Superseded: don't leave a half-written answer behind
+        return None
     
     # Process Response
-    return await process_ai_response(update, context, ai_response)
+    return await process_ai_response(update, context, ai_response, placeholder=stream.message if stream else None)
 
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Get the photo file
-    photo_file = await update.message.photo[-1].get_file()
-    photo_bytes = await photo_file.download_as_bytearray()
+    photos = update.message.photo
+    file_unique_id = photos[-1].file_unique_id
+    context.user_data.pop('payment_proof', None)
     
-    # Send Typing Action
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
+    # Receipt already analysed (forwarded / resent): no download, no Gemini call
+    receipt = invoice_cache.by_file(file_unique_id)
+    if receipt is not None:
+        if receipt.appointment_id:
+            paid = await async_database.get_appointment_by_id(receipt.appointment_id)
+            if paid:
+                return await reject_duplicate_receipt(update, paid)
+        ai_response = copy.deepcopy(receipt.response)
+    else:
+        # Smallest photo size that is still legible, downscaled and stripped of metadata
+        photo_bytes = await media.prepare_photo(photos)
+        
+        # Send Typing Action
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
+        
+        # Send to Gemini
+        ai_response = await ask_gemini(update, context, update.message.caption or "", image_base64=photo_bytes)
+        if ai_response is None:
+            return None
+        if ai_response.get('intent') == 'invoice_analysis':
+            receipt, paid = await identify_receipt(photo_bytes, file_unique_id, ai_response)
+            if paid:
+                return await reject_duplicate_receipt(update, paid)
     
-    # Send to Gemini
-    ai_response = send_message_to_gemini([], update.message.caption or "", image_base64=photo_bytes)
+    if receipt is not None:
+        context.user_data['payment_proof'] = receipt.proof
     
     # Process Response
     return await process_ai_response(update, context, ai_response)
 
+async def identify_receipt(photo_bytes, file_unique_id, ai_response):
+    """
+    (Receipt, paid appointment or None) for a photo Gemini read as a payment
+    proof. Only payment proofs are fingerprinted and looked up in the database.
+    """
+    sha256_hex, dhash = await media.fingerprint(photo_bytes)
+    receipt = invoice_cache.by_content(sha256_hex, file_unique_id)
+    if receipt is None:
+        # Registered before a restart: only the database knows about it
+        paid = await async_database.get_appointment_by_payment_proof(invoice_cache.proof_id(sha256_hex))
+        if paid:
+            return None, paid
+        # Looks like an earlier receipt: the same one only if reference and amount match too
+        receipt = invoice_cache.by_payment(dhash, ai_response, file_unique_id)
+    if receipt is None:
+        return invoice_cache.store(file_unique_id, sha256_hex, dhash, ai_response), None
+    if receipt.appointment_id:
+        paid = await async_database.get_appointment_by_id(receipt.appointment_id)
+        if paid:
+            return receipt, paid
+    return receipt, None
+
+async def reject_duplicate_receipt(update: Update, paid):
+    """A receipt already used to pay an appointment is not registered again."""
+    invoice_cache.note_duplicate()
+    await update.message.reply_text(
+        f"⚠️ Este comprobante ya fue registrado como pago de la cita del {paid.date} a las {paid.time:%H:%M} ({paid.service_name}).\n\n"
+        "Si se trata de un pago diferente, envía la foto del comprobante correcto 🙏"
+    )
+    return ConversationHandler.END
+
 async def handle_voice(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Get voice file
-    voice_file = await update.message.voice.get_file()
-    voice_bytes = await voice_file.download_as_bytearray()
-    
-    # Send Typing Action (or Record Voice)
-    await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=constants.ChatAction.TYPING)
-    
-    # Send to Gemini
-    ai_response = send_message_to_gemini([], "", audio_base64=voice_bytes)
+    # Send to Gemini (or reuse the transcription of an already seen voice note)
+    ai_response = await ask_gemini_voice(update, context)
+    if ai_response is None:
+        return None
     
     transcription = ai_response.get('audioTranscription', '')
     
@@ -259,7 +444,7 @@ async def receive_id_for_payment(update: Update, context: ContextTypes.DEFAULT_T
         await update.message.reply_text("⚠️ Uy, esa cédula no parece válida. Intenta de nuevo por favor. 🙏")
         return ENTERING_ID_PAYMENT
 
-    apps = database.get_appointments_by_patient(patient_id)
+    apps = await async_database.get_appointments_by_patient(patient_id)
     if not apps:
         await update.message.reply_text("😔 No encontré citas para esta cédula. ¿Seguro que está bien escrita?")
         return ConversationHandler.END
@@ -267,8 +452,8 @@ async def receive_id_for_payment(update: Update, context: ContextTypes.DEFAULT_T
     # Show appointments to link payment
     keyboard = []
     for app in apps:
-        btn_text = f"{app['date']} {app['time']} - {app['service_name']}"
-        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"pay_{app['id']}")])
+        btn_text = f"{app.date} {app.time} - {app.service_name}"
+        keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"pay_{app.id}")])
         
     reply_markup = InlineKeyboardMarkup(keyboard)
     await update.message.reply_text("Selecciona la cita a pagar de la lista: 👇", reply_markup=reply_markup)
@@ -281,9 +466,11 @@ async def confirm_payment_selection(update: Update, context: ContextTypes.DEFAUL
     if query.data.startswith("pay_"):
         app_id = query.data.split("_")[1]
         amount = context.user_data.get('payment_amount', 0)
+        proof = context.user_data.get('payment_proof', 'digital_proof')
         
         # Update DB
-        if database.update_payment_status(app_id, 'paid', 'transfer', 'digital_proof', amount):
+        if await async_database.update_payment_status(app_id, 'paid', 'transfer', proof, amount):
+            invoice_cache.mark_registered(proof, app_id)
             await query.edit_message_text(f"✅ **¡Pago Registrado!** 🎉\n\nSe ha abonado ${amount:,.0f} a la cita. ¡Gracias!")
         else:
             await query.edit_message_text("❌ Hubo un error al registrar el pago. Lo siento 😔")
@@ -299,7 +486,15 @@ async def handle_booking_conversation_text(update: Update, context: ContextTypes
     user_text = update.message.text
     
     # Send to Gemini
-    ai_response = send_message_to_gemini([], user_text)
+    ai_response = await ask_gemini(update, context, user_text)
+    if ai_response is None:
+        return None
+
+    # Cancel / reschedule / check: hand over to the management flow (asks for the cédula)
+    # instead of answering and showing the services again
+    if ai_response.get('intent') in ('check_appointment', 'cancellation', 'reschedule'):
+        return await process_ai_response(update, context, ai_response)
+
     message_text = ai_response.get('message', '')
     suggested_ids = ai_response.get('suggestedServiceIds', [])
     
@@ -310,20 +505,19 @@ async def handle_booking_conversation_text(update: Update, context: ContextTypes
     # 2. Re-attach Service Buttons (Guidance)
     keyboard = []
     if suggested_ids:
-        for s_id in suggested_ids:
-            service = database.get_service_by_id(s_id)
-            if service:
-                emoji = SERVICE_EMOJIS.get(s_id, "🏥")
-                btn_text = f"{emoji} {service['nombre']}"
-                keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s_id}")])
+        for service in await async_database.get_services_by_ids(suggested_ids):
+            s_id = service.id
+            emoji = SERVICE_EMOJIS.get(s_id, "🏥")
+            btn_text = f"{emoji} {service.nombre}"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s_id}")])
         keyboard.append([InlineKeyboardButton("📋 Ver todos los servicios", callback_data="show_all_services")])
     else:
-        services = database.get_services()
+        services = await async_database.get_services()
         keyboard = []
         for s in services:
-            emoji = SERVICE_EMOJIS.get(s['id'], "🏥")
-            btn_text = f"{emoji} {s['nombre']}"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s['id']}")])
+            emoji = SERVICE_EMOJIS.get(s.id, "🏥")
+            btn_text = f"{emoji} {s.nombre}"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s.id}")])
     
     reply_markup = InlineKeyboardMarkup(keyboard)
     
@@ -346,12 +540,12 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 1. Show All Services List
     if data == "show_all_services":
         context.user_data['from_suggestions'] = False  # Reset flag
-        services = database.get_services()
+        services = await async_database.get_services()
         keyboard = []
         for s in services:
-            emoji = SERVICE_EMOJIS.get(s['id'], "🏥")
-            btn_text = f"{emoji} {s['nombre']}"
-            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s['id']}")])
+            emoji = SERVICE_EMOJIS.get(s.id, "🏥")
+            btn_text = f"{emoji} {s.nombre}"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s.id}")])
             
         reply_markup = InlineKeyboardMarkup(keyboard)
         await query.edit_message_text("📂 **Servicios Disponibles**\nSelecciona uno para ver más información: 👇", reply_markup=reply_markup, parse_mode='Markdown')
@@ -361,12 +555,11 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "back_to_suggestions":
         suggested_ids = context.user_data.get('last_suggested_ids', [])
         keyboard = []
-        for s_id in suggested_ids:
-            service = database.get_service_by_id(s_id)
-            if service:
-                emoji = SERVICE_EMOJIS.get(s_id, "🏥")
-                btn_text = f"{emoji} {service['nombre']}"
-                keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s_id}")])
+        for service in await async_database.get_services_by_ids(suggested_ids):
+            s_id = service.id
+            emoji = SERVICE_EMOJIS.get(s_id, "🏥")
+            btn_text = f"{emoji} {service.nombre}"
+            keyboard.append([InlineKeyboardButton(btn_text, callback_data=f"view_service_{s_id}")])
         
         keyboard.append([InlineKeyboardButton("📋 Ver todos los servicios", callback_data="show_all_services")])
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -376,16 +569,16 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 2. View Service Details (The "Card")
     if data.startswith("view_service_"):
         service_id = int(data.split("_")[-1])
-        service = database.get_service_by_id(service_id)
+        service = await async_database.get_service_by_id(service_id)
         
         # Store service_id temporarily
         context.user_data['temp_service_id'] = service_id
         
         emoji = SERVICE_EMOJIS.get(service_id, "🏥")
         details = (
-            f"{emoji} **{service['nombre']}**\n\n"
-            f"⏱ Duración: {service['duracion']} min\n"
-            f"📝 {service.get('description', 'Sin descripción')}\n"
+            f"{emoji} **{service.nombre}**\n\n"
+            f"⏱ Duración: {service.duracion} min\n"
+            f"📝 {service.description or 'Sin descripción'}\n"
         )
         
         keyboard = [
@@ -407,6 +600,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if data.startswith("book_"):
             service_id = int(data.split("_")[1])
             context.user_data['service_id'] = service_id
+            context.user_data.pop('slot_conflict', None)  # New booking: nothing carried over from a previous one
         else:
             service_id = context.user_data.get('service_id')
         
@@ -443,7 +637,7 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['date'] = date_text
         
         # Show Time Slots
-        time_keyboard = create_time_slots_keyboard(date_text, database.get_booked_slots(date_text))
+        time_keyboard = create_time_slots_keyboard(date_text, await async_database.get_booked_slots(date_text))
         await query.edit_message_text(
             f"📅 Fecha: {date_text}\n⏰ **Selecciona una hora:**",
             reply_markup=time_keyboard,
@@ -457,10 +651,10 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         # Double Check Availability (Race Condition)
         date_text = context.user_data['date']
-        if not database.check_availability(date_text, time_text):
+        if not await async_database.check_availability(date_text, time_text):
             await query.answer("⚠️ Uy, esa hora ya fue ocupada. Elige otra por favor. 🙏", show_alert=True)
             # Refresh slots
-            time_keyboard = create_time_slots_keyboard(date_text, database.get_booked_slots(date_text))
+            time_keyboard = create_time_slots_keyboard(date_text, await async_database.get_booked_slots(date_text))
             await query.edit_message_text(
                 f"📅 Fecha: {date_text}\n⏰ **Selecciona una hora:**",
                 reply_markup=time_keyboard,
@@ -474,20 +668,19 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # --- RESCHEDULING FLOW ---
         if context.user_data.get('is_rescheduling'):
             app_id = context.user_data['manage_app_id']
-            old_app = database.get_appointment_by_id(app_id)
+            old_app = await async_database.get_appointment_by_id(app_id)
             
             # Format Dates for Confirmation
-            old_date_obj = datetime.strptime(old_app['date'], "%Y-%m-%d")
             new_date_obj = datetime.strptime(date_text, "%Y-%m-%d")
             
             days_es = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
-            old_day = days_es[old_date_obj.weekday()]
+            old_day = days_es[old_app.date.weekday()]
             new_day = days_es[new_date_obj.weekday()]
             
             # Show Confirmation Dialog
             msg = (
                 f"⚠️ **Confirmar Cambio de Cita**\n\n"
-                f"📅 **Anterior:** {old_day} {old_app['date']} - {old_app['time']}\n"
+                f"📅 **Anterior:** {old_day} {old_app.date} - {old_app.time}\n"
                 f"📅 **Nueva:** {new_day} {date_text} - {time_text}\n\n"
                 f"¿Estás seguro de realizar este cambio?"
             )
@@ -527,18 +720,19 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "confirm_time_yes":
         date_text = context.user_data['date']
         time_text = context.user_data['time']
-        slot_key = f"{date_text}_{time_text}"
         
-        # Double Check Availability
-        if not database.check_availability(date_text, time_text):
+        # Double Check Availability (the booking itself is atomic, this is just early feedback)
+        if not await async_database.check_availability(date_text, time_text):
             await query.answer("⚠️ Lo sentimos, alguien acaba de tomar este horario. 🏃💨", show_alert=True)
-            booked = database.get_booked_slots(date_text)
+            booked = await async_database.get_booked_slots(date_text)
             time_markup = create_time_slots_keyboard(date_text, booked)
             await query.edit_message_text("Por favor selecciona otra hora:", reply_markup=time_markup)
             return CHOOSING_TIME
         
-        # Lock the slot temporarily
-        slot_locks[slot_key] = True
+        # Slot was lost at final confirmation: patient data is already filled in
+        if context.user_data.pop('slot_conflict', False):
+            await show_confirmation_summary(update, context)
+            return CONFIRMING
         
         await query.edit_message_text(
             f"✅ Fecha: {date_text}\n✅ Hora: {time_text}\n\n"
@@ -567,20 +761,26 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         date_text = context.user_data['date']
         time_text = context.user_data['time']
         
-        old_app = database.get_appointment_by_id(app_id)
+        old_app = await async_database.get_appointment_by_id(app_id)
+        result = await async_database.update_appointment(app_id, date_text, time_text)
+        
+        if isinstance(result, SlotTaken):
+            await query.answer("⚠️ Lo sentimos, alguien acaba de tomar este horario. 🏃💨", show_alert=True)
+            time_markup = create_time_slots_keyboard(date_text, result.booked_slots)
+            await query.edit_message_text("Por favor selecciona otra hora:", reply_markup=time_markup)
+            return CHOOSING_TIME
         
-        if database.update_appointment(app_id, date_text, time_text):
+        if result:
             # Format Dates
-            old_date_obj = datetime.strptime(old_app['date'], "%Y-%m-%d")
             new_date_obj = datetime.strptime(date_text, "%Y-%m-%d")
             
             days_es = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
-            old_day = days_es[old_date_obj.weekday()]
+            old_day = days_es[old_app.date.weekday()]
             new_day = days_es[new_date_obj.weekday()]
             
             msg = (
                 f"✅ **¡Cita Reprogramada Exitosamente!**\n\n"
-                f"📅 **Anterior:** {old_day} {old_app['date']} - {old_app['time']}\n"
+                f"📅 **Anterior:** {old_day} {old_app.date} - {old_app.time}\n"
                 f"📅 **Nueva:** {new_day} {date_text} - {time_text}\n\n"
                 f"Te esperamos. Si necesitas algo más como agendar otra cita, cancelar, cambiar el horario o info sobre la dirección del consultorio, no dudes en preguntar. Estoy aquí para ayudarte."
             )
@@ -596,17 +796,17 @@ async def button_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_confirmation_summary(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Summary
     s_id = context.user_data['service_id']
-    service = database.get_service_by_id(s_id)
+    service = await async_database.get_service_by_id(s_id)
     
     summary = (
         "📋 **CONFIRMAR CITA**\n\n"
         f"👤 **Paciente:** {context.user_data['name']}\n"
         f"🪪 **Cédula:** {context.user_data['patient_id']}\n"
         f"📱 **Celular:** {context.user_data['phone']}\n"
-        f"🏥 **Servicio:** {service['nombre']}\n"
+        f"🏥 **Servicio:** {service.nombre}\n"
         f"📅 **Fecha:** {context.user_data['date']}\n"
         f"⏰ **Hora:** {context.user_data['time']}\n"
-        f"💰 **Valor:** ${service['precio']:,.0f}\n"
+        f"💰 **Valor:** ${service.precio:,.0f}\n"
     )
     
     keyboard = [
@@ -726,7 +926,7 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # --- CONFIRMATION ---
     if data == "confirm_booking":
         # Save to DB
-        app_id = database.create_appointment(
+        app_id = await async_database.create_appointment(
             context.user_data['name'],
             context.user_data['patient_id'],
             context.user_data['phone'],
@@ -735,9 +935,17 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['time']
         )
         
+        if isinstance(app_id, SlotTaken):
+            # Someone booked the slot while the patient was typing their data
+            context.user_data['slot_conflict'] = True
+            await query.answer("⚠️ Lo sentimos, alguien acaba de tomar este horario. 🏃💨", show_alert=True)
+            time_markup = create_time_slots_keyboard(app_id.date, app_id.booked_slots)
+            await query.edit_message_text("Por favor selecciona otra hora:", reply_markup=time_markup)
+            return CHOOSING_TIME
+        
         if app_id:
             # Re-fetch service for the name
-            service = database.get_service_by_id(context.user_data['service_id'])
+            service = await async_database.get_service_by_id(context.user_data['service_id'])
             
             # Format Date with Day Name (e.g., Martes 2025-11-25)
             date_obj = datetime.strptime(context.user_data['date'], "%Y-%m-%d")
@@ -750,7 +958,7 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"🎫 **Credencial de Cita**\n"
                 f"━━━━━━━━━━━━━━━━\n"
                 f"👤 **Paciente:** {context.user_data['name']}\n"
-                f"🏥 **Servicio:** {service['nombre']}\n"
+                f"🏥 **Servicio:** {service.nombre}\n"
                 f"📅 **Fecha:** {formatted_date}\n"
                 f"🕒 **Hora:** {context.user_data['time']}\n"
                 f"━━━━━━━━━━━━━━━━\n\n"
@@ -760,9 +968,11 @@ async def confirm_booking(update: Update, context: ContextTypes.DEFAULT_TYPE):
         else:
             await query.edit_message_text("❌ Hubo un error al guardar la cita. Intenta de nuevo por favor. 😔")
             
+        context.user_data.pop('slot_conflict', None)
         return ConversationHandler.END
         
     if data == "cancel_booking":
+        context.user_data.pop('slot_conflict', None)
         await query.edit_message_text("❌ Proceso de agendamiento cancelado. ¡Avísame si necesitas algo más! 👋")
         return ConversationHandler.END
 
@@ -785,7 +995,7 @@ async def receive_id_for_management(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("⚠️ Cédula inválida. Intenta de nuevo por favor. 🙏")
         return ENTERING_ID_CANCEL
         
-    apps = database.get_appointments_by_patient(patient_id)
+    apps = await async_database.get_appointments_by_patient(patient_id)
     
     if not apps:
         await update.message.reply_text("ℹ️ No encontré citas activas para esta cédula.")
@@ -801,7 +1011,7 @@ async def receive_id_for_management(update: Update, context: ContextTypes.DEFAUL
     
     for app in apps:
         # Parse app date and time
-        app_dt = datetime.strptime(f"{app['date']} {app['time']}", "%Y-%m-%d %H:%M:%S")
+        app_dt = app.starts_at
         
         # Filter past appointments (keep only today and future)
         if app_dt.date() < now.date():
@@ -813,12 +1023,12 @@ async def receive_id_for_management(update: Update, context: ContextTypes.DEFAUL
         
         # Check 1 day notice (Relaxed: Appointment Date > Now Date)
         if app_dt.date() > now.date():
-            btn_text = f"❌ {day_name} {app['date']} {app['time']} - {app['service_name']}"
-            callback = f"manage_{app['id']}"
+            btn_text = f"❌ {day_name} {app.date} {app.time} - {app.service_name}"
+            callback = f"manage_{app.id}"
             keyboard.append([InlineKeyboardButton(btn_text, callback_data=callback)])
         else:
             # Today (Locked)
-            btn_text = f"🔒 {day_name} {app['date']} {app['time']} (No modificable)"
+            btn_text = f"🔒 {day_name} {app.date} {app.time} (No modificable)"
             callback = "ignore_cancellation"
             keyboard.append([InlineKeyboardButton(btn_text, callback_data=callback)])
         
@@ -865,13 +1075,13 @@ async def manage_appointment_menu(update: Update, context: ContextTypes.DEFAULT_
     elif data == "back_to_list":
         patient_id = context.user_data.get('manage_patient_id')
         if patient_id:
-            apps = database.get_appointments_by_patient(patient_id)
+            apps = await async_database.get_appointments_by_patient(patient_id)
             msg = "📅 **Tus Citas Activas:**\nSelecciona una cita de la lista si deseas cancelarla o cambiar el horario.\n_(Recuerda que debes hacerlo con al menos un día de antelación)_"
             keyboard = []
             now = datetime.now()
             
             for app in apps:
-                app_dt = datetime.strptime(f"{app['date']} {app['time']}", "%Y-%m-%d %H:%M:%S")
+                app_dt = app.starts_at
                 # Filter past appointments
                 if app_dt.date() < now.date():
                     continue
@@ -880,11 +1090,11 @@ async def manage_appointment_menu(update: Update, context: ContextTypes.DEFAULT_
                 day_name = days_es[app_dt.weekday()]
                 
                 if app_dt.date() > now.date():
-                    btn_text = f"❌ {day_name} {app['date']} {app['time']} - {app['service_name']}"
-                    callback = f"manage_{app['id']}"
+                    btn_text = f"❌ {day_name} {app.date} {app.time} - {app.service_name}"
+                    callback = f"manage_{app.id}"
                     keyboard.append([InlineKeyboardButton(btn_text, callback_data=callback)])
                 else:
-                    btn_text = f"🔒 {day_name} {app['date']} {app['time']} (No modificable)"
+                    btn_text = f"🔒 {day_name} {app.date} {app.time} (No modificable)"
                     callback = "ignore_cancellation"
                     keyboard.append([InlineKeyboardButton(btn_text, callback_data=callback)])
             
@@ -906,7 +1116,7 @@ async def manage_appointment_menu(update: Update, context: ContextTypes.DEFAULT_
         
     elif data == "do_cancel":
         app_id = context.user_data['manage_app_id']
-        if database.cancel_appointment(app_id):
+        if await async_database.cancel_appointment(app_id):
             msg = (
                 "✅ **Cita cancelada exitosamente.**\n\n"
                 "Si necesitas algo más como la dirección del consultorio o ayuda para agendar nuevamente otra cita no dudes en preguntar, estoy aquí para ayudarte. 🤝"
@@ -937,15 +1147,108 @@ async def manage_appointment_menu(update: Update, context: ContextTypes.DEFAULT_
             
     return ConversationHandler.END
 
+# --- ADMIN COMMANDS ---
+
+async def reload_services(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/recargar_servicios: reloads the in-memory service catalog from the database."""
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
+    
+    version = await async_database.refresh_service_catalog()
+    services = await async_database.get_services()
+    await update.message.reply_text(f"🔄 Catálogo recargado: {len(services)} servicios (versión {version}).")
+
+async def query_metrics(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/metricas: slowest query functions (by total time) and connection pool usage."""
+    if update.effective_chat.id not in ADMIN_CHAT_IDS:
+        return
+    
+    metrics = get_query_metrics()
+    functions = sorted(metrics['functions'].items(), key=lambda item: item[1]['total_ms'], reverse=True)
+    
+    lines = [f"📊 Consultas desde {metrics['since']}", ""]
+    for name, m in functions[:10]:
+        lines.append(
+            f"{name}: {m['calls']} llamadas, p50 {m['p50_ms']:.0f} / p95 {m['p95_ms']:.0f} / p99 {m['p99_ms']:.0f} ms, "
+            f"{m['rows']} filas, {m['errors']} errores, {m['slow']} lentas"
+        )
+    if not functions:
+        lines.append("Sin consultas registradas todavía.")
+    
+    pool = metrics['pool']
+    lines.append("")
+    lines.append(f"🔌 Pool: {pool['in_use']}/{pool['size']} en uso, espera media {pool['wait_avg'] * 1000:.1f} ms, timeouts {pool['timeouts']}")
+    
+    cache = get_response_cache_stats()
+    lines.append(f"🧠 Caché Gemini: {cache['hits']}/{cache['hits'] + cache['misses']} aciertos ({cache['hit_rate']:.0%}), {cache['size']} respuestas guardadas")
+    tokens = get_token_stats()
+    lines.append(f"🔤 Tokens Gemini: {tokens['requests']} llamadas, {tokens['prompt']} de entrada ({tokens['cached_share']:.0%} en caché, máx {tokens['max_prompt']} por llamada), {tokens['output']} de salida")
+    fast = get_fast_path_stats()
+    lines.append(f"⚡ Respuestas locales: {fast['answered']}/{fast['calls']} mensajes sin Gemini ({fast['avoided_rate']:.0%})")
+    flights = get_coalescing_stats()
+    lines.append(f"🔗 Llamadas compartidas: {flights['coalesced']}/{flights['calls']} ({flights['coalesced_rate']:.0%}), {flights['abandoned']} abandonadas")
+    images = media.get_media_stats()
+    lines.append(
+        f"🖼️ Imágenes: {images['images']} procesadas, {images['saved_bytes'] // 1024} KB ahorrados ({images['saved_rate']:.0%}), "
+        f"p50 {images['p50_ms']:.0f} / p95 {images['p95_ms']:.0f} ms"
+    )
+    voices = transcription_cache.get_transcription_cache_stats()
+    lines.append(f"🎤 Transcripciones: {voices['memory_hits'] + voices['disk_hits']} reutilizadas ({voices['hit_rate']:.0%}), {voices['size']} en memoria")
+    receipts = invoice_cache.get_invoice_cache_stats()
+    lines.append(
+        f"🧾 Comprobantes: {receipts['file_hits'] + receipts['exact_hits'] + receipts['near_hits']} reconocidos ({receipts['hit_rate']:.0%}), "
+        f"{receipts['duplicates']} duplicados rechazados, {receipts['near_mismatches']} parecidos pero distintos"
+    )
+    history = conversation_memory.get_history_stats()
+    lines.append(
+        f"💬 Memoria: {history['chats']} chats, {history['avg_history_tokens']:.0f} tokens de historial por llamada "
+        f"(máx {history['max_history_tokens']}, presupuesto {history['token_budget']}), {history['turns_summarized']} turnos resumidos"
+    )
+    transport = get_transport_stats()
+    breaker = transport['breaker']
+    lines.append(
+        f"🛡️ Gemini: circuito {breaker['state']} (abierto {breaker['opened']} veces, {breaker['short_circuited']} rechazadas), "
+        f"{transport['retries']} reintentos, {transport['retries_exhausted']} agotados, {transport['timeouts']} sin respuesta, "
+        f"{transport['hedges']} duplicadas ({transport['hedge_wins']} ganadas), {transport['stream_failures']} streams cortados"
+    )
+    updates = context.application.update_processor.stats()
+    lines.append(f"📨 Mensajes: {updates['waited']}/{updates['updates']} esperaron al anterior de su chat, {updates['busy_chats']} chats ocupados")
+    await update.message.reply_text("\n".join(lines))
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    cancel_gemini(context)
+    context.user_data.pop('slot_conflict', None)
     await update.message.reply_text("Operación cancelada. ¡Aquí estaré si me necesitas! 👋")
     return ConversationHandler.END
 
+async def post_init(application):
+    # google-genai's client.aio runs each request with asyncio.to_thread, on the
+    # loop's default executor. Bound it: calls abandoned on timeout keep their thread.
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=GEMINI_SDK_THREADS, thread_name_prefix="genai")
+    )
+
 def main():
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    def on_busy(update):
+        # A new message (or /cancel) for a chat still waiting on Gemini: the user
+        # moved on, so the pending call is cancelled and its handler stops quietly
+        if update.message:
+            chat_data = application.chat_data.get(update.effective_chat.id)
+            if chat_data:
+                _cancel_gemini_task(chat_data)
+
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerChatUpdateProcessor(BOT_CONCURRENT_UPDATES, on_busy=on_busy))
+        .post_init(post_init)
+        .build()
+    )
     
     # Handlers
     application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("recargar_servicios", reload_services))
+    application.add_handler(CommandHandler("metricas", query_metrics))
     
     # Booking Conversation
     booking_conv = ConversationHandler(
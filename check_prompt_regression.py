@@ -0,0 +1,126 @@
+"""
+Size and quality check of the system prompt built by prompt_manager.py.
+
+1. Builds today's system instruction from the live Services table and reports
+   its size: exact tokens via the Gemini count_tokens API when GOOGLE_API_KEY is
+   set, otherwise a ~4 chars/token estimate. Fails if it exceeds
+   PROMPT_TOKEN_BUDGET.
+2. Replays the recorded cases (prompt_regression_cases.jsonl, one JSON object
+   per line: "message", expected "intent" and optionally "services", the ids of
+   which at least one must be suggested; an empty list means no suggestions)
+   against Gemini with that prompt, bypassing the fast path and the caches.
+   Fails if the pass rate is below --min-pass.
+
+Run it after editing SYSTEM_INSTRUCTION or the catalog rendering.
+
+Usage:
+    python check_prompt_regression.py
+    python check_prompt_regression.py --size-only
+    python check_prompt_regression.py --cases my_cases.jsonl --min-pass 0.85
+"""
+import argparse
+import datetime
+import json
+import os
+import sys
+
+import database
+import gemini_service
+from config import GOOGLE_API_KEY, PROMPT_TOKEN_BUDGET
+from prompt_manager import Prompt, build_instruction, render_service_table
+from text_utils import estimate_tokens
+
+DEFAULT_CASES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompt_regression_cases.jsonl")
+
+def load_cases(path):
+    cases = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                cases.append(json.loads(line))
+    return cases
+
+def count_tokens(text):
+    """(tokens, method): exact count from the API when possible, estimate otherwise."""
+    if GOOGLE_API_KEY:
+        try:
+            result = gemini_service.client.models.count_tokens(model=gemini_service.MODEL_ID, contents=text)
+            return result.total_tokens, "count_tokens"
+        except Exception as e:
+            print(f"count_tokens failed, using estimate: {e}")
+    return estimate_tokens(text), "estimate"
+
+def check_size(instruction, services):
+    table = render_service_table(services)
+    tokens, method = count_tokens(instruction)
+    table_tokens, _ = count_tokens(table)
+    print(f"System instruction: {len(instruction):,} chars, {tokens:,} tokens ({method})")
+    print(f"Service table:      {len(table):,} chars, {table_tokens:,} tokens, {len(table.splitlines()) - 1} services")
+    print(f"Budget:             {PROMPT_TOKEN_BUDGET:,} tokens\n")
+    return tokens <= PROMPT_TOKEN_BUDGET
+
+def check_case(case, response):
+    """List of failure reasons (empty when the case passes)."""
+    failures = []
+    if response.get("intent") != case["intent"]:
+        failures.append(f"intent {response.get('intent')!r}, expected {case['intent']!r}")
+    if "services" in case:
+        suggested = set(response.get("suggestedServiceIds") or [])
+        expected = set(case["services"])
+        if expected and not suggested & expected:
+            failures.append(f"suggested {sorted(suggested)}, expected one of {sorted(expected)}")
+        elif not expected and suggested:
+            failures.append(f"suggested {sorted(suggested)}, expected none")
+    return failures
+
+def replay(cases, prompt):
+    passed = 0
+    for case in cases:
+        contents, config = gemini_service._build_request(prompt, case["message"])
+        try:
+            response = gemini_service.client.models.generate_content(
+                model=gemini_service.MODEL_ID, contents=contents, config=config
+            )
+            failures = check_case(case, gemini_service._parse_response(response))
+        except Exception as e:
+            failures = [f"error: {e}"]
+        if failures:
+            print(f"FAIL {case['message']!r}: {'; '.join(failures)}")
+        else:
+            passed += 1
+    return passed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cases", default=DEFAULT_CASES, help="JSONL file with the recorded cases")
+    parser.add_argument("--min-pass", type=float, default=0.9, help="Minimum share of cases that must pass")
+    parser.add_argument("--size-only", action="store_true", help="Only check the prompt size (no Gemini calls)")
+    args = parser.parse_args()
+
+    services = database.get_services()
+    if not services:
+        print("No services in the catalog; check the database connection.")
+        sys.exit(1)
+
+    today = datetime.date.today()
+    instruction = build_instruction(today, services)
+    ok = check_size(instruction, services)
+    if not ok:
+        print("Prompt is over budget.")
+
+    if not args.size_only:
+        if not GOOGLE_API_KEY:
+            print("GOOGLE_API_KEY is not set; skipping the replay.")
+            sys.exit(0 if ok else 1)
+        cases = load_cases(args.cases)
+        # Never uploaded, so the instruction is sent inline
+        prompt = Prompt((today, database.get_catalog_version()), instruction)
+        passed = replay(cases, prompt)
+        rate = passed / len(cases) if cases else 0.0
+        print(f"\nCases: {passed}/{len(cases)} passed ({rate:.1%}, minimum {args.min_pass:.0%})")
+        ok = ok and rate >= args.min_pass
+
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,10 @@ SQL_TRUSTED_CONNECTION = os.getenv('SQL_TRUSTED_CONNECTION', 'yes')
 SQL_USER = os.getenv('SQL_USER')
 SQL_PASSWORD = os.getenv('SQL_PASSWORD')
 
+# Storage backend: 'sqlserver' (default) or 'sqlite' (embedded, see db_backends.py)
+DB_BACKEND = os.getenv('DB_BACKEND', 'sqlserver').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'fisioterapia.db')
+
 # Construct Connection String
 if SQL_TRUSTED_CONNECTION.lower() == 'yes':
     DB_CONNECTION_STRING = (
@@ -34,6 +38,104 @@ else:
         f"PWD={SQL_PASSWORD};"
     )
 
+# Database Connection Pool
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))  # Max open connections
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))  # Reopen connections older than this (seconds)
+DB_POOL_VALIDATE_AFTER = int(os.getenv('DB_POOL_VALIDATE_AFTER', '30'))  # Ping connections idle longer than this (seconds)
+
+# Service Catalog Cache
+SERVICE_CATALOG_TTL = int(os.getenv('SERVICE_CATALOG_TTL', '3600'))  # Reload Services table at least this often (seconds)
+SERVICE_CATALOG_STAMP_FILE = os.getenv('SERVICE_CATALOG_STAMP_FILE', 'service_catalog.stamp')  # Touched by scripts to invalidate the bot's cache
+
+# Bookable Slots (start hour of each 1h slot: 9-12 and 14-19)
+SLOT_HOURS = [9, 10, 11, 14, 15, 16, 17, 18]
+
+# Slot Occupancy Index
+SLOT_INDEX_HORIZON_DAYS = int(os.getenv('SLOT_INDEX_HORIZON_DAYS', '62'))  # Days ahead kept in memory
+SLOT_INDEX_RECONCILE = int(os.getenv('SLOT_INDEX_RECONCILE', '300'))  # Re-sync with the DB every N seconds
+
+# Query Instrumentation (db_metrics.py)
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv('SLOW_QUERY_THRESHOLD_MS', '200'))  # Log calls slower than this (0 disables the log)
+SLOW_QUERY_LOG = os.getenv('SLOW_QUERY_LOG', 'slow_queries.log')  # JSON lines, one per slow call
+
+# Per-Patient Appointment Cache
+PATIENT_CACHE_SIZE = int(os.getenv('PATIENT_CACHE_SIZE', '1000'))  # Patients kept (least recently used are evicted)
+PATIENT_CACHE_TTL = int(os.getenv('PATIENT_CACHE_TTL', '120'))  # Re-query after this many seconds (writes from other processes)
+
+# Admin chats allowed to run maintenance commands (comma-separated Telegram chat IDs)
+ADMIN_CHAT_IDS = {int(x) for x in os.getenv('ADMIN_CHAT_IDS', '').split(',') if x.strip()}
+
+# Rows fetched per round trip by streaming queries (database.iter_appointments_by_range)
+DB_FETCH_BATCH_SIZE = int(os.getenv('DB_FETCH_BATCH_SIZE', '500'))
+
+# PDF report detail table (reports.py): rows listed at most, and rows per table flowable
+REPORT_DETAIL_MAX_ROWS = int(os.getenv('REPORT_DETAIL_MAX_ROWS', '2000'))
+REPORT_DETAIL_CHUNK_ROWS = int(os.getenv('REPORT_DETAIL_CHUNK_ROWS', '200'))
+
+# Async Data Access (async_database.py)
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', str(DB_POOL_SIZE)))  # Threads running blocking DB calls
+DB_CALL_TIMEOUT = float(os.getenv('DB_CALL_TIMEOUT', '15'))  # Per-call deadline (seconds)
+
+# Gemini Calls (gemini_service.py)
+GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '8'))  # Requests in flight at once
+GEMINI_CALL_TIMEOUT = float(os.getenv('GEMINI_CALL_TIMEOUT', '30'))  # Per-call deadline, including the wait for a free slot (seconds)
+GEMINI_ATTEMPT_TIMEOUT = float(os.getenv('GEMINI_ATTEMPT_TIMEOUT', '15'))  # Per-request deadline once a slot is held; these count for the circuit breaker (seconds)
+
+# Gemini Retries, Circuit Breaker and Hedging (gemini_resilience.py)
+GEMINI_RETRY_ATTEMPTS = int(os.getenv('GEMINI_RETRY_ATTEMPTS', '3'))  # Attempts per call, counting the first one
+GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '0.5'))  # Backoff base (seconds, doubled per retry, jittered)
+GEMINI_RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', '4'))  # Backoff cap (seconds)
+GEMINI_BREAKER_THRESHOLD = int(os.getenv('GEMINI_BREAKER_THRESHOLD', '5'))  # Consecutive failed calls that open the breaker
+GEMINI_BREAKER_COOLDOWN = float(os.getenv('GEMINI_BREAKER_COOLDOWN', '30'))  # Seconds before a probe call is let through
+GEMINI_HEDGE_ENABLED = os.getenv('GEMINI_HEDGE_ENABLED', 'no').lower() == 'yes'  # Second request after the p95 latency
+GEMINI_HEDGE_MIN_DELAY = float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '2'))  # Never hedge sooner than this (seconds)
+
+# Upload the daily system prompt as Gemini cached content (falls back to inline when unsupported)
+GEMINI_CONTEXT_CACHE = os.getenv('GEMINI_CONTEXT_CACHE', 'yes').lower() == 'yes'
+GEMINI_LOG_USAGE = os.getenv('GEMINI_LOG_USAGE', 'no').lower() == 'yes'  # Print the token counts of every call (debug); totals are always in /metricas
+
+# Local Fast-Path Intent Classifier (intent_classifier.py)
+FAST_PATH_ENABLED = os.getenv('FAST_PATH_ENABLED', 'yes').lower() == 'yes'
+FAST_PATH_MIN_CONFIDENCE = float(os.getenv('FAST_PATH_MIN_CONFIDENCE', '0.8'))  # Below this the message goes to Gemini
+
+# FAQ Response Cache (gemini_service.py)
+GEMINI_CACHE_SIZE = int(os.getenv('GEMINI_CACHE_SIZE', '500'))  # Distinct questions kept
+GEMINI_CACHE_TTL = int(os.getenv('GEMINI_CACHE_TTL', '21600'))  # Seconds (entries also expire at midnight)
+
+# Photo Preprocessing before Gemini (media.py)
+MEDIA_MIN_SIDE = int(os.getenv('MEDIA_MIN_SIDE', '720'))  # Smallest short side (px) downloaded from Telegram
+MEDIA_MAX_SIDE = int(os.getenv('MEDIA_MAX_SIDE', '1280'))  # Long side (px) images are downscaled to, unless that takes the short side below MEDIA_MIN_SIDE
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', '300000'))  # Byte budget per image sent to Gemini
+MEDIA_JPEG_QUALITY = int(os.getenv('MEDIA_JPEG_QUALITY', '85'))  # Starting JPEG quality when re-encoding
+MEDIA_WORKERS = int(os.getenv('MEDIA_WORKERS', '2'))  # Threads resizing / re-encoding images
+
+# Voice-Note Transcription Cache (transcription_cache.py)
+TRANSCRIPTION_CACHE_SIZE = int(os.getenv('TRANSCRIPTION_CACHE_SIZE', '1000'))  # Voice notes kept in memory
+TRANSCRIPTION_CACHE_PATH = os.getenv('TRANSCRIPTION_CACHE_PATH', '')  # SQLite file for the disk tier (empty = memory only)
+TRANSCRIPTION_DISK_MAX_ENTRIES = int(os.getenv('TRANSCRIPTION_DISK_MAX_ENTRIES', '20000'))
+
+# Payment Receipt Cache (invoice_cache.py)
+INVOICE_CACHE_SIZE = int(os.getenv('INVOICE_CACHE_SIZE', '2000'))  # Receipts remembered in memory
+INVOICE_HASH_MAX_DISTANCE = int(os.getenv('INVOICE_HASH_MAX_DISTANCE', '4'))  # dHash bits (of 64) two copies of a receipt may differ by; a hint only, reference and amount must match too
+
+# Streamed Gemini answers shown while they are generated (bot.handle_message)
+GEMINI_STREAMING = os.getenv('GEMINI_STREAMING', 'yes').lower() == 'yes'
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.0'))  # Min seconds between edits of the same message (Telegram rate limits)
+
+# Per-Chat Conversation Memory sent to Gemini (conversation_memory.py)
+HISTORY_ENABLED = os.getenv('HISTORY_ENABLED', 'yes').lower() == 'yes'
+HISTORY_MAX_TURNS = int(os.getenv('HISTORY_MAX_TURNS', '10'))  # Recent turns kept verbatim (user + Gon)
+HISTORY_TOKEN_BUDGET = int(os.getenv('HISTORY_TOKEN_BUDGET', '600'))  # Above this, the oldest turns are summarized
+HISTORY_SUMMARY_TOKENS = int(os.getenv('HISTORY_SUMMARY_TOKENS', '150'))  # Cap of the rolling summary
+HISTORY_TURN_MAX_CHARS = int(os.getenv('HISTORY_TURN_MAX_CHARS', '500'))  # Longer turns are cut
+HISTORY_IDLE_TTL = int(os.getenv('HISTORY_IDLE_TTL', '1800'))  # Seconds without messages before a chat is forgotten
+HISTORY_MAX_CHATS = int(os.getenv('HISTORY_MAX_CHATS', '5000'))  # Chats remembered at once
+
+# Telegram updates handled at the same time across chats; each chat's updates still run one at a time (update_processor.py)
+BOT_CONCURRENT_UPDATES = int(os.getenv('BOT_CONCURRENT_UPDATES', '32'))
+GEMINI_SDK_THREADS = int(os.getenv('GEMINI_SDK_THREADS', '16'))  # Default executor threads; the SDK's client.aio runs requests there
+
 # Clinic Info (Ported from constants.ts)
 CLINIC_INFO = {
   "name": "Consultorio Ana María López Fisioterapia Especializada",
@@ -43,6 +145,22 @@ CLINIC_INFO = {
   "botName": "Gon"
 }
 
+# Emoji shown next to each service (buttons and system prompt)
+SERVICE_EMOJIS = {
+    1: "🩺", 2: "📷", 3: "💆‍♂️", 4: "⚡", 5: "📦", 
+    6: "🏋️", 7: "🧖", 8: "🏃", 9: "🤰", 10: "🧘", 
+    11: "🩸", 13: "🧖‍♀️"
+}
+
+# Replaced by prompt_manager with the service table generated from the live catalog
+SERVICE_CATALOG_PLACEHOLDER = "<<CATALOGO_SERVICIOS>>"
+# Services kept out of the prompt's table, as in the original hand-written list: the
+# plasma package (12) and the facial add-ons (14, 15) are only booked from the buttons
+PROMPT_EXCLUDED_SERVICE_IDS = {int(i) for i in os.getenv('PROMPT_EXCLUDED_SERVICE_IDS', '12,14,15').split(',') if i.strip()}
+
+# Size the generated system instruction must stay under (see check_prompt_regression.py)
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '2200'))
+
 SYSTEM_INSTRUCTION = f"""
 Eres Gon, el asistente virtual comercial e inteligente del consultorio de Fisioterapia de Ana María López.
 
@@ -51,19 +169,7 @@ INFORMACIÓN DEL NEGOCIO:
 - Dirección: {CLINIC_INFO['address']} (Mapa: {CLINIC_INFO['mapUrl']})
 - Horarios: Lunes a Sábado, 9am-12pm y 2pm-7pm. Dom/Festivos CERRADO.
 
-LISTA DE SERVICIOS DISPONIBLES (ID: Nombre - Precio):
-1: 🩺 Consulta General (Evaluación inicial) - $65,000
-2: 📷 Valoración por fisioterapia + ecografía especializada - $85,000
-3: 💆‍♂️ Sesión de descarga muscular en piernas - $75,000
-4: ⚡ Terapia física avanzada y manejo del dolor - $65,000
-5: 📦 Paquete 5 sesiones terapia física - $250,000
-6: 🏋️ Sesión de ejercicio personalizado - $50,000
-7: 🧖 Sesión recovery y relajación - $80,000
-8: 🏃 Entrenamiento deportivo - $60,000
-9: 🤰 Acondicionamiento físico en el embarazo - $50,000
-10: 🧘 Sesión pilates piso - $50,000
-11: 🩸 Plasma rico en plaquetas - $165,000
-13: 🧖‍♀️ Limpieza facial profunda - $90,000
+{SERVICE_CATALOG_PLACEHOLDER}
 
 TU OBJETIVO:
 Concretar citas, ayudar a modificarlas y brindar soporte, manteniendo una conversación natural, empática y profesional.
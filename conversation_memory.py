@@ -0,0 +1,182 @@
+"""
+Per-chat conversation memory passed to Gemini as `history`.
+
+Each chat keeps its last HISTORY_MAX_TURNS turns (user text / Gon's answer,
+whitespace-collapsed and cut at HISTORY_TURN_MAX_CHARS). When the turns go
+over HISTORY_TOKEN_BUDGET (or the turn limit) the oldest ones are folded into
+a rolling summary of one short line per turn, itself capped at
+HISTORY_SUMMARY_TOKENS; the summary is built locally, so remembering costs no
+extra Gemini calls.
+
+Memory stays bounded across thousands of chats: chats idle for longer than
+HISTORY_IDLE_TTL are dropped, and at most HISTORY_MAX_CHATS are kept (least
+recently used first out).
+
+get_history_stats() reports how many tokens of history go out with each
+request, to tune the budget against latency / cost.
+"""
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
+from config import (
+    HISTORY_MAX_TURNS, HISTORY_TOKEN_BUDGET, HISTORY_SUMMARY_TOKENS,
+    HISTORY_TURN_MAX_CHARS, HISTORY_IDLE_TTL, HISTORY_MAX_CHATS,
+)
+from text_utils import estimate_tokens
+
+# Characters kept of each turn once it is folded into the summary
+SUMMARY_LINE_CHARS = 90
+SUMMARY_HEADER = "Resumen de la conversación anterior:"
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _compact(text, max_chars):
+    text = _WHITESPACE.sub(" ", text or "").strip()
+    return text if len(text) <= max_chars else text[:max_chars - 1] + "…"
+
+
+class Turn:
+    __slots__ = ("role", "text", "tokens")
+
+    def __init__(self, role, text):
+        self.role = role  # "user" / "model"
+        self.text = text
+        self.tokens = estimate_tokens(text)
+
+
+class ChatHistory:
+    __slots__ = ("turns", "tokens", "summary", "summary_tokens", "last_used")
+
+    def __init__(self):
+        self.turns = deque()
+        self.tokens = 0
+        self.summary = deque()  # One line per folded turn
+        self.summary_tokens = 0
+        self.last_used = time.monotonic()
+
+
+class ConversationMemory:
+    def __init__(self, max_turns, token_budget, summary_tokens, turn_max_chars, idle_ttl, max_chats):
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary_budget = summary_tokens
+        self.turn_max_chars = turn_max_chars
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        self._chats = OrderedDict()  # chat_id -> ChatHistory, least recently used first
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "history_tokens": 0,
+            "max_history_tokens": 0,
+            "turns_recorded": 0,
+            "turns_summarized": 0,
+            "idle_evictions": 0,
+            "lru_evictions": 0,
+        }
+
+    # --- Bounding ---
+
+    def _evict_idle(self, now):
+        while self._chats:
+            chat_id, chat = next(iter(self._chats.items()))
+            if now - chat.last_used <= self.idle_ttl:
+                break
+            del self._chats[chat_id]
+            self._stats["idle_evictions"] += 1
+
+    def _fold(self, chat):
+        """Moves the oldest turn into the summary, trimming the summary to its budget."""
+        turn = chat.turns.popleft()
+        chat.tokens -= turn.tokens
+        who = "Paciente" if turn.role == "user" else "Gon"
+        line = f"- {who}: {_compact(turn.text, SUMMARY_LINE_CHARS)}"
+        chat.summary.append(line)
+        chat.summary_tokens += estimate_tokens(line)
+        while chat.summary_tokens > self.summary_budget and len(chat.summary) > 1:
+            chat.summary_tokens -= estimate_tokens(chat.summary.popleft())
+        self._stats["turns_summarized"] += 1
+
+    # --- Public API ---
+
+    def get(self, chat_id):
+        """History for a request: [{'role', 'text'}], oldest first, with the summary as the first turn."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            chat = self._chats.get(chat_id)
+            history = []
+            tokens = 0
+            if chat is not None:
+                chat.last_used = now
+                self._chats.move_to_end(chat_id)
+                if chat.summary:
+                    history.append({"role": "user", "text": SUMMARY_HEADER + "\n" + "\n".join(chat.summary)})
+                    tokens += chat.summary_tokens
+                history.extend({"role": turn.role, "text": turn.text} for turn in chat.turns)
+                tokens += chat.tokens
+            self._stats["requests"] += 1
+            self._stats["history_tokens"] += tokens
+            self._stats["max_history_tokens"] = max(self._stats["max_history_tokens"], tokens)
+        return history
+
+    def record(self, chat_id, user_text, model_text):
+        """Adds one exchange to the chat's history."""
+        now = time.monotonic()
+        with self._lock:
+            self._evict_idle(now)
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = ChatHistory()
+                while len(self._chats) > self.max_chats:
+                    self._chats.popitem(last=False)
+                    self._stats["lru_evictions"] += 1
+            chat.last_used = now
+            self._chats.move_to_end(chat_id)
+
+            for role, text in (("user", user_text), ("model", model_text)):
+                text = _compact(text, self.turn_max_chars)
+                if not text:
+                    continue
+                turn = Turn(role, text)
+                chat.turns.append(turn)
+                chat.tokens += turn.tokens
+                self._stats["turns_recorded"] += 1
+
+            while chat.turns and (len(chat.turns) > self.max_turns or chat.tokens > self.token_budget):
+                self._fold(chat)
+
+    def clear(self, chat_id):
+        with self._lock:
+            self._chats.pop(chat_id, None)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["chats"] = len(self._chats)
+            stats["turns"] = sum(len(chat.turns) for chat in self._chats.values())
+        stats["avg_history_tokens"] = stats["history_tokens"] / stats["requests"] if stats["requests"] else 0.0
+        stats["token_budget"] = self.token_budget
+        return stats
+
+
+_memory = ConversationMemory(
+    HISTORY_MAX_TURNS, HISTORY_TOKEN_BUDGET, HISTORY_SUMMARY_TOKENS,
+    HISTORY_TURN_MAX_CHARS, HISTORY_IDLE_TTL, HISTORY_MAX_CHATS,
+)
+
+def get(chat_id):
+    return _memory.get(chat_id)
+
+def record(chat_id, user_text, model_text):
+    _memory.record(chat_id, user_text, model_text)
+
+def clear(chat_id):
+    _memory.clear(chat_id)
+
+def get_history_stats():
+    """Chats and turns held, and the history tokens sent per request (avg / max)."""
+    return _memory.stats()
@@ -1,212 +1,1041 @@
-import pyodbc
 import uuid
-from datetime import datetime
-from config import DB_CONNECTION_STRING
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from decimal import Decimal
+from db_backends import get_backend
+import db_metrics
+from db_metrics import instrumented, note_acquire, note_error
+from config import (
+    DB_BACKEND,
+    DB_CONNECTION_STRING,
+    SQLITE_PATH,
+    DB_POOL_SIZE,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_VALIDATE_AFTER,
+    SERVICE_CATALOG_TTL,
+    SERVICE_CATALOG_STAMP_FILE,
+    SLOT_HOURS,
+    SLOT_INDEX_HORIZON_DAYS,
+    SLOT_INDEX_RECONCILE,
+    PATIENT_CACHE_SIZE,
+    PATIENT_CACHE_TTL,
+    DB_FETCH_BATCH_SIZE,
+)
+
+# --- RECORDS ---
+
+class _Record:
+    """
+    Base for the row objects returned by this module.
+    Values keep their native DB types (date, time, Decimal); formatting
+    happens where they are rendered.
+    """
+    __slots__ = ()
+
+    def _values(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._values() == other._values()
+
+    __hash__ = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Service(_Record):
+    """One row of the Services table."""
+    __slots__ = ("id", "nombre", "duracion", "precio", "description")
+
+    def __init__(self, id, nombre, duracion, precio, description=None):
+        self.id = id
+        self.nombre = nombre
+        self.duracion = duracion
+        self.precio = precio
+        self.description = description
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row.id, row.nombre, row.duracion, row.precio, row.description)
+
+
+class Appointment(_Record):
+    """A patient's appointment, as listed in the management / payment flows."""
+    __slots__ = ("id", "date", "time", "status", "service_name", "patient_name")
+
+    def __init__(self, id, date, time, status, service_name, patient_name):
+        self.id = id
+        self.date = date
+        self.time = time
+        self.status = status
+        self.service_name = service_name
+        self.patient_name = patient_name
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(row.id, row.appointment_date, row.appointment_time, row.status, row.nombre, row.patient_name)
+
+    @property
+    def starts_at(self):
+        return datetime.combine(self.date, self.time)
+
+
+class DailyAppointment(_Record):
+    """An appointment with its price and payment data, as used by the financial reports."""
+    __slots__ = (
+        "id", "patient_name", "patient_id", "service_name", "price", "date", "time",
+        "status", "payment_status", "payment_method", "payment_amount",
+    )
+
+    def __init__(self, id, patient_name, patient_id, service_name, price, date, time,
+                 status, payment_status, payment_method, payment_amount):
+        self.id = id
+        self.patient_name = patient_name
+        self.patient_id = patient_id
+        self.service_name = service_name
+        self.price = price
+        self.date = date
+        self.time = time
+        self.status = status
+        self.payment_status = payment_status
+        self.payment_method = payment_method
+        self.payment_amount = payment_amount
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(
+            row.id, row.patient_name, row.patient_id, row.service_name, row.precio,
+            row.appointment_date, row.appointment_time, row.status,
+            row.payment_status, row.payment_method,
+            row.payment_amount if row.payment_amount else Decimal(0),
+        )
+
+
+class ReportSummary(_Record):
+    """Financial KPIs of a date range, aggregated by the database."""
+    __slots__ = ("appointment_count", "active_count", "total_expected", "total_collected", "active_collected")
+
+    def __init__(self, appointment_count, active_count, total_expected, total_collected, active_collected):
+        self.appointment_count = appointment_count
+        self.active_count = active_count
+        self.total_expected = total_expected
+        self.total_collected = total_collected
+        self.active_collected = active_collected
+
+    @property
+    def cancelled_count(self):
+        return self.appointment_count - self.active_count
+
+    @property
+    def pending_amount(self):
+        # Pending only for active appointments
+        return self.total_expected - self.active_collected
+
+# --- CONNECTION POOL ---
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available within the checkout timeout."""
+
+
+class _PoolEntry:
+    __slots__ = ("conn", "created_at", "last_used", "overrides")
+
+    def __init__(self, conn):
+        now = time.monotonic()
+        self.conn = conn
+        self.created_at = now
+        self.last_used = now
+        self.overrides = {}  # Connection attributes set by the borrower -> original value
+
+
+class PooledConnection:
+    """
+    Thin proxy around a DB-API connection checked out from a ConnectionPool.
+    close() hands the connection back to the pool instead of closing the socket,
+    so existing `conn.close()` calls keep working unchanged.
+    """
+
+    def __init__(self, pool, entry):
+        self._pool = pool
+        self._entry = entry
+
+    def __getattr__(self, name):
+        if self._entry is None:
+            raise RuntimeError("Connection already returned to the pool")
+        return getattr(self._entry.conn, name)
+
+    def __setattr__(self, name, value):
+        # Settings (autocommit, isolation_level...) go to the real connection;
+        # the pool puts the original values back when it is returned
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+            return
+        if self._entry is None:
+            raise RuntimeError("Connection already returned to the pool")
+        self._entry.overrides.setdefault(name, getattr(self._entry.conn, name))
+        setattr(self._entry.conn, name, value)
+
+    def close(self):
+        if self._entry is not None:
+            entry, self._entry = self._entry, None
+            self._pool.release(entry)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ConnectionPool:
+    """
+    Thread-safe, bounded pool of database connections.
+
+    - `size`: maximum number of open connections.
+    - `timeout`: seconds to wait for a free connection before giving up.
+    - `recycle`: connections older than this (seconds) are closed and reopened.
+    - `validate_after`: connections idle longer than this (seconds) are pinged
+      with `SELECT 1` before being handed out.
+    """
+
+    def __init__(self, connect, size=5, timeout=10.0, recycle=1800, validate_after=30):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.recycle = recycle
+        self.validate_after = validate_after
+
+        self._idle = deque()
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            "checkouts": 0,
+            "failures": 0,
+            "timeouts": 0,
+            "created": 0,
+            "recycled": 0,
+            "invalidated": 0,
+            "wait_total": 0.0,
+            "wait_max": 0.0,
+        }
+
+    def acquire(self):
+        start = time.monotonic()
+        deadline = start + self.timeout
+        entry = None
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    # LIFO: reuse the most recently returned (warmest) connection
+                    entry = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"No database connection available after {self.timeout}s")
+                self._cond.wait(remaining)
+
+        if entry is not None:
+            entry = self._check(entry)
+
+        if entry is None:
+            try:
+                entry = _PoolEntry(self._connect())
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._stats["failures"] += 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._stats["created"] += 1
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._stats["checkouts"] += 1
+            self._stats["wait_total"] += waited
+            self._stats["wait_max"] = max(self._stats["wait_max"], waited)
+
+        return PooledConnection(self, entry)
+
+    def _check(self, entry):
+        """Returns the entry if still usable, otherwise closes it and returns None."""
+        now = time.monotonic()
+
+        if self.recycle and now - entry.created_at > self.recycle:
+            self._discard(entry.conn)
+            with self._cond:
+                self._stats["recycled"] += 1
+            return None
+
+        if now - entry.last_used > self.validate_after:
+            try:
+                cursor = entry.conn.cursor()
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+                cursor.close()
+            except Exception:
+                self._discard(entry.conn)
+                with self._cond:
+                    self._stats["invalidated"] += 1
+                return None
+
+        return entry
+
+    def release(self, entry):
+        try:
+            # Never hand out a connection with a half-finished transaction,
+            # or with settings (autocommit...) changed by the last borrower
+            entry.conn.rollback()
+            while entry.overrides:
+                name, value = entry.overrides.popitem()
+                setattr(entry.conn, name, value)
+        except Exception:
+            self._discard(entry.conn)
+            with self._cond:
+                self._open -= 1
+                self._stats["invalidated"] += 1
+                self._cond.notify()
+            return
+
+        entry.last_used = time.monotonic()
+        with self._cond:
+            self._idle.append(entry)
+            self._cond.notify()
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close_all(self):
+        with self._cond:
+            while self._idle:
+                entry = self._idle.pop()
+                self._discard(entry.conn)
+                self._open -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats["size"] = self.size
+            stats["open"] = self._open
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._open - len(self._idle)
+        stats["wait_avg"] = stats["wait_total"] / stats["checkouts"] if stats["checkouts"] else 0.0
+        return stats
+
+
+_backend = get_backend(DB_BACKEND, connection_string=DB_CONNECTION_STRING, sqlite_path=SQLITE_PATH)
+
+_pool = ConnectionPool(
+    _backend.connect,
+    size=DB_POOL_SIZE,
+    timeout=DB_POOL_TIMEOUT,
+    recycle=DB_POOL_RECYCLE,
+    validate_after=DB_POOL_VALIDATE_AFTER,
+)
+
+def get_pool_stats():
+    """Snapshot of connection pool usage (checkouts, wait times, failures...)."""
+    return _pool.stats()
+
+def get_query_metrics():
+    """Per-function query metrics (see db_metrics.py) together with the pool stats."""
+    metrics = db_metrics.snapshot()
+    metrics["pool"] = _pool.stats()
+    return metrics
 
 def get_db_connection():
+    start = time.perf_counter()
     try:
-        conn = pyodbc.connect(DB_CONNECTION_STRING)
-        return conn
+        return _pool.acquire()
     except Exception as e:
         print(f"Database Connection Error: {e}")
+        note_error(e)
         return None
+    finally:
+        note_acquire(time.perf_counter() - start)
 
-def get_services():
+# --- SERVICE CATALOG CACHE ---
+
+@instrumented(name="load_services")
+def _fetch_services():
+    """Loads the full Services table. Returns None if the database is unreachable."""
     conn = get_db_connection()
-    if not conn: return []
-    
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, nombre, duracion, precio, description FROM Services")
-    rows = cursor.fetchall()
-    
-    services = []
-    for row in rows:
-        services.append({
-            "id": row.id,
-            "nombre": row.nombre,
-            "duracion": row.duracion,
-            "precio": float(row.precio),
-            "description": row.description
-        })
+    if not conn: return None
     
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, nombre, duracion, precio, description FROM Services ORDER BY id")
+        services = [Service.from_row(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
     return services
 
+
+class ServiceCatalog:
+    """
+    In-memory copy of the Services table.
+
+    The table is loaded once and served from memory (id lookups are a dict hit).
+    It is reloaded when:
+    - `ttl` seconds have passed since the last load, or
+    - the stamp file changes (another process called invalidate_service_catalog()), or
+    - invalidate() / reload() is called in this process.
+
+    `version` increases every time the loaded content actually changes, so
+    anything derived from the catalog (keyboards, prompts...) can compare it
+    to know when to rebuild.
+    """
+
+    def __init__(self, ttl, stamp_path):
+        self.ttl = ttl
+        self.stamp_path = stamp_path
+        self.version = 0
+        self._services = []
+        self._by_id = {}
+        self._loaded_at = None
+        self._stamp = None
+        self._lock = threading.RLock()
+
+    def _read_stamp(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return True
+        if time.monotonic() - self._loaded_at > self.ttl:
+            return True
+        return self._read_stamp() != self._stamp
+
+    def _ensure_loaded(self):
+        if self._is_stale():
+            with self._lock:
+                if self._is_stale():
+                    self.reload()
+
+    def reload(self):
+        """Reloads from the database. On failure keeps serving the previous data."""
+        with self._lock:
+            # Read the stamp first so an invalidation during the query triggers another reload
+            stamp = self._read_stamp()
+            services = _fetch_services()
+            if services is None:
+                return False
+
+            if services != self._services:
+                self.version += 1
+            self._services = services
+            self._by_id = {s.id: s for s in services}
+            self._loaded_at = time.monotonic()
+            self._stamp = stamp
+            return True
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def all(self):
+        self._ensure_loaded()
+        return list(self._services)
+
+    def get(self, service_id):
+        self._ensure_loaded()
+        return self._by_id.get(service_id)
+
+    def get_many(self, service_ids):
+        self._ensure_loaded()
+        by_id = self._by_id
+        services = []
+        seen = set()
+        for s_id in service_ids:
+            if s_id in seen:
+                continue
+            seen.add(s_id)
+            service = by_id.get(s_id)
+            if service:
+                services.append(service)
+        return services
+
+    def get_version(self):
+        self._ensure_loaded()
+        return self.version
+
+
+_catalog = ServiceCatalog(SERVICE_CATALOG_TTL, SERVICE_CATALOG_STAMP_FILE)
+
+def get_services():
+    return _catalog.all()
+
 def get_service_by_id(service_id):
+    return _catalog.get(service_id)
+
+def get_services_by_ids(service_ids):
+    """
+    Batch lookup for suggestion keyboards.
+    Returns the services in the requested order, skipping unknown and repeated ids.
+    """
+    return _catalog.get_many(service_ids)
+
+def get_catalog_version():
+    """Current catalog version. Changes whenever the Services table content changes."""
+    return _catalog.get_version()
+
+def refresh_service_catalog():
+    """Forces an immediate reload in this process. Returns the new catalog version."""
+    _catalog.reload()
+    return _catalog.version
+
+def invalidate_service_catalog():
+    """
+    Marks the catalog as stale in this process AND in any other running process
+    (e.g. the bot) by touching the shared stamp file.
+    Call this after modifying the Services table from a script.
+    """
+    try:
+        with open(SERVICE_CATALOG_STAMP_FILE, 'w') as f:
+            f.write(str(time.time_ns()))
+    except OSError as e:
+        print(f"Error touching catalog stamp file: {e}")
+    _catalog.invalidate()
+
+# --- SLOT OCCUPANCY INDEX ---
+
+def _date_key(d):
+    """Normalizes a date / datetime / 'YYYY-MM-DD' string to 'YYYY-MM-DD'."""
+    if hasattr(d, 'isoformat'):
+        return d.isoformat()[:10]
+    return str(d)[:10]
+
+def _as_date(d):
+    """'YYYY-MM-DD' -> date, so every backend stores and compares native values."""
+    if isinstance(d, str):
+        return datetime.strptime(d[:10], "%Y-%m-%d").date()
+    return d
+
+def _as_time(t):
+    """'HH:MM' / 'HH:MM:SS' -> time, so every backend stores and compares native values."""
+    if isinstance(t, str):
+        return datetime.strptime(t[:5], "%H:%M").time()
+    return t
+
+def _as_decimal(value):
+    """SUM() results -> Decimal (NULL for an empty range, int/float on SQLite)."""
+    if value is None:
+        return Decimal(0)
+    if isinstance(value, Decimal):
+        return value
+    return Decimal(str(value))
+
+def _time_key(t):
+    """Normalizes a time object / 'HH:MM' / 'HH:MM:SS' string to 'HH:MM'."""
+    if isinstance(t, str):
+        return t[:5]
+    return t.strftime("%H:%M")
+
+
+class SlotIndex:
+    """
+    In-memory occupancy map of confirmed appointments for the bookable horizon
+    (today .. today + horizon_days).
+
+    Each date maps to an int bitmap over SLOT_HOURS: bit i set means the slot
+    starting at SLOT_HOURS[i] is taken. The index is warmed from the DB, kept
+    up to date by the write functions of this module and fully re-synced every
+    `reconcile_interval` seconds to pick up writes from other processes.
+
+    Lookups return None when the index can't answer (date outside the horizon,
+    time outside the slot grid, DB unreachable) so callers fall back to SQL.
+    """
+
+    def __init__(self, slot_hours, horizon_days, reconcile_interval):
+        self.slots = [f"{h:02d}:00" for h in slot_hours]
+        self._bit = {slot: 1 << i for i, slot in enumerate(self.slots)}
+        self.horizon_days = horizon_days
+        self.reconcile_interval = reconcile_interval
+
+        self._days = {}
+        self._first_day = None
+        self._last_day = None
+        self._synced_at = None
+        self._generation = 0  # bumped on every in-place change
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _needs_sync(self):
+        if self._synced_at is None:
+            return True
+        if time.monotonic() - self._synced_at > self.reconcile_interval:
+            return True
+        return datetime.now().date().isoformat() != self._first_day
+
+    @instrumented(name="slot_index_sync")
+    def sync(self):
+        """Rebuilds the index from the database."""
+        with self._sync_lock:
+            today = datetime.now().date()
+            last = today + timedelta(days=self.horizon_days)
+            generation = self._generation
+
+            conn = get_db_connection()
+            if not conn: return False
+            try:
+                cursor = conn.cursor()
+                cursor.execute("""
+                    SELECT appointment_date, appointment_time FROM Appointments
+                    WHERE appointment_date >= ? AND appointment_date <= ? AND status = 'confirmed'
+                """, (today, last))
+                rows = cursor.fetchall()
+            except Exception as e:
+                print(f"Error warming slot index: {e}")
+                note_error(e)
+                return False
+            finally:
+                conn.close()
+
+            days = {}
+            for row in rows:
+                bit = self._bit.get(_time_key(row.appointment_time))
+                if bit:
+                    key = _date_key(row.appointment_date)
+                    days[key] = days.get(key, 0) | bit
+
+            with self._lock:
+                if generation != self._generation:
+                    # A booking changed while we were reading; our snapshot may
+                    # predate it. Keep the live map and retry on the next lookup.
+                    return False
+                self._days = days
+                self._first_day = today.isoformat()
+                self._last_day = last.isoformat()
+                self._synced_at = time.monotonic()
+            return True
+
+    def _bitmap(self, date):
+        if self._needs_sync():
+            self.sync()
+        if self._synced_at is None:
+            return None
+
+        key = _date_key(date)
+        with self._lock:
+            if not (self._first_day <= key <= self._last_day):
+                return None
+            return self._days.get(key, 0)
+
+    def booked_slots(self, date):
+        bitmap = self._bitmap(date)
+        if bitmap is None:
+            return None
+        return [slot for slot in self.slots if bitmap & self._bit[slot]]
+
+    def is_free(self, date, time_):
+        bit = self._bit.get(_time_key(time_))
+        if bit is None:
+            return None
+        bitmap = self._bitmap(date)
+        if bitmap is None:
+            return None
+        return not bitmap & bit
+
+    def mark(self, date, time_, booked=True):
+        bit = self._bit.get(_time_key(time_))
+        if bit is None:
+            return
+        key = _date_key(date)
+        with self._lock:
+            self._generation += 1
+            if booked:
+                self._days[key] = self._days.get(key, 0) | bit
+            else:
+                self._days[key] = self._days.get(key, 0) & ~bit
+
+
+_slot_index = SlotIndex(SLOT_HOURS, SLOT_INDEX_HORIZON_DAYS, SLOT_INDEX_RECONCILE)
+
+# --- PATIENT APPOINTMENT CACHE ---
+
+@instrumented(name="get_appointments_by_patient")
+def _fetch_patient_appointments(patient_id):
+    """Confirmed appointments of a patient. Returns None if the database is unreachable."""
     conn = get_db_connection()
     if not conn: return None
     
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, nombre, duracion, precio, description FROM Services WHERE id = ?", service_id)
-    row = cursor.fetchone()
-    
-    service = None
-    if row:
-        service = {
-            "id": row.id,
-            "nombre": row.nombre,
-            "duracion": row.duracion,
-            "precio": float(row.precio),
-            "description": row.description
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.appointment_date, a.appointment_time, a.status, s.nombre, a.patient_name
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.patient_id = ? AND a.status = 'confirmed'
+            ORDER BY a.appointment_date, a.appointment_time
+        """, (patient_id,))
+
+        appointments = [Appointment.from_row(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    return appointments
+
+
+class PatientAppointmentCache:
+    """
+    Bounded LRU cache of get_appointments_by_patient results, keyed by patient_id.
+
+    - `max_size`: patients kept; the least recently used one is evicted first.
+    - `ttl`: entries older than this (seconds) are re-queried, to pick up writes
+      made by other processes.
+
+    Writes in this module invalidate the affected patient. Writes that only know
+    the appointment id find the patient through the ids of the cached lists: if
+    no cached list holds the appointment, there is nothing to invalidate.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # patient_id -> (loaded_at, appointments)
+        self._owner = {}  # appointment_id -> patient_id, for the cached lists
+        self._generation = 0  # bumped on every invalidation
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
         }
-    
-    conn.close()
-    return service
 
+    def get(self, patient_id):
+        key = str(patient_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                loaded_at, appointments = entry
+                if time.monotonic() - loaded_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return list(appointments)
+                self._drop(key)
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            generation = self._generation
+
+        appointments = _fetch_patient_appointments(key)
+        if appointments is None:
+            return []
+
+        with self._lock:
+            # Don't store a result that may predate a write made while we were querying
+            if generation == self._generation:
+                self._drop(key)
+                self._entries[key] = (time.monotonic(), appointments)
+                for app in appointments:
+                    self._owner[app.id] = key
+                while len(self._entries) > self.max_size:
+                    self._drop(next(iter(self._entries)))
+                    self._stats["evictions"] += 1
+        return list(appointments)
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            for app in entry[1]:
+                self._owner.pop(app.id, None)
+
+    def invalidate_patient(self, patient_id):
+        with self._lock:
+            self._generation += 1
+            if str(patient_id) in self._entries:
+                self._drop(str(patient_id))
+                self._stats["invalidations"] += 1
+
+    def invalidate_appointment(self, appointment_id):
+        with self._lock:
+            self._generation += 1
+            key = self._owner.get(appointment_id)
+            if key is not None:
+                self._drop(key)
+                self._stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._owner.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_size"] = self.max_size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+_patient_cache = PatientAppointmentCache(PATIENT_CACHE_SIZE, PATIENT_CACHE_TTL)
+
+def get_patient_cache_stats():
+    """Snapshot of the per-patient appointment cache (hits, misses, evictions...)."""
+    return _patient_cache.stats()
+
+# --- BOOKING ---
+
+class SlotTaken:
+    """
+    Returned by create_appointment / update_appointment when the requested slot
+    is already held by another confirmed appointment.
+
+    It is falsy, so `if result:` checks keep treating it as a failed write.
+    `booked_slots` holds the day's current occupancy so the time keyboard can be
+    re-rendered without another query.
+    """
+    __slots__ = ("date", "time", "booked_slots")
+
+    def __init__(self, date, time, booked_slots):
+        self.date = date
+        self.time = time
+        self.booked_slots = booked_slots
+
+    def __bool__(self):
+        return False
+
+    def __repr__(self):
+        return f"SlotTaken({self.date!r}, {self.time!r})"
+
+def _slot_taken(date, time):
+    # Our index missed this booking (made elsewhere or still in flight): record it
+    _slot_index.mark(date, time)
+    booked_slots = _slot_index.booked_slots(date)
+    if booked_slots is None:
+        booked_slots = get_booked_slots(date)
+    return SlotTaken(date, time, booked_slots)
+
+@instrumented
 def create_appointment(patient_name, patient_id, patient_phone, service_id, date, time):
+    """
+    Books the slot only if it is still free: the check and the insert are a single
+    statement, backed by the filtered unique index on confirmed (date, time).
+    Returns the new appointment id, SlotTaken if the slot is already booked, or None on error.
+    """
     conn = get_db_connection()
     if not conn: return None
     
     appointment_id = str(uuid.uuid4())
     
     try:
+        db_date, db_time = _as_date(date), _as_time(time)
         cursor = conn.cursor()
-        cursor.execute("""
+        cursor.execute(f"""
             INSERT INTO Appointments (id, patient_name, patient_id, patient_phone, service_id, appointment_date, appointment_time, status, payment_status, payment_amount)
-            VALUES (?, ?, ?, ?, ?, ?, ?, 'confirmed', 'pending', 0)
-        """, (appointment_id, patient_name, patient_id, patient_phone, service_id, date, time))
+            SELECT ?, ?, ?, ?, ?, ?, ?, 'confirmed', 'pending', 0
+            WHERE NOT EXISTS (
+                SELECT 1 FROM Appointments {_backend.lock_hint}
+                WHERE appointment_date = ? AND appointment_time = ? AND status = 'confirmed'
+            )
+        """, (appointment_id, patient_name, patient_id, patient_phone, service_id, db_date, db_time, db_date, db_time))
+        inserted = cursor.rowcount == 1
         conn.commit()
-        return appointment_id
     except Exception as e:
-        print(f"Error creating appointment: {e}")
-        return None
+        if not _backend.is_slot_conflict(e):
+            print(f"Error creating appointment: {e}")
+            note_error(e)
+            return None
+        inserted = False
     finally:
         conn.close()
 
+    if not inserted:
+        return _slot_taken(date, time)
+
+    _slot_index.mark(date, time)
+    _patient_cache.invalidate_patient(patient_id)
+    return appointment_id
+
 def get_appointments_by_patient(patient_id):
-    conn = get_db_connection()
-    if not conn: return []
-    
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.id, a.appointment_date, a.appointment_time, a.status, s.nombre, a.patient_name
-        FROM Appointments a
-        JOIN Services s ON a.service_id = s.id
-        WHERE a.patient_id = ? AND a.status = 'confirmed'
-        ORDER BY a.appointment_date, a.appointment_time
-    """, patient_id)
-    
-    rows = cursor.fetchall()
-    appointments = []
-    for row in rows:
-        appointments.append({
-            "id": row.id,
-            "date": str(row.appointment_date),
-            "time": str(row.appointment_time),
-            "status": row.status,
-            "service_name": row.nombre,
-            "patient_name": row.patient_name
-        })
-        
-    conn.close()
-    return appointments
+    """Confirmed appointments of a patient, served from the per-patient cache when fresh."""
+    return _patient_cache.get(patient_id)
 
+@instrumented
 def get_appointment_by_id(appointment_id):
     conn = get_db_connection()
     if not conn: return None
     
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.id, a.appointment_date, a.appointment_time, a.status, s.nombre, a.patient_name
-        FROM Appointments a
-        JOIN Services s ON a.service_id = s.id
-        WHERE a.id = ?
-    """, appointment_id)
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.appointment_date, a.appointment_time, a.status, s.nombre, a.patient_name
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.id = ?
+        """, (appointment_id,))
+
+        row = cursor.fetchone()
+        appointment = Appointment.from_row(row) if row else None
+    finally:
+        conn.close()
+
+    return appointment
+
+@instrumented
+def get_appointment_by_payment_proof(payment_proof):
+    """Paid appointment whose payment was registered with this proof (see invoice_cache.proof_id), or None."""
+    conn = get_db_connection()
+    if not conn: return None
     
-    row = cursor.fetchone()
-    appointment = None
-    if row:
-        appointment = {
-            "id": row.id,
-            "date": str(row.appointment_date),
-            "time": str(row.appointment_time),
-            "status": row.status,
-            "service_name": row.nombre,
-            "patient_name": row.patient_name
-        }
-        
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.appointment_date, a.appointment_time, a.status, s.nombre, a.patient_name
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.payment_proof = ? AND a.payment_status = 'paid'
+        """, (payment_proof,))
+
+        row = cursor.fetchone()
+        appointment = Appointment.from_row(row) if row else None
+    except Exception as e:
+        print(f"Error looking up payment proof: {e}")
+        note_error(e)
+        appointment = None
+    finally:
+        conn.close()
+
     return appointment
 
+@instrumented
 def cancel_appointment(appointment_id):
     conn = get_db_connection()
     if not conn: return False
     
     try:
         cursor = conn.cursor()
-        cursor.execute("UPDATE Appointments SET status = 'cancelled' WHERE id = ?", appointment_id)
+        cursor.execute("SELECT appointment_date, appointment_time, status FROM Appointments WHERE id = ?", (appointment_id,))
+        old = cursor.fetchone()
+        cursor.execute("UPDATE Appointments SET status = 'cancelled' WHERE id = ?", (appointment_id,))
         conn.commit()
+        if old and old.status == 'confirmed':
+            _slot_index.mark(old.appointment_date, old.appointment_time, booked=False)
+        _patient_cache.invalidate_appointment(appointment_id)
         return True
     except Exception as e:
         print(f"Error cancelling appointment: {e}")
+        note_error(e)
         return False
     finally:
         conn.close()
 
+@instrumented
 def check_availability(date, time):
+    free = _slot_index.is_free(date, time)
+    if free is not None:
+        return free
+    
     conn = get_db_connection()
     if not conn: return False
     
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT COUNT(*) FROM Appointments 
-        WHERE appointment_date = ? AND appointment_time = ? AND status = 'confirmed'
-    """, (date, time))
-    
-    count = cursor.fetchone()[0]
-    conn.close()
-    
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COUNT(*) FROM Appointments 
+            WHERE appointment_date = ? AND appointment_time = ? AND status = 'confirmed'
+        """, (_as_date(date), _as_time(time)))
+
+        count = cursor.fetchone()[0]
+    finally:
+        conn.close()
+
     return count == 0
 
+@instrumented
 def get_booked_slots(date):
+    booked_slots = _slot_index.booked_slots(date)
+    if booked_slots is not None:
+        return booked_slots
+    
     conn = get_db_connection()
     if not conn: return []
     
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT appointment_time FROM Appointments 
-        WHERE appointment_date = ? AND status = 'confirmed'
-    """, date)
-    
-    rows = cursor.fetchall()
-    booked_slots = []
-    for row in rows:
-        # row.appointment_time is likely a datetime.time object or string
-        t = row.appointment_time
-        if isinstance(t, str):
-            # Handle string "HH:MM:SS"
-            try:
-                t_obj = datetime.strptime(t, "%H:%M:%S").time()
-                booked_slots.append(t_obj.strftime("%H:%M"))
-            except ValueError:
-                # Fallback if format is different
-                booked_slots.append(t[:5])
-        else:
-            # Handle datetime.time object
-            booked_slots.append(t.strftime("%H:%M"))
-            
-    conn.close()
-    return booked_slots
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT appointment_time FROM Appointments 
+            WHERE appointment_date = ? AND status = 'confirmed'
+        """, (_as_date(date),))
+        rows = cursor.fetchall()
+    finally:
+        conn.close()
 
+    # row.appointment_time may be a datetime.time object or an "HH:MM:SS" string
+    return [_time_key(row.appointment_time) for row in rows]
+
+@instrumented
 def update_appointment(appointment_id, new_date, new_time):
+    """
+    Moves an appointment to a new slot only if that slot is free (single conditional UPDATE).
+    Returns True, SlotTaken if the new slot is already booked, or False on error.
+    """
     conn = get_db_connection()
     if not conn: return False
     
     try:
         cursor = conn.cursor()
-        cursor.execute("""
+        cursor.execute("SELECT appointment_date, appointment_time, status FROM Appointments WHERE id = ?", (appointment_id,))
+        old = cursor.fetchone()
+        if not old:
+            return False
+        
+        db_date, db_time = _as_date(new_date), _as_time(new_time)
+        cursor.execute(f"""
             UPDATE Appointments 
             SET appointment_date = ?, appointment_time = ? 
-            WHERE id = ?
-        """, (new_date, new_time, appointment_id))
+            WHERE id = ? AND NOT EXISTS (
+                SELECT 1 FROM Appointments {_backend.lock_hint}
+                WHERE appointment_date = ? AND appointment_time = ? AND status = 'confirmed' AND id <> ?
+            )
+        """, (db_date, db_time, appointment_id, db_date, db_time, appointment_id))
+        updated = cursor.rowcount == 1
         conn.commit()
-        return True
     except Exception as e:
-        print(f"Error updating appointment: {e}")
-        return False
+        if not _backend.is_slot_conflict(e):
+            print(f"Error updating appointment: {e}")
+            note_error(e)
+            return False
+        updated = False
     finally:
         conn.close()
 
+    if not updated:
+        return _slot_taken(new_date, new_time)
+
+    if old.status == 'confirmed':
+        _slot_index.mark(old.appointment_date, old.appointment_time, booked=False)
+        _slot_index.mark(new_date, new_time)
+    _patient_cache.invalidate_appointment(appointment_id)
+    return True
+
+@instrumented
 def update_payment_status(appointment_id, status, method, proof_path, amount):
     conn = get_db_connection()
     if not conn: return False
@@ -219,74 +1048,144 @@ def update_payment_status(appointment_id, status, method, proof_path, amount):
             WHERE id = ?
         """, (status, method, proof_path, amount, appointment_id))
         conn.commit()
+        _patient_cache.invalidate_appointment(appointment_id)
         return True
     except Exception as e:
         print(f"Error updating payment: {e}")
+        note_error(e)
         return False
     finally:
         conn.close()
 
+@instrumented
 def get_daily_appointments(date):
     conn = get_db_connection()
     if not conn: return []
     
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.id, a.patient_name, a.patient_id, s.nombre as service_name, s.precio, a.appointment_time, a.status, a.payment_status, a.payment_method, a.payment_amount
-        FROM Appointments a
-        JOIN Services s ON a.service_id = s.id
-        WHERE a.appointment_date = ?
-        ORDER BY a.appointment_time ASC
-    """, (date,))
-    
-    rows = cursor.fetchall()
-    appointments = []
-    for row in rows:
-        appointments.append({
-            "id": row.id,
-            "patient_name": row.patient_name,
-            "patient_id": row.patient_id,
-            "service_name": row.service_name,
-            "price": float(row.precio),
-            "time": str(row.appointment_time),
-            "status": row.status,
-            "payment_status": row.payment_status,
-            "payment_method": row.payment_method,
-            "payment_amount": float(row.payment_amount) if row.payment_amount else 0.0
-        })
-        
-    conn.close()
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.patient_name, a.patient_id, s.nombre as service_name, s.precio, a.appointment_date, a.appointment_time, a.status, a.payment_status, a.payment_method, a.payment_amount
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.appointment_date = ?
+            ORDER BY a.appointment_time ASC
+        """, (_as_date(date),))
+
+        appointments = [DailyAppointment.from_row(row) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
     return appointments
 
 def get_appointments_by_range(start_date, end_date):
+    return list(iter_appointments_by_range(start_date, end_date))
+
+@instrumented
+def iter_appointments_by_range(start_date, end_date, batch_size=DB_FETCH_BATCH_SIZE):
+    """
+    Generator version of get_appointments_by_range for large reporting windows.
+    Pages through the cursor with fetchmany, so only `batch_size` rows are held in memory.
+    The pooled connection stays checked out until the generator is exhausted or closed.
+    """
+    conn = get_db_connection()
+    if not conn: return
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT a.id, a.patient_name, a.patient_id, s.nombre as service_name, s.precio, a.appointment_date, a.appointment_time, a.status, a.payment_status, a.payment_method, a.payment_amount
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.appointment_date >= ? AND a.appointment_date <= ?
+            ORDER BY a.appointment_date ASC, a.appointment_time ASC
+        """, (_as_date(start_date), _as_date(end_date)))
+
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield DailyAppointment.from_row(row)
+    finally:
+        conn.close()
+
+# --- REPORT AGGREGATES ---
+# Computed by the database so report cost doesn't grow with the number of rows.
+
+@instrumented
+def get_report_summary(start_date, end_date):
+    """Counts and money totals for the range. Returns None if the database is unreachable."""
+    conn = get_db_connection()
+    if not conn: return None
+    
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT
+                COUNT(*) AS appointment_count,
+                SUM(CASE WHEN a.status <> 'cancelled' THEN 1 ELSE 0 END) AS active_count,
+                SUM(CASE WHEN a.status <> 'cancelled' THEN s.precio ELSE 0 END) AS total_expected,
+                SUM(COALESCE(a.payment_amount, 0)) AS total_collected,
+                SUM(CASE WHEN a.status <> 'cancelled' THEN COALESCE(a.payment_amount, 0) ELSE 0 END) AS active_collected
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.appointment_date >= ? AND a.appointment_date <= ?
+        """, (_as_date(start_date), _as_date(end_date)))
+
+        row = cursor.fetchone()
+    finally:
+        conn.close()
+
+    return ReportSummary(
+        row.appointment_count,
+        row.active_count or 0,
+        _as_decimal(row.total_expected),
+        _as_decimal(row.total_collected),
+        _as_decimal(row.active_collected),
+    )
+
+@instrumented
+def get_payment_method_totals(start_date, end_date):
+    """[(method, amount)] of the money collected in the range, all appointments included (audit trail)."""
     conn = get_db_connection()
     if not conn: return []
     
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT a.id, a.patient_name, a.patient_id, s.nombre as service_name, s.precio, a.appointment_date, a.appointment_time, a.status, a.payment_status, a.payment_method, a.payment_amount
-        FROM Appointments a
-        JOIN Services s ON a.service_id = s.id
-        WHERE a.appointment_date >= ? AND a.appointment_date <= ?
-        ORDER BY a.appointment_date ASC, a.appointment_time ASC
-    """, (start_date, end_date))
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT COALESCE(a.payment_method, 'Pendiente') AS method, SUM(a.payment_amount) AS amount
+            FROM Appointments a
+            WHERE a.appointment_date >= ? AND a.appointment_date <= ? AND a.payment_amount > 0
+            GROUP BY COALESCE(a.payment_method, 'Pendiente')
+            ORDER BY amount DESC
+        """, (_as_date(start_date), _as_date(end_date)))
+
+        totals = [(row.method, _as_decimal(row.amount)) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    return totals
+
+@instrumented
+def get_service_counts(start_date, end_date):
+    """[(service_name, count)] of active (not cancelled) appointments in the range."""
+    conn = get_db_connection()
+    if not conn: return []
     
-    rows = cursor.fetchall()
-    appointments = []
-    for row in rows:
-        appointments.append({
-            "id": row.id,
-            "patient_name": row.patient_name,
-            "patient_id": row.patient_id,
-            "service_name": row.service_name,
-            "price": float(row.precio),
-            "date": str(row.appointment_date),
-            "time": str(row.appointment_time),
-            "status": row.status,
-            "payment_status": row.payment_status,
-            "payment_method": row.payment_method,
-            "payment_amount": float(row.payment_amount) if row.payment_amount else 0.0
-        })
-        
-    conn.close()
-    return appointments
+    try:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT s.nombre AS service_name, COUNT(*) AS total
+            FROM Appointments a
+            JOIN Services s ON a.service_id = s.id
+            WHERE a.appointment_date >= ? AND a.appointment_date <= ? AND a.status <> 'cancelled'
+            GROUP BY s.nombre
+            ORDER BY total DESC
+        """, (_as_date(start_date), _as_date(end_date)))
+
+        counts = [(row.service_name, row.total) for row in cursor.fetchall()]
+    finally:
+        conn.close()
+
+    return counts
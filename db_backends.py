@@ -0,0 +1,114 @@
+"""
+Storage backends for database.py.
+
+All queries in database.py are plain parameterized SQL ('?' placeholders) that
+run unchanged on both engines. A backend only supplies what really differs:
+how to open a connection, the row-locking hint used by the conditional booking
+writes, and how to recognise a double-booking error.
+
+- SqlServerBackend: the production setup (pyodbc + ODBC Driver 17).
+- SqliteBackend: embedded single-file database in WAL mode with the same schema
+  and indexes (schema_sqlite.sql). Useful for single-node deployments, local
+  development and load tests without a SQL Server instance.
+
+Select one with DB_BACKEND=sqlserver|sqlite in the environment.
+"""
+import collections
+import os
+import sqlite3
+import threading
+from datetime import date, time
+from decimal import Decimal
+
+SLOT_UNIQUE_INDEX = "UX_Appointments_ConfirmedSlot"
+
+
+class SqlServerBackend:
+    name = "sqlserver"
+    # Keeps the NOT EXISTS check and the write in one serializable step
+    lock_hint = "WITH (UPDLOCK, HOLDLOCK)"
+
+    def __init__(self, connection_string):
+        self.connection_string = connection_string
+
+    def connect(self):
+        import pyodbc  # only needed when SQL Server is actually used
+        return pyodbc.connect(self.connection_string)
+
+    def is_slot_conflict(self, error):
+        return SLOT_UNIQUE_INDEX in str(error)
+
+
+# --- SQLite ---
+
+# Store dates/times as ISO text ('YYYY-MM-DD' / 'HH:MM:SS') and read them back
+# as native objects, like pyodbc does with SQL Server DATE / TIME / DECIMAL.
+sqlite3.register_adapter(date, lambda d: d.isoformat())
+sqlite3.register_adapter(time, lambda t: t.strftime("%H:%M:%S"))
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_converter("DATE", lambda b: date.fromisoformat(b.decode()))
+sqlite3.register_converter("TIME", lambda b: time.fromisoformat(b.decode()))
+sqlite3.register_converter("DECIMAL", lambda b: Decimal(b.decode()))
+
+_row_classes = {}
+
+def _row_factory(cursor, row):
+    """Rows with attribute access (row.id) and index access (row[0]), like pyodbc.Row."""
+    fields = tuple(col[0] for col in cursor.description)
+    cls = _row_classes.get(fields)
+    if cls is None:
+        cls = _row_classes[fields] = collections.namedtuple("Row", fields, rename=True)
+    return cls(*row)
+
+
+class SqliteBackend:
+    name = "sqlite"
+    # SQLite serializes writers; the partial unique index does the rest
+    lock_hint = ""
+
+    SCHEMA_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "schema_sqlite.sql")
+
+    def __init__(self, path, busy_timeout=5.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            # Pooled connections move between executor threads (one user at a time)
+            check_same_thread=False,
+        )
+        conn.row_factory = _row_factory
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        self._ensure_schema(conn)
+        return conn
+
+    def _ensure_schema(self, conn):
+        if self._schema_ready:
+            return
+        with self._schema_lock:
+            if self._schema_ready:
+                return
+            with open(self.SCHEMA_FILE, 'r', encoding='utf-8') as f:
+                conn.executescript(f.read())
+            conn.commit()
+            self._schema_ready = True
+
+    def is_slot_conflict(self, error):
+        # sqlite3 reports: UNIQUE constraint failed: Appointments.appointment_date, Appointments.appointment_time
+        message = str(error)
+        return isinstance(error, sqlite3.IntegrityError) and "UNIQUE" in message and "appointment_date" in message
+
+
+def get_backend(name, connection_string=None, sqlite_path=None):
+    if name == "sqlserver":
+        return SqlServerBackend(connection_string)
+    if name == "sqlite":
+        return SqliteBackend(sqlite_path)
+    raise ValueError(f"Unknown DB_BACKEND '{name}' (expected 'sqlserver' or 'sqlite')")
@@ -0,0 +1,271 @@
+"""
+Query instrumentation for database.py.
+
+Every query function decorated with @instrumented records, per function:
+call count, errors, rows returned, latency histogram (p50/p95/p99) and the
+time spent waiting for a pooled connection. Calls slower than
+SLOW_QUERY_THRESHOLD_MS are appended to SLOW_QUERY_LOG as one JSON object per
+line. Arguments are not logged (they carry patient data).
+
+snapshot() returns the current numbers, for the /metricas admin command or a
+metrics endpoint.
+"""
+import functools
+import inspect
+import json
+import threading
+import time
+from datetime import datetime
+
+from config import SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_LOG
+
+# Upper bounds (ms) of the latency buckets; the last bucket is open-ended
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Fixed-bucket latency histogram; percentiles are interpolated inside the bucket."""
+    __slots__ = ("counts", "total", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, ms):
+        i = 0
+        while i < len(BUCKETS_MS) and ms > BUCKETS_MS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.total += ms
+        self.count += 1
+        self.max = max(self.max, ms)
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lower = BUCKETS_MS[i - 1] if i else 0
+                upper = BUCKETS_MS[i] if i < len(BUCKETS_MS) else self.max
+                estimate = lower + (upper - lower) * (rank - seen) / n
+                return min(estimate, self.max)
+            seen += n
+        return self.max
+
+    def buckets(self):
+        labels = [f"<={b}ms" for b in BUCKETS_MS] + [f">{BUCKETS_MS[-1]}ms"]
+        return {label: n for label, n in zip(labels, self.counts) if n}
+
+
+class _FunctionStats:
+    __slots__ = ("calls", "errors", "rows", "latency", "acquire_total", "slow")
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self.latency = LatencyHistogram()
+        self.acquire_total = 0.0
+        self.slow = 0
+
+
+class _Call:
+    """Measurements of one in-flight call (filled by note_acquire / note_error)."""
+    __slots__ = ("name", "elapsed", "acquire", "rows", "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.elapsed = 0.0
+        self.acquire = 0.0
+        self.rows = None
+        self.error = None
+
+
+class QueryMetrics:
+    def __init__(self, slow_threshold_ms, slow_log_path):
+        self.slow_threshold_ms = slow_threshold_ms
+        self.slow_log_path = slow_log_path
+        self.started_at = time.time()
+        self._functions = {}
+        self._lock = threading.Lock()
+        self._log_lock = threading.Lock()
+        self._local = threading.local()
+
+    # --- Current call (thread-local) ---
+
+    def _push(self, call):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(call)
+
+    def _pop(self):
+        self._local.stack.pop()
+
+    def current(self):
+        stack = getattr(self._local, "stack", None)
+        return stack[-1] if stack else None
+
+    def note_acquire(self, seconds):
+        call = self.current()
+        if call is not None:
+            call.acquire += seconds
+
+    def note_error(self, error):
+        call = self.current()
+        if call is not None:
+            call.error = f"{type(error).__name__}: {error}"
+
+    # --- Recording ---
+
+    def record(self, call):
+        ms = call.elapsed * 1000
+        slow = self.slow_threshold_ms and ms >= self.slow_threshold_ms
+        with self._lock:
+            stats = self._functions.get(call.name)
+            if stats is None:
+                stats = self._functions[call.name] = _FunctionStats()
+            stats.calls += 1
+            stats.latency.add(ms)
+            stats.acquire_total += call.acquire
+            if call.rows:
+                stats.rows += call.rows
+            if call.error:
+                stats.errors += 1
+            if slow:
+                stats.slow += 1
+        if slow:
+            self._log_slow(call, ms)
+
+    def _log_slow(self, call, ms):
+        entry = {
+            "ts": datetime.now().isoformat(timespec="milliseconds"),
+            "function": call.name,
+            "duration_ms": round(ms, 1),
+            "acquire_ms": round(call.acquire * 1000, 1),
+            "rows": call.rows,
+            "error": call.error,
+            "thread": threading.current_thread().name,
+        }
+        try:
+            with self._log_lock, open(self.slow_log_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        except OSError as e:
+            print(f"Error writing slow query log: {e}")
+
+    def snapshot(self):
+        """{function: {calls, errors, rows, avg/p50/p95/p99/max ms, acquire_avg_ms, slow, histogram}}"""
+        with self._lock:
+            functions = {}
+            for name, stats in self._functions.items():
+                latency = stats.latency
+                functions[name] = {
+                    "calls": stats.calls,
+                    "errors": stats.errors,
+                    "rows": stats.rows,
+                    "slow": stats.slow,
+                    "total_ms": round(latency.total, 1),
+                    "avg_ms": round(latency.total / latency.count, 2) if latency.count else 0.0,
+                    "p50_ms": round(latency.percentile(50), 2),
+                    "p95_ms": round(latency.percentile(95), 2),
+                    "p99_ms": round(latency.percentile(99), 2),
+                    "max_ms": round(latency.max, 2),
+                    "acquire_avg_ms": round(stats.acquire_total * 1000 / stats.calls, 2) if stats.calls else 0.0,
+                    "histogram": latency.buckets(),
+                }
+        return {
+            "since": datetime.fromtimestamp(self.started_at).isoformat(timespec="seconds"),
+            "slow_threshold_ms": self.slow_threshold_ms,
+            "functions": functions,
+        }
+
+    def reset(self):
+        with self._lock:
+            self._functions.clear()
+            self.started_at = time.time()
+
+
+def _count_rows(result):
+    if result is None:
+        return 0
+    if isinstance(result, (list, tuple)):
+        return len(result)
+    if isinstance(result, (bool, int, float, str)):
+        return None  # status / id, not rows
+    return 1
+
+
+_metrics = QueryMetrics(SLOW_QUERY_THRESHOLD_MS, SLOW_QUERY_LOG)
+
+def instrumented(func=None, *, name=None):
+    """
+    Records metrics for every call of the decorated query function.
+    Generator functions are timed while they produce rows (not while the caller
+    consumes them) and report the number of rows yielded.
+    """
+    if func is None:
+        return functools.partial(instrumented, name=name)
+    label = name or func.__name__
+
+    if inspect.isgeneratorfunction(func):
+        @functools.wraps(func)
+        def gen_wrapper(*args, **kwargs):
+            call = _Call(label)
+            call.rows = 0
+            gen = func(*args, **kwargs)
+            try:
+                while True:
+                    _metrics._push(call)
+                    start = time.perf_counter()
+                    try:
+                        row = next(gen)
+                    except StopIteration:
+                        break
+                    finally:
+                        call.elapsed += time.perf_counter() - start
+                        _metrics._pop()
+                    call.rows += 1
+                    yield row
+            except Exception as e:
+                call.error = call.error or f"{type(e).__name__}: {e}"
+                raise
+            finally:
+                gen.close()
+                _metrics.record(call)
+        return gen_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        call = _Call(label)
+        _metrics._push(call)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            call.rows = _count_rows(result)
+            return result
+        except Exception as e:
+            call.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            call.elapsed = time.perf_counter() - start
+            _metrics._pop()
+            _metrics.record(call)
+    return wrapper
+
+def note_acquire(seconds):
+    """Adds connection-checkout time to the call in progress on this thread."""
+    _metrics.note_acquire(seconds)
+
+def note_error(error):
+    """Marks the call in progress on this thread as failed (for errors handled inside it)."""
+    _metrics.note_error(error)
+
+def snapshot():
+    return _metrics.snapshot()
+
+def reset():
+    _metrics.reset()
@@ -0,0 +1,105 @@
+"""
+Offline evaluation of the local fast-path intent classifier (intent_classifier.py).
+
+Reads a labelled corpus (expected Gemini intent <TAB> message, '#' comments
+allowed) and reports:
+- precision: share of the locally answered messages whose intent is correct
+- avoided:   share of all messages answered locally (Gemini calls saved)
+- per-intent breakdown and every wrong local answer
+
+By default it runs on intent_eval_corpus.tsv (written alongside the phrase
+list, so it flatters the classifier) and on intent_eval_holdout.tsv (written
+afterwards, negations included); quote the held-out figures. With --strict
+the exit status is 1 if any message gets a wrong local answer, so it can run
+as a regression check.
+
+Usage:
+    python evaluate_intent_classifier.py
+    python evaluate_intent_classifier.py --strict
+    python evaluate_intent_classifier.py --corpus my_corpus.tsv --min-confidence 0.7
+"""
+import argparse
+import os
+import sys
+
+import intent_classifier
+from config import FAST_PATH_MIN_CONFIDENCE
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CORPORA = [
+    os.path.join(BASE_DIR, "intent_eval_corpus.tsv"),
+    os.path.join(BASE_DIR, "intent_eval_holdout.tsv"),
+]
+
+def load_corpus(path):
+    samples = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            expected, message = line.split("\t", 1)
+            samples.append((expected, message))
+    return samples
+
+def evaluate(samples, min_confidence):
+    answered = 0
+    correct = 0
+    by_intent = {}
+    mistakes = []
+
+    for expected, message in samples:
+        row = by_intent.setdefault(expected, {"total": 0, "answered": 0, "correct": 0})
+        row["total"] += 1
+
+        response = intent_classifier.classify(message, min_confidence=min_confidence)
+        if response is None:
+            continue
+        answered += 1
+        row["answered"] += 1
+        if response["intent"] == expected:
+            correct += 1
+            row["correct"] += 1
+        else:
+            mistakes.append((message, expected, response["intent"]))
+
+    return answered, correct, by_intent, mistakes
+
+def report(path, samples, min_confidence):
+    """Prints the evaluation of one corpus; returns the number of wrong local answers."""
+    answered, correct, by_intent, mistakes = evaluate(samples, min_confidence)
+
+    precision = correct / answered if answered else 0.0
+    avoided = answered / len(samples) if samples else 0.0
+    print(f"Corpus: {os.path.basename(path)}, {len(samples)} messages, threshold {min_confidence}\n")
+    print(f"Precision: {precision:6.1%} ({correct}/{answered} local answers correct)")
+    print(f"Avoided:   {avoided:6.1%} ({answered}/{len(samples)} Gemini calls)\n")
+
+    print(f"{'intent':<20} {'total':>6} {'local':>6} {'correct':>8}")
+    for intent, row in sorted(by_intent.items()):
+        print(f"{intent:<20} {row['total']:>6} {row['answered']:>6} {row['correct']:>8}")
+
+    if mistakes:
+        print("\nWrong local answers:")
+        for message, expected, got in mistakes:
+            print(f"  {message!r}: expected {expected}, got {got}")
+    return len(mistakes)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", action="append", help="TSV file: intent<TAB>message (repeatable; default: the bundled corpora)")
+    parser.add_argument("--min-confidence", type=float, default=FAST_PATH_MIN_CONFIDENCE, help="Fast-path confidence threshold")
+    parser.add_argument("--strict", action="store_true", help="Exit with status 1 on any wrong local answer")
+    args = parser.parse_args()
+
+    wrong = 0
+    for i, path in enumerate(args.corpus or DEFAULT_CORPORA):
+        if i:
+            print("\n" + "-" * 40 + "\n")
+        wrong += report(path, load_corpus(path), args.min_confidence)
+
+    if args.strict and wrong:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -48,6 +48,14 @@ def reset_db():
         """)
         conn.commit()
         
+        print("Creating slot unique index...")
+        cursor.execute("""
+            CREATE UNIQUE INDEX UX_Appointments_ConfirmedSlot
+            ON Appointments (appointment_date, appointment_time)
+            WHERE status = 'confirmed'
+        """)
+        conn.commit()
+        
         print("Seeding Services...")
         services_data = [
             (1, 'Consulta', 60, 65000, 'Evaluación completa inicial para diagnóstico fisioterapéutico.'),
@@ -71,6 +79,7 @@ def reset_db():
         
         cursor.executemany("INSERT INTO Services (id, nombre, duracion, precio, description) VALUES (?, ?, ?, ?, ?)", services_data)
         conn.commit()
+        database.invalidate_service_catalog()
         
         print("Database reset successfully.")
         
@@ -1,4 +1,5 @@
 import pyodbc
+import database
 from config import DB_CONNECTION_STRING
 
 def force_update():
@@ -10,6 +11,10 @@ def force_update():
         conn.commit()
         print("Update committed.")
         
+        # Make the running bot reload its service catalog
+        database.invalidate_service_catalog()
+        print("Service catalog invalidated.")
+        
         # Verify
         cursor.execute("SELECT id, nombre FROM Services WHERE id = 1")
         row = cursor.fetchone()
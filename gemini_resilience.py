@@ -0,0 +1,245 @@
+"""
+Retry, circuit breaker and hedging for the Gemini calls in gemini_service.py.
+
+- Retries: transient failures (429, 5xx, connection errors, a request past
+  GEMINI_ATTEMPT_TIMEOUT) are retried up to GEMINI_RETRY_ATTEMPTS times with
+  exponential backoff and full jitter. Other errors (bad request, invalid
+  key...) fail straight away.
+- Circuit breaker: after GEMINI_BREAKER_THRESHOLD consecutive transient
+  failures the breaker opens and calls fail fast with CircuitOpenError for
+  GEMINI_BREAKER_COOLDOWN seconds, so the bot can answer with a local menu
+  instead of making every user wait for a timeout. After the cooldown one
+  probe call goes through; its result closes or re-opens the breaker.
+- Hedging (GEMINI_HEDGE_ENABLED, async only): if a call is still pending after
+  the recent p95 latency, a second identical request is sent and the first
+  answer wins. It costs an extra call on the slowest ~5%, so it is off by
+  default.
+
+stats() returns the breaker state and the retry / hedge counters for /metricas.
+"""
+import asyncio
+import random
+import threading
+import time
+from collections import deque
+
+from google.genai import errors
+
+from config import (
+    GEMINI_RETRY_ATTEMPTS, GEMINI_RETRY_BASE_DELAY, GEMINI_RETRY_MAX_DELAY,
+    GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN,
+    GEMINI_HEDGE_ENABLED, GEMINI_HEDGE_MIN_DELAY,
+)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Latency samples kept for the hedge delay, and how many are needed before hedging
+LATENCY_WINDOW = 200
+HEDGE_MIN_SAMPLES = 20
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling Gemini while the breaker is open."""
+
+
+def is_retryable(error):
+    if isinstance(error, errors.APIError):
+        return error.code in RETRYABLE_STATUS
+    return isinstance(error, (ConnectionError, TimeoutError, asyncio.TimeoutError)) or \
+        type(error).__module__.startswith("httpx")  # Transport errors of the SDK's HTTP client
+
+def backoff_delay(attempt):
+    """Full jitter: uniform in [0, min(max, base * 2^attempt)]."""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_DELAY, GEMINI_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+        self._stats = {
+            "opened": 0,
+            "short_circuited": 0,
+            "probes": 0,
+        }
+
+    def allow(self):
+        """False while open. Once the cooldown has passed, lets one probe through per cooldown."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            if now - self._opened_at >= self.cooldown:
+                # A probe that never reports back (cancelled) doesn't block the next one
+                self.state = self.HALF_OPEN
+                self._opened_at = now
+                self._stats["probes"] += 1
+                return True
+            self._stats["short_circuited"] += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self.state = self.CLOSED
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self.state == self.HALF_OPEN or (self.state == self.CLOSED and self._failures >= self.threshold):
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._stats["opened"] += 1
+                print(f"Gemini circuit breaker OPEN after {self._failures} consecutive failures")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["state"] = self.state
+            stats["consecutive_failures"] = self._failures
+        return stats
+
+
+class GeminiTransport:
+    """Wraps one Gemini request function with retries, the circuit breaker and (async) hedging."""
+
+    def __init__(self):
+        self.breaker = CircuitBreaker(GEMINI_BREAKER_THRESHOLD, GEMINI_BREAKER_COOLDOWN)
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "retries": 0,
+            "retries_exhausted": 0,
+            "timeouts": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "stream_failures": 0,
+        }
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _record_latency(self, seconds):
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def hedge_delay(self):
+        """p95 of the recent successful calls (never below GEMINI_HEDGE_MIN_DELAY), None without enough data."""
+        with self._lock:
+            if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return max(GEMINI_HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+    def _failed(self, error, attempt):
+        """Records a failed attempt; True if it should be retried."""
+        if not is_retryable(error):
+            return False
+        timed_out = isinstance(error, (TimeoutError, asyncio.TimeoutError))
+        if timed_out:
+            # Per attempt: a hung Gemini may not get to exhaust the retries before the caller's deadline
+            self._count("timeouts")
+            self.breaker.record_failure()
+        if attempt + 1 < GEMINI_RETRY_ATTEMPTS:
+            self._count("retries")
+            return True
+        self._count("retries_exhausted")
+        if not timed_out:
+            self.breaker.record_failure()
+        return False
+
+    def stream_failed(self, error):
+        """
+        A stream that failed after call_async opened it: no retry (the caller may
+        have shown part of it), but transient errors count for the breaker.
+        """
+        self._count("stream_failures")
+        if is_retryable(error):
+            self.breaker.record_failure()
+
+    def call(self, request):
+        """Blocking: request() is retried on transient errors. Raises CircuitOpenError while open."""
+        if not self.breaker.allow():
+            raise CircuitOpenError("Gemini circuit breaker is open")
+        self._count("calls")
+        for attempt in range(GEMINI_RETRY_ATTEMPTS):
+            start = time.monotonic()
+            try:
+                response = request()
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                print(f"Gemini transient error ({e}), retrying")
+                time.sleep(backoff_delay(attempt))
+                continue
+            self._record_latency(time.monotonic() - start)
+            self.breaker.record_success()
+            return response
+
+    async def call_async(self, request, hedge=True):
+        """
+        Async version of call(); request is a coroutine function. Hedges when
+        enabled. hedge=False is for opening streams: no hedging, and the time to
+        open isn't recorded as a call latency.
+        """
+        if not self.breaker.allow():
+            raise CircuitOpenError("Gemini circuit breaker is open")
+        self._count("calls")
+        for attempt in range(GEMINI_RETRY_ATTEMPTS):
+            start = time.monotonic()
+            try:
+                response = await (self._attempt(request) if hedge else request())
+            except Exception as e:
+                if not self._failed(e, attempt):
+                    raise
+                print(f"Gemini transient error ({e}), retrying")
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+            if hedge:
+                self._record_latency(time.monotonic() - start)
+            self.breaker.record_success()
+            return response
+
+    async def _attempt(self, request):
+        delay = self.hedge_delay() if GEMINI_HEDGE_ENABLED else None
+        if delay is None:
+            return await request()
+
+        primary = asyncio.ensure_future(request())
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+
+        self._count("hedges")
+        hedge = asyncio.ensure_future(request())
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._count("hedge_wins")
+                        return task.result()
+            # Both failed: report the primary's error
+            return primary.result()
+        finally:
+            for task in (primary, hedge):
+                if not task.done():
+                    task.cancel()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["breaker"] = self.breaker.stats()
+        delay = self.hedge_delay()
+        stats["hedge_delay_ms"] = round(delay * 1000) if delay is not None else None
+        return stats
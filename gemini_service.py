@@ -1,11 +1,22 @@
 from google import genai
 from google.genai import types
-from config import GOOGLE_API_KEY, SYSTEM_INSTRUCTION
-import datetime
+from config import GOOGLE_API_KEY, GEMINI_MAX_CONCURRENCY, GEMINI_CALL_TIMEOUT, GEMINI_ATTEMPT_TIMEOUT, GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL, FAST_PATH_ENABLED, GEMINI_CONTEXT_CACHE, GEMINI_LOG_USAGE
+from text_utils import normalize_text
+from prompt_manager import PromptManager, PromptUnavailable
+from gemini_resilience import GeminiTransport, CircuitOpenError
+import intent_classifier
+from collections import OrderedDict
+import asyncio
+import copy
+import hashlib
 import json
+import re
+import threading
+import time
 
 # Initialize Client
 client = genai.Client(api_key=GOOGLE_API_KEY)
+MODEL_ID = 'gemini-2.5-flash'
 
 # Schema Definition (matching the React one)
 response_schema = {
@@ -24,7 +35,8 @@ response_schema = {
             "type": "OBJECT",
             "properties": {
                 "amount": {"type": "NUMBER"},
-                "date": {"type": "STRING"}
+                "date": {"type": "STRING"},
+                "reference": {"type": "STRING"}
             }
         },
         "audioTranscription": {"type": "STRING"}
@@ -32,68 +44,566 @@ response_schema = {
     "required": ["message", "intent"]
 }
 
+EMPTY_REQUEST_RESPONSE = {"message": "No entendí, por favor envía texto, imagen o audio.", "intent": "general"}
+
+FALLBACK_RESPONSE = {
+    "message": "Lo siento, tuve un problema técnico momentáneo. ¿Podrías intentarlo de nuevo?",
+    "intent": "general"
+}
+
+# Answer while the circuit breaker is open: booking_request without suggestions shows the full service menu
+UNAVAILABLE_RESPONSE = {
+    "message": "Estoy teniendo problemas para procesar mensajes en este momento 🙏. "
+               "Mientras tanto, puedes elegir un servicio del menú y agendar tu cita directamente 👇",
+    "intent": "booking_request",
+    "suggestedServiceIds": []
+}
+
+_semaphore = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+_transport = GeminiTransport()
+
+def get_transport_stats():
+    """Circuit breaker state and retry / hedge counters."""
+    return _transport.stats()
+
+# --- RESPONSE CACHE ---
+
+# Answers that only depend on the message text (and the prompt / date), never on who asks
+CACHEABLE_INTENTS = {'location_inquiry', 'price_inquiry', 'show_all_services', 'greeting'}
+
+
+class ResponseCache:
+    """
+    LRU + TTL cache of Gemini responses for repeated FAQ-style text messages.
+
+    Keys are (normalized text, prompt version, date): answers produced with
+    another prompt are never served, and since the answer may mention "today",
+    entries never outlive the day they were produced on.
+    Only responses whose intent is in CACHEABLE_INTENTS are stored.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (stored_at, response)
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "expirations": 0,
+        }
+
+    @staticmethod
+    def key(text_message, prompt_version, date_string):
+        normalized = normalize_text(text_message)
+        if not normalized:
+            return None
+        return (normalized, prompt_version, date_string)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                stored_at, response = entry
+                if time.monotonic() - stored_at <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return copy.deepcopy(response)
+                del self._entries[key]
+                self._stats["expirations"] += 1
+            self._stats["misses"] += 1
+            return None
+
+    def put(self, key, response):
+        if response.get('intent') not in CACHEABLE_INTENTS:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), copy.deepcopy(response))
+            self._entries.move_to_end(key)
+            self._stats["stores"] += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_size"] = self.max_size
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+_response_cache = ResponseCache(GEMINI_CACHE_SIZE, GEMINI_CACHE_TTL)
+
+def get_response_cache_stats():
+    """Hit rate and counters of the FAQ response cache."""
+    return _response_cache.stats()
+
+def _local_answer(history, text_message, image_base64, audio_base64):
+    """
+    Fast-path answer for obvious text messages (see intent_classifier.py), or None.
+    The phrases it answers ("hola", "gracias", "dónde quedan"...) mean the same
+    whatever was said before, so conversation history doesn't disable it.
+    """
+    if not FAST_PATH_ENABLED or image_base64 or audio_base64:
+        return None
+    return intent_classifier.classify(text_message)
+
+def _cache_key(text_message, image_base64, audio_base64, prompt):
+    """Only text-only requests use the cache (see _cached_answer / _cacheable for history)."""
+    if image_base64 or audio_base64:
+        return None
+    return ResponseCache.key(text_message, prompt.version, prompt.key[0].isoformat())
+
+def _cached_answer(cache_key, history):
+    """
+    Cached response, if any. Only for messages without conversation history:
+    even a price or service-list answer depends on context ("¿y cuánto
+    cuesta?" after picking a service). The fast path still answers the
+    obvious messages of returning chats.
+    """
+    if cache_key is None or history:
+        return None
+    return _response_cache.get(cache_key)
+
+def _cacheable(cache_key, history):
+    """A follow-up may be answered for its context: don't store it for everyone."""
+    return cache_key is not None and not history
+
+# --- IN-FLIGHT COALESCING ---
+
+
+class _Flight:
+    __slots__ = ("task", "waiters")
+
+    def __init__(self, task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Deduplicates concurrent identical Gemini calls.
+
+    The first request for a key starts the call; identical requests that arrive
+    while it is pending await the same task and each get their own copy of the
+    result. A waiter that is cancelled or times out doesn't affect the others;
+    the call itself is only cancelled when nobody is waiting for it anymore.
+    """
+
+    def __init__(self):
+        self._flights = {}  # key -> _Flight
+        self._stats = {
+            "calls": 0,
+            "leaders": 0,
+            "coalesced": 0,
+            "abandoned": 0,
+        }
+
+    def _finished(self, key, flight, task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved by the waiters; avoids "never retrieved" warnings when none are left
+
+    async def do(self, key, factory):
+        """Awaits factory() once per key among concurrent callers. key=None disables coalescing."""
+        self._stats["calls"] += 1
+        if key is None:
+            self._stats["leaders"] += 1
+            return await factory()
+
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = _Flight(asyncio.ensure_future(factory()))
+            flight.task.add_done_callback(lambda task, key=key, flight=flight: self._finished(key, flight, task))
+            self._flights[key] = flight
+            self._stats["leaders"] += 1
+        else:
+            self._stats["coalesced"] += 1
+
+        flight.waiters += 1
+        try:
+            return copy.deepcopy(await asyncio.shield(flight.task))
+        finally:
+            flight.waiters -= 1
+            if flight.waiters == 0 and not flight.task.done():
+                flight.task.cancel()
+                self._stats["abandoned"] += 1
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["in_flight"] = len(self._flights)
+        stats["coalesced_rate"] = stats["coalesced"] / stats["calls"] if stats["calls"] else 0.0
+        return stats
+
+
+_flights = SingleFlight()
+
+def get_coalescing_stats():
+    """How many Gemini requests shared an identical call already in flight."""
+    return _flights.stats()
+
+def _digest(data):
+    return hashlib.sha1(data).hexdigest() if data else None
+
+def _flight_key(history, text_message, image_base64, audio_base64, prompt):
+    """
+    Same normalized text and identical media bytes -> same call (e.g. a
+    double-sent message). Requests without history coalesce across chats; with
+    history only an identical conversation shares the call, since the answer
+    may depend on it.
+    """
+    normalized = normalize_text(text_message) if text_message else ""
+    if not (normalized or image_base64 or audio_base64):
+        return None
+    history_digest = _digest(json.dumps(history, ensure_ascii=False).encode("utf-8")) if history else None
+    return (prompt.version, history_digest, normalized, _digest(image_base64), _digest(audio_base64))
+
+# --- PROMPT ---
+
+_prompts = PromptManager(client, MODEL_ID, use_context_cache=GEMINI_CONTEXT_CACHE)
+
+def _history_contents(history):
+    """[{'role': 'user'|'model', 'text'}] (see conversation_memory.py) -> Gemini contents."""
+    return [
+        types.Content(role=turn["role"], parts=[types.Part.from_text(text=turn["text"])])
+        for turn in history or ()
+    ]
+
+def _build_request(prompt, text_message, image_base64=None, audio_base64=None, history=None):
+    """Returns (contents, config) for generate_content, or None if there is nothing to send."""
+    # Prepare Content
+    parts = []
+    
+    if image_base64:
+         parts.append(types.Part.from_bytes(data=image_base64, mime_type="image/jpeg"))
+         parts.append(types.Part.from_text(text="Analiza esta imagen. Si es un comprobante de pago, extrae el monto, la fecha y la referencia."))
+
+    if audio_base64:
+         parts.append(types.Part.from_bytes(data=audio_base64, mime_type="audio/ogg")) # Telegram voice notes are usually OGG
+         parts.append(types.Part.from_text(text="Transcribe este audio y responde a la intención del usuario."))
+
+    if text_message:
+        parts.append(types.Part.from_text(text=text_message))
+
+    if not parts:
+        return None
+
+    contents = _history_contents(history) + [types.Content(role="user", parts=parts)]
+    config = _prompts.generate_config(
+        prompt,
+        response_mime_type="application/json",
+        response_schema=response_schema,
+        temperature=0.2
+    )
+    return contents, config
+
+# --- TOKEN USAGE ---
+
+_token_stats = {"requests": 0, "prompt": 0, "cached": 0, "output": 0, "max_prompt": 0}
+_token_lock = threading.Lock()
+
+def _log_usage(response, prompt):
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt_tokens = usage.prompt_token_count or 0
+    cached_tokens = usage.cached_content_token_count or 0
+    output_tokens = usage.candidates_token_count or 0
+    with _token_lock:
+        _token_stats["requests"] += 1
+        _token_stats["prompt"] += prompt_tokens
+        _token_stats["cached"] += cached_tokens
+        _token_stats["output"] += output_tokens
+        _token_stats["max_prompt"] = max(_token_stats["max_prompt"], prompt_tokens)
+    if GEMINI_LOG_USAGE:
+        print(f"Gemini tokens: prompt={prompt_tokens} (cached={cached_tokens}) output={output_tokens} prompt_version={prompt.version}")
+
+def get_token_stats():
+    """Cumulative token usage of the Gemini calls made by this process."""
+    with _token_lock:
+        stats = dict(_token_stats)
+    stats["cached_share"] = stats["cached"] / stats["prompt"] if stats["prompt"] else 0.0
+    return stats
+
+def partial_json_string(buffer, key):
+    """
+    Decoded value of the string field `key` in a JSON object that is still
+    being streamed: everything received so far, even if the closing quote
+    hasn't arrived yet. None while the field hasn't started.
+    """
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), buffer)
+    if not match:
+        return None
+    out = []
+    i = match.end()
+    n = len(buffer)
+    while i < n:
+        c = buffer[i]
+        if c == '"':
+            break
+        if c != '\\':
+            out.append(c)
+            i += 1
+            continue
+        if i + 1 >= n:
+            break  # Escape split across chunks
+        escaped = buffer[i + 1]
+        if escaped == 'u':
+            if i + 6 > n:
+                break
+            code = int(buffer[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:  # Surrogate pair (emoji): needs the second half
+                if i + 12 > n:
+                    break
+                low = int(buffer[i + 8:i + 12], 16)
+                out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                i += 12
+            else:
+                out.append(chr(code))
+                i += 6
+            continue
+        out.append(_JSON_ESCAPES.get(escaped, escaped))
+        i += 2
+    return "".join(out)
+
+_JSON_ESCAPES = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+class _Relay:
+    """
+    Runs a stream's on_message callback in its own task with the latest partial
+    text, so a slow Telegram edit never holds a Gemini slot. Partials that
+    arrive while a callback is running are collapsed into the newest one.
+    """
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self._latest = None
+        self._ready = asyncio.Event()
+        self._closed = False
+        self._task = asyncio.ensure_future(self._run())
+
+    def push(self, text):
+        self._latest = text
+        self._ready.set()
+
+    async def _run(self):
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if self._closed:
+                return
+            text, self._latest = self._latest, None
+            try:
+                await self.on_message(text)
+            except Exception as e:
+                print(f"Streaming callback failed: {e}")
+
+    async def close(self):
+        """Waits for the callback in progress, if any; pending partials are dropped."""
+        self._closed = True
+        self._ready.set()
+        await self._task
+
+_NOT_ANSWERS = {EMPTY_REQUEST_RESPONSE["message"], FALLBACK_RESPONSE["message"], UNAVAILABLE_RESPONSE["message"]}
+
+def is_fallback(response):
+    """True for the canned error / unavailable answers (not worth remembering as conversation)."""
+    return response.get("message") in _NOT_ANSWERS
+
+def _parse_response(response):
+    if response.text:
+        return json.loads(response.text)
+    else:
+        raise Exception("No response text from Gemini")
+
 def send_message_to_gemini(history, text_message, image_base64=None, audio_base64=None):
+    """Blocking call. Bot handlers must use send_message_to_gemini_async instead."""
+    try:
+        local = _local_answer(history, text_message, image_base64, audio_base64)
+        if local:
+            return local
+
+        prompt = _prompts.get()
+        cache_key = _cache_key(text_message, image_base64, audio_base64, prompt)
+        cached = _cached_answer(cache_key, history)
+        if cached:
+            return cached
+
+        request = _build_request(prompt, text_message, image_base64, audio_base64, history)
+        if request is None:
+            return dict(EMPTY_REQUEST_RESPONSE)
+        contents, config = request
+
+        response = _transport.call(lambda: client.models.generate_content(model=MODEL_ID, contents=contents, config=config))
+        _log_usage(response, prompt)
+        result = _parse_response(response)
+        if _cacheable(cache_key, history):
+            _response_cache.put(cache_key, result)
+        return result
+
+    except CircuitOpenError:
+        return copy.deepcopy(UNAVAILABLE_RESPONSE)
+    except Exception as e:
+        print(f"Gemini API Error: {e}")
+        return dict(FALLBACK_RESPONSE)
+
+async def send_message_to_gemini_async(history, text_message, image_base64=None, audio_base64=None, timeout=GEMINI_CALL_TIMEOUT):
+    """
+    Non-blocking version on the SDK's client.aio. In google-genai 1.2 that is
+    the blocking HTTP call run with asyncio.to_thread, so each request in
+    flight takes a thread of the loop's default executor (sized by
+    bot.post_init, GEMINI_SDK_THREADS).
+
+    At most GEMINI_MAX_CONCURRENCY calls run at once; `timeout` covers the wait
+    for a free slot, the request itself and any retries (see
+    gemini_resilience.py). While the circuit breaker is open it answers at once
+    with UNAVAILABLE_RESPONSE. Identical requests made while one is pending
+    share its call (see SingleFlight). On error or timeout it returns the same
+    fallback message as the sync version. Cancelling the awaiting task (see
+    bot.ask_gemini) aborts the request unless other identical requests are
+    still waiting for it.
+    """
+    local = _local_answer(history, text_message, image_base64, audio_base64)
+    if local:
+        return local
+
     try:
-        model_id = 'gemini-2.5-flash' 
-
-        # Context Injection
-        now = datetime.datetime.now()
-        day_name = now.strftime("%A") 
-        days_es = {"Monday": "Lunes", "Tuesday": "Martes", "Wednesday": "Miércoles", "Thursday": "Jueves", "Friday": "Viernes", "Saturday": "Sábado", "Sunday": "Domingo"}
-        day_name_es = days_es.get(day_name, day_name)
-        date_string = now.strftime("%Y-%m-%d")
-
-        context_instruction = f"""
-        {SYSTEM_INSTRUCTION}
-        
-        CONTEXTO TEMPORAL OBLIGATORIO:
-        - HOY es: {day_name_es.upper()}, {date_string}.
-        - Si el usuario dice "mañana", se refiere al día siguiente.
-        
-        INSTRUCCIONES DE VISIÓN Y AUDIO:
-        - Si recibes una IMAGEN de un comprobante de pago (Nequi, Daviplata, Bancolombia, efectivo), extrae el valor y la fecha.
-          - Intent: 'invoice_analysis'
-          - extractedInvoiceData: {{ "amount": 50000, "date": "2023-10-27" }}
-        - Si recibes un AUDIO, transcríbelo y responde como si fuera texto.
-          - audioTranscription: "Texto transcrito del audio"
-        """
-
-        # Prepare Content
-        parts = []
-        
-        if image_base64:
-             parts.append(types.Part.from_bytes(data=image_base64, mime_type="image/jpeg"))
-             parts.append(types.Part.from_text(text="Analiza esta imagen. Si es un comprobante de pago, extrae el monto y fecha."))
-
-        if audio_base64:
-             parts.append(types.Part.from_bytes(data=audio_base64, mime_type="audio/ogg")) # Telegram voice notes are usually OGG
-             parts.append(types.Part.from_text(text="Transcribe este audio y responde a la intención del usuario."))
-
-        if text_message:
-            parts.append(types.Part.from_text(text=text_message))
-
-        if not parts:
-            return {"message": "No entendí, por favor envía texto, imagen o audio.", "intent": "general"}
-
-        response = client.models.generate_content(
-            model=model_id,
-            contents=[types.Content(role="user", parts=parts)],
-            config=types.GenerateContentConfig(
-                system_instruction=context_instruction,
-                response_mime_type="application/json",
-                response_schema=response_schema,
-                temperature=0.2
+        prompt = await _prompts.get_async()
+    except PromptUnavailable as e:
+        print(f"Gemini API Error: {e}")
+        return dict(FALLBACK_RESPONSE)
+    cache_key = _cache_key(text_message, image_base64, audio_base64, prompt)
+    cached = _cached_answer(cache_key, history)
+    if cached:
+        return cached
+
+    request = _build_request(prompt, text_message, image_base64, audio_base64, history)
+    if request is None:
+        return dict(EMPTY_REQUEST_RESPONSE)
+    contents, config = request
+
+    async def request():
+        async with _semaphore:
+            # Timed from here: waiting for a slot is local queueing, not a Gemini failure
+            return await asyncio.wait_for(
+                client.aio.models.generate_content(model=MODEL_ID, contents=contents, config=config),
+                GEMINI_ATTEMPT_TIMEOUT,
             )
+
+    async def call():
+        response = await _transport.call_async(request)
+        _log_usage(response, prompt)
+        result = _parse_response(response)
+        if _cacheable(cache_key, history):
+            _response_cache.put(cache_key, result)
+        return result
+
+    flight_key = _flight_key(history, text_message, image_base64, audio_base64, prompt)
+    try:
+        return await asyncio.wait_for(_flights.do(flight_key, call), timeout)
+    except CircuitOpenError:
+        return copy.deepcopy(UNAVAILABLE_RESPONSE)
+    except asyncio.TimeoutError:
+        # Not reported to the breaker: this deadline includes the wait for a slot and
+        # fires once per coalesced waiter; GeminiTransport counts the attempts that timed out
+        print(f"Gemini Timeout: no response after {timeout}s")
+        return dict(FALLBACK_RESPONSE)
+    except Exception as e:
+        print(f"Gemini API Error: {e}")
+        return dict(FALLBACK_RESPONSE)
+
+async def send_message_to_gemini_stream(history, text_message, on_message, image_base64=None, audio_base64=None, timeout=GEMINI_CALL_TIMEOUT):
+    """
+    Streaming version of send_message_to_gemini_async.
+
+    `on_message(text)` is called with the 'message' field decoded so far as
+    chunks extend it, so the caller can show the answer while it is being
+    generated; the full response dict (intent, suggestedServiceIds...) is
+    returned at the end. The callback runs outside the Gemini semaphore (see
+    _Relay) and may skip intermediate partials when it is slower than the
+    stream; it has finished when this returns or is cancelled. Fast-path and cached answers are returned directly
+    without calling on_message. Streams are not coalesced or hedged (each
+    caller needs its own progressive output), but opening one is retried and
+    guarded by the circuit breaker like any other call, and a stream that
+    breaks after opening counts as a failed call.
+    """
+    local = _local_answer(history, text_message, image_base64, audio_base64)
+    if local:
+        return local
+
+    try:
+        prompt = await _prompts.get_async()
+    except PromptUnavailable as e:
+        print(f"Gemini API Error: {e}")
+        return dict(FALLBACK_RESPONSE)
+    cache_key = _cache_key(text_message, image_base64, audio_base64, prompt)
+    cached = _cached_answer(cache_key, history)
+    if cached:
+        return cached
+
+    request = _build_request(prompt, text_message, image_base64, audio_base64, history)
+    if request is None:
+        return dict(EMPTY_REQUEST_RESPONSE)
+    contents, config = request
+
+    async def open_stream():
+        return await asyncio.wait_for(
+            client.aio.models.generate_content_stream(model=MODEL_ID, contents=contents, config=config),
+            GEMINI_ATTEMPT_TIMEOUT,
         )
 
-        if response.text:
-            return json.loads(response.text)
-        else:
+    async def call():
+        text = ""
+        shown = ""
+        last_chunk = None
+        relay = _Relay(on_message)
+        try:
+            async with _semaphore:
+                stream = await _transport.call_async(open_stream, hedge=False)
+                try:
+                    async for chunk in stream:
+                        last_chunk = chunk
+                        if not chunk.text:
+                            continue
+                        text += chunk.text
+                        partial = partial_json_string(text, "message")
+                        if partial and partial != shown:
+                            shown = partial
+                            relay.push(partial)
+                except Exception as e:
+                    _transport.stream_failed(e)  # Opened fine, broke mid-stream: still counts for the breaker
+                    raise
+        finally:
+            # Even when cancelled: an edit still in flight finishes before the caller cleans up the message
+            await relay.close()
+        if not text:
             raise Exception("No response text from Gemini")
+        if last_chunk is not None:
+            _log_usage(last_chunk, prompt)  # Usage totals come with the last chunk
+        result = json.loads(text)
+        if _cacheable(cache_key, history):
+            _response_cache.put(cache_key, result)
+        return result
 
+    try:
+        return await asyncio.wait_for(call(), timeout)
+    except CircuitOpenError:
+        return copy.deepcopy(UNAVAILABLE_RESPONSE)
+    except asyncio.TimeoutError:
+        # Not reported to the breaker: this deadline includes the wait for a slot and
+        # fires once per coalesced waiter; GeminiTransport counts the attempts that timed out
+        print(f"Gemini Timeout: no response after {timeout}s")
+        return dict(FALLBACK_RESPONSE)
     except Exception as e:
         print(f"Gemini API Error: {e}")
-        return {
-            "message": "Lo siento, tuve un problema técnico momentáneo. ¿Podrías intentarlo de nuevo?",
-            "intent": "general"
-        }
+        return dict(FALLBACK_RESPONSE)
@@ -38,9 +38,11 @@ def main():
         print("Opción inválida.")
         return
 
+    include_details = input("¿Incluir el detalle de cada cita? (s/n): ").strip().lower() != 'n'
+
     print(f"\nGenerando reporte desde {start_date} hasta {end_date}...")
     try:
-        filepath = reports.generate_financial_report(start_date, end_date)
+        filepath = reports.generate_financial_report(start_date, end_date, include_details=include_details)
         print(f"\n✅ ¡Reporte generado con éxito!")
         print(f"📂 Ubicación: {filepath}")
     except Exception as e:
@@ -1,5 +1,6 @@
 import pyodbc
 import os
+import database
 from config import DB_CONNECTION_STRING
 
 def init_db():
@@ -60,6 +61,16 @@ def init_db():
         END
         """)
         
+        # Part 2.5: One confirmed appointment per slot (enforced by the DB, not just the bot)
+        cursor.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name='UX_Appointments_ConfirmedSlot')
+        BEGIN
+            CREATE UNIQUE INDEX UX_Appointments_ConfirmedSlot
+            ON Appointments (appointment_date, appointment_time)
+            WHERE status = 'confirmed';
+        END
+        """)
+        
         # Part 3: Seed Data (Delete and Insert)
         cursor.execute("DELETE FROM Services")
         
@@ -89,6 +100,9 @@ def init_db():
         conn.commit()
         print("Database initialized successfully!")
         conn.close()
+        
+        # Services were re-seeded: make the running bot reload its catalog
+        database.invalidate_service_catalog()
         return True
         
     except Exception as e:
@@ -0,0 +1,220 @@
+"""
+Local fast-path intent classifier.
+
+Obvious messages ("hola", "gracias", "dónde quedan", "quiero cancelar mi cita",
+a bare cédula...) don't need an LLM round trip just to get an intent back.
+classify() matches the normalized text against a token trie of known phrases
+plus a few regexes and returns a response dict with the same shape Gemini
+returns ({"message", "intent", "suggestedServiceIds"}), or None when it is not
+confident enough, in which case the message goes to Gemini as before.
+
+Confidence = phrase weight x share of the message covered by the phrase and
+filler words. A second, different intent in the same message ("hola, me duele
+la espalda"), any word that needs the LLM (symptoms, prices...) or a negation
+near a phrase ("no quiero cancelar mi cita", "ya no necesito reprogramar")
+makes the classifier step aside.
+
+Run evaluate_intent_classifier.py to measure precision and the share of Gemini
+calls avoided on the labelled corpus.
+"""
+import re
+import threading
+
+from config import CLINIC_INFO, FAST_PATH_MIN_CONFIDENCE
+from text_utils import normalize_text
+
+# (phrase, intent, weight). Phrases are matched on normalized text (no accents, lowercase).
+PHRASES = [
+    # Greetings
+    ("hola", "greeting", 1.0),
+    ("holi", "greeting", 1.0),
+    ("buenas", "greeting", 1.0),
+    ("buen dia", "greeting", 1.0),
+    ("buenos dias", "greeting", 1.0),
+    ("buenas tardes", "greeting", 1.0),
+    ("buenas noches", "greeting", 1.0),
+    ("que tal", "greeting", 0.9),
+    ("hey", "greeting", 0.9),
+    ("saludos", "greeting", 0.9),
+    # Thanks / goodbye
+    ("gracias", "thanks", 1.0),
+    ("muchas gracias", "thanks", 1.0),
+    ("mil gracias", "thanks", 1.0),
+    ("muy amable", "thanks", 1.0),
+    ("listo gracias", "thanks", 1.0),
+    ("chao", "thanks", 1.0),
+    ("adios", "thanks", 1.0),
+    ("hasta luego", "thanks", 1.0),
+    # Location
+    ("donde quedan", "location_inquiry", 1.0),
+    ("donde queda", "location_inquiry", 1.0),
+    ("donde estan", "location_inquiry", 1.0),
+    ("donde estan ubicados", "location_inquiry", 1.0),
+    ("donde es", "location_inquiry", 0.9),
+    ("direccion", "location_inquiry", 1.0),
+    ("ubicacion", "location_inquiry", 1.0),
+    ("como llego", "location_inquiry", 1.0),
+    ("como llegar", "location_inquiry", 1.0),
+    # Appointment management
+    ("cancelar", "cancellation", 0.9),
+    ("cancelar mi cita", "cancellation", 1.0),
+    ("cancelar la cita", "cancellation", 1.0),
+    ("anular mi cita", "cancellation", 1.0),
+    ("reprogramar", "reschedule", 1.0),
+    ("cambiar mi cita", "reschedule", 1.0),
+    ("cambiar la cita", "reschedule", 1.0),
+    ("cambiar la hora", "reschedule", 1.0),
+    ("cambiar el horario", "reschedule", 1.0),
+    ("mover mi cita", "reschedule", 1.0),
+    ("mover la cita", "reschedule", 1.0),
+    ("ver mis citas", "check_appointment", 1.0),
+    ("consultar mi cita", "check_appointment", 1.0),
+    ("consultar mis citas", "check_appointment", 1.0),
+    ("mis citas", "check_appointment", 0.9),
+    ("mi cita", "check_appointment", 0.8),
+]
+
+# Whole-message patterns, matched on normalized text
+PATTERNS = [
+    # Bare cédula; 10 digits starting with 3 is a Colombian mobile number, left to the LLM
+    (re.compile(r"^(?!3\d{9}$)\d{6,10}$"), "check_appointment", 1.0),
+]
+
+# Words that carry no intent of their own; they count as covered text
+FILLER = set("""
+a al algo ayuda ayudar buen buena bueno como con de del el en es esta este favor gon hay la las le lo los
+me mi mis muy necesito para por porfa porfavor podria puedo puedes quiero quisiera se senor si
+su sus te tu un una y ya yo ok okay listo senora doctora doc ana maria
+""".split())
+
+# Words that mean the message needs the LLM (symptoms, prices, booking details...)
+NEEDS_LLM = set("""
+dolor duele duelen lesion molestia precio precios cuanto cuesta valor vale costo agendar reservar apartar
+servicio servicios terapia masaje pilates plasma embarazo manana hoy hora horario horarios pago pague
+transferencia comprobante
+""".split())
+
+# A negation this close (in tokens) to a matched phrase sends the message to the LLM.
+# "ya no" is covered by "no".
+NEGATIONS = {"no", "nunca", "tampoco"}
+NEGATION_WINDOW = 3
+
+GREETING_MESSAGE = (
+    f"¡Hola! 👋 Soy {CLINIC_INFO['botName']}, el asistente virtual de {CLINIC_INFO['therapist']} "
+    "Fisioterapia. ¿En qué puedo ayudarte hoy? 😊"
+)
+THANKS_MESSAGE = "¡Con mucho gusto! 😊 Si necesitas algo más, aquí estaré. ✨"
+LOCATION_MESSAGE = (
+    f"📍 Estamos en **{CLINIC_INFO['address']}**.\n\n"
+    f"🗺️ Mapa: {CLINIC_INFO['mapUrl']}\n\n"
+    "¡Te esperamos! 😊"
+)
+MANAGEMENT_MESSAGE = "Claro, ya te paso con el sistema de gestión."
+
+RESPONSES = {
+    "greeting": ("greeting", GREETING_MESSAGE),
+    "thanks": ("general", THANKS_MESSAGE),
+    "location_inquiry": ("location_inquiry", LOCATION_MESSAGE),
+    "cancellation": ("cancellation", MANAGEMENT_MESSAGE),
+    "reschedule": ("reschedule", MANAGEMENT_MESSAGE),
+    "check_appointment": ("check_appointment", MANAGEMENT_MESSAGE),
+}
+
+_END = object()
+
+def _build_trie(phrases):
+    trie = {}
+    for phrase, label, weight in phrases:
+        node = trie
+        for token in normalize_text(phrase).split():
+            node = node.setdefault(token, {})
+        node[_END] = (label, weight)
+    return trie
+
+_TRIE = _build_trie(PHRASES)
+
+
+def _matches(tokens):
+    """Longest trie match starting at each position: [(start, length, label, weight)]."""
+    found = []
+    i = 0
+    while i < len(tokens):
+        node = _TRIE
+        best = None
+        j = i
+        while j < len(tokens) and tokens[j] in node:
+            node = node[tokens[j]]
+            j += 1
+            if _END in node:
+                best = (i, j - i) + node[_END]
+        if best:
+            found.append(best)
+            i += best[1]
+        else:
+            i += 1
+    return found
+
+def score(text):
+    """Returns (label, confidence) for the message; label is None when nothing matched."""
+    normalized = normalize_text(text)
+    if not normalized:
+        return None, 0.0
+
+    for pattern, label, weight in PATTERNS:
+        if pattern.match(normalized):
+            return label, weight
+
+    tokens = normalized.split()
+    matches = _matches(tokens)
+    if not matches:
+        return None, 0.0
+
+    in_phrase = set()
+    for start, length, _, _ in matches:
+        in_phrase.update(range(start, start + length))
+        nearby = tokens[max(0, start - NEGATION_WINDOW):start + length + NEGATION_WINDOW]
+        if any(token in NEGATIONS for token in nearby):
+            return None, 0.0
+    if any(token in NEEDS_LLM for i, token in enumerate(tokens) if i not in in_phrase):
+        return None, 0.0
+
+    labels = {label for _, _, label, _ in matches}
+    if len(labels) > 1 and labels != {"greeting", "thanks"}:
+        return None, 0.0  # Mixed signals: let the LLM decide
+
+    covered = len(in_phrase) + sum(1 for i, token in enumerate(tokens) if i not in in_phrase and token in FILLER)
+    coverage = covered / len(tokens)
+
+    # "hola, gracias" -> thanks wins (the user is closing the conversation)
+    label = "thanks" if "thanks" in labels else matches[0][2]
+    weight = max(w for _, _, l, w in matches if l == label)
+    return label, weight * coverage
+
+
+_stats = {"calls": 0, "answered": 0}
+_stats_by_label = {}
+_stats_lock = threading.Lock()
+
+def classify(text, min_confidence=FAST_PATH_MIN_CONFIDENCE):
+    """Gemini-shaped response dict for high-confidence messages, None otherwise."""
+    label, confidence = score(text)
+    answered = label is not None and confidence >= min_confidence
+
+    with _stats_lock:
+        _stats["calls"] += 1
+        if answered:
+            _stats["answered"] += 1
+            _stats_by_label[label] = _stats_by_label.get(label, 0) + 1
+
+    if not answered:
+        return None
+    intent, message = RESPONSES[label]
+    return {"message": message, "intent": intent, "suggestedServiceIds": []}
+
+def get_fast_path_stats():
+    """How many messages were answered locally (and with which intent) vs sent to Gemini."""
+    with _stats_lock:
+        stats = dict(_stats)
+        stats["by_intent"] = dict(_stats_by_label)
+    stats["avoided_rate"] = stats["answered"] / stats["calls"] if stats["calls"] else 0.0
+    return stats
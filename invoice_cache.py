@@ -0,0 +1,181 @@
+"""
+Cache of payment-receipt analyses (Gemini 'invoice_analysis' responses).
+
+A receipt is the same one sent before only on an exact match:
+1. the Telegram file_unique_id of the photo (forwarded / resent: no download,
+   the stored extraction is reused and Gemini is not asked again);
+2. the SHA-256 of the prepared image bytes (same file uploaded again).
+
+Receipts from the same app share a template, so two different payments can
+have a dHash distance of 0. A perceptual match (within INVOICE_HASH_MAX_DISTANCE
+bits) is therefore only a hint: the photo still goes to Gemini, and it counts
+as the earlier receipt (e.g. re-compressed by another chat app) only if the
+extracted reference and amount are the same too.
+
+Each receipt gets a proof id ("sha256:<hex>") that confirm_payment_selection
+saves in Appointments.payment_proof; a receipt whose proof id is already
+linked to a paid appointment (here or in the database) is a duplicate
+submission.
+"""
+import copy
+import re
+import threading
+from collections import OrderedDict
+
+from config import INVOICE_CACHE_SIZE, INVOICE_HASH_MAX_DISTANCE
+
+
+class Receipt:
+    __slots__ = ("proof", "dhash", "response", "appointment_id")
+
+    def __init__(self, proof, dhash, response):
+        self.proof = proof
+        self.dhash = dhash
+        self.response = response
+        self.appointment_id = None  # Set once the payment is registered
+
+
+def proof_id(sha256_hex):
+    return f"sha256:{sha256_hex}"
+
+def _payment_key(response):
+    """(reference, amount) extracted from a receipt, None without a reference."""
+    data = response.get("extractedInvoiceData") or {}
+    reference = re.sub(r"[^0-9A-Z]", "", str(data.get("reference") or "").upper())
+    if not reference:
+        return None
+    try:
+        amount = round(float(data.get("amount") or 0))
+    except (TypeError, ValueError):
+        return None
+    return reference, amount
+
+
+class InvoiceCache:
+    def __init__(self, max_size, max_distance):
+        self.max_size = max_size
+        self.max_distance = max_distance
+        self._receipts = OrderedDict()  # proof -> Receipt
+        self._by_file = {}              # file_unique_id -> proof
+        self._lock = threading.Lock()
+        self._stats = {
+            "file_hits": 0,
+            "exact_hits": 0,
+            "near_hits": 0,
+            "near_mismatches": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "duplicates": 0,
+        }
+
+    def _touch(self, receipt):
+        self._receipts.move_to_end(receipt.proof)
+        return receipt
+
+    def by_file(self, file_unique_id):
+        """Receipt already seen with this Telegram file, or None. Doesn't count a miss."""
+        with self._lock:
+            receipt = self._receipts.get(self._by_file.get(file_unique_id))
+            if receipt is None:
+                return None
+            self._stats["file_hits"] += 1
+            return self._touch(receipt)
+
+    def by_content(self, sha256_hex, file_unique_id):
+        """Receipt with exactly the same bytes, or None; remembers file_unique_id for next time."""
+        with self._lock:
+            receipt = self._receipts.get(proof_id(sha256_hex))
+            if receipt is None:
+                return None
+            self._stats["exact_hits"] += 1
+            self._by_file[file_unique_id] = receipt.proof
+            return self._touch(receipt)
+
+    def by_payment(self, dhash, response, file_unique_id):
+        """
+        Receipt that looks the same (dHash within max_distance) and has the same
+        extracted reference and amount as `response`, or None.
+        """
+        key = _payment_key(response)
+        with self._lock:
+            if dhash is None or key is None:
+                self._stats["misses"] += 1
+                return None
+            best = None
+            for candidate in self._receipts.values():
+                if candidate.dhash is None:
+                    continue
+                distance = bin(candidate.dhash ^ dhash).count("1")
+                if distance > self.max_distance:
+                    continue
+                if _payment_key(candidate.response) != key:
+                    self._stats["near_mismatches"] += 1  # Same template, different payment
+                    continue
+                if best is None or distance < best[0]:
+                    best = (distance, candidate)
+            if best is None:
+                self._stats["misses"] += 1
+                return None
+            receipt = best[1]
+            self._stats["near_hits"] += 1
+            self._by_file[file_unique_id] = receipt.proof
+            return self._touch(receipt)
+
+    def store(self, file_unique_id, sha256_hex, dhash, response):
+        receipt = Receipt(proof_id(sha256_hex), dhash, copy.deepcopy(response))
+        with self._lock:
+            self._receipts[receipt.proof] = receipt
+            self._receipts.move_to_end(receipt.proof)
+            self._by_file[file_unique_id] = receipt.proof
+            self._stats["stores"] += 1
+            while len(self._receipts) > self.max_size:
+                proof, _ = self._receipts.popitem(last=False)
+                self._stats["evictions"] += 1
+                for uid in [uid for uid, p in self._by_file.items() if p == proof]:
+                    del self._by_file[uid]
+        return receipt
+
+    def mark_registered(self, proof, appointment_id):
+        with self._lock:
+            receipt = self._receipts.get(proof)
+            if receipt is not None:
+                receipt.appointment_id = appointment_id
+
+    def note_duplicate(self):
+        with self._lock:
+            self._stats["duplicates"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._receipts)
+            stats["max_size"] = self.max_size
+        hits = stats["file_hits"] + stats["exact_hits"] + stats["near_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+
+_cache = InvoiceCache(INVOICE_CACHE_SIZE, INVOICE_HASH_MAX_DISTANCE)
+
+def by_file(file_unique_id):
+    return _cache.by_file(file_unique_id)
+
+def by_content(sha256_hex, file_unique_id):
+    return _cache.by_content(sha256_hex, file_unique_id)
+
+def by_payment(dhash, response, file_unique_id):
+    return _cache.by_payment(dhash, response, file_unique_id)
+
+def store(file_unique_id, sha256_hex, dhash, response):
+    return _cache.store(file_unique_id, sha256_hex, dhash, response)
+
+def mark_registered(proof, appointment_id):
+    _cache.mark_registered(proof, appointment_id)
+
+def note_duplicate():
+    _cache.note_duplicate()
+
+def get_invoice_cache_stats():
+    return _cache.stats()
@@ -0,0 +1,178 @@
+"""
+Photo preprocessing before images go to Gemini.
+
+Telegram sends every photo in several sizes (update.message.photo, smallest
+first). Payment receipts only need enough pixels for the amounts and dates to
+be legible, so prepare_photo():
+
+1. picks the smallest size whose short side is at least MEDIA_MIN_SIDE
+   (the largest one if none is big enough) and downloads only that one;
+2. on a worker thread, applies the EXIF orientation, downscales so the long
+   side fits MEDIA_MAX_SIDE and re-encodes as JPEG without metadata (EXIF,
+   GPS...), lowering the quality and then the size until it fits
+   MEDIA_MAX_BYTES.
+
+The short side is never scaled below MEDIA_MIN_SIDE, the legibility floor:
+for tall screenshots (1080x2400) that wins over MEDIA_MAX_SIDE (-> 720x1600),
+and an image that only fits MEDIA_MAX_BYTES below that size is sent over
+budget at MIN_JPEG_QUALITY.
+
+If the image cannot be decoded the downloaded bytes are sent unchanged.
+fingerprint() returns an exact (SHA-256) and a perceptual (dHash) hash of an
+image, used by invoice_cache.py to recognise a receipt that was sent before.
+get_media_stats() reports the bytes saved and the end-to-end latency per image
+(selection + download + processing).
+"""
+import asyncio
+import hashlib
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageOps
+
+from config import MEDIA_MIN_SIDE, MEDIA_MAX_SIDE, MEDIA_MAX_BYTES, MEDIA_JPEG_QUALITY, MEDIA_WORKERS
+from db_metrics import LatencyHistogram
+
+# Quality steps tried (below MEDIA_JPEG_QUALITY) before shrinking the image further
+MIN_JPEG_QUALITY = 45
+QUALITY_STEP = 10
+SHRINK_FACTOR = 0.8
+
+_executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="media")
+
+
+def pick_photo_size(photos, min_side=MEDIA_MIN_SIDE):
+    """Smallest PhotoSize whose short side is >= min_side, or the largest available."""
+    for photo in sorted(photos, key=lambda p: p.width * p.height):
+        if min(photo.width, photo.height) >= min_side:
+            return photo
+    return max(photos, key=lambda p: p.width * p.height)
+
+def _encode(image, quality):
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)  # No exif= -> metadata is dropped
+    return buffer.getvalue()
+
+def _scale(size, max_side, min_side):
+    """Factor (<= 1) that fits the long side in max_side without taking the short side below min_side."""
+    width, height = size
+    scale = min(1.0, max_side / max(width, height))
+    return max(scale, min(1.0, min_side / min(width, height)))
+
+def shrink_image(data, max_side=MEDIA_MAX_SIDE, max_bytes=MEDIA_MAX_BYTES, quality=MEDIA_JPEG_QUALITY, min_side=MEDIA_MIN_SIDE):
+    """Re-encoded JPEG bytes within max_side / max_bytes, short side kept >= min_side. Blocking (CPU bound)."""
+    with Image.open(io.BytesIO(data)) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        scale = _scale(image.size, max_side, min_side)
+        if scale < 1:
+            width, height = image.size
+            image = image.resize((round(width * scale), round(height * scale)), Image.LANCZOS)
+
+        encoded = _encode(image, quality)
+        while len(encoded) > max_bytes:
+            if quality - QUALITY_STEP >= MIN_JPEG_QUALITY:
+                quality -= QUALITY_STEP
+            else:
+                width, height = image.size
+                scale = max(SHRINK_FACTOR, min_side / min(width, height))
+                if scale >= 1:
+                    break  # Already at the legibility floor: sent over budget
+                image = image.resize((round(width * scale), round(height * scale)), Image.LANCZOS)
+            encoded = _encode(image, quality)
+        return encoded
+
+def dhash(data, size=8):
+    """
+    Difference hash: size x size bits comparing neighbouring pixels of a
+    grayscale thumbnail. Re-compressed or resized copies of the same image
+    differ in only a few bits.
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        pixels = list(image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (left > right)
+    return bits
+
+def _fingerprint(data):
+    try:
+        perceptual = dhash(data)
+    except Exception as e:
+        print(f"Could not compute image hash: {e}")
+        perceptual = None
+    return hashlib.sha256(data).hexdigest(), perceptual
+
+async def fingerprint(data):
+    """(sha256 hex, dHash or None) of an image, computed on the media worker pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, _fingerprint, data)
+
+
+class MediaStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = LatencyHistogram()
+        self._stats = {
+            "images": 0,
+            "failed": 0,
+            "largest_bytes": 0,     # Size of the largest Telegram variant (what used to be sent)
+            "downloaded_bytes": 0,
+            "sent_bytes": 0,
+        }
+
+    def record(self, largest, downloaded, sent, seconds, failed=False):
+        with self._lock:
+            self._stats["images"] += 1
+            if failed:
+                self._stats["failed"] += 1
+            self._stats["largest_bytes"] += largest
+            self._stats["downloaded_bytes"] += downloaded
+            self._stats["sent_bytes"] += sent
+            self._latency.add(seconds * 1000)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            latency = self._latency
+            stats["p50_ms"] = round(latency.percentile(50), 1)
+            stats["p95_ms"] = round(latency.percentile(95), 1)
+            stats["max_ms"] = round(latency.max, 1)
+        stats["saved_bytes"] = max(0, stats["largest_bytes"] - stats["sent_bytes"])
+        stats["saved_rate"] = stats["saved_bytes"] / stats["largest_bytes"] if stats["largest_bytes"] else 0.0
+        return stats
+
+
+_stats = MediaStats()
+
+def get_media_stats():
+    """Images processed, bytes saved vs sending Telegram's largest size, and latency per image."""
+    return _stats.stats()
+
+async def prepare_photo(photos):
+    """Downloads the best-fitting size of a Telegram photo and returns JPEG bytes ready for Gemini."""
+    start = time.perf_counter()
+    largest = max(photos, key=lambda p: p.width * p.height)
+    chosen = pick_photo_size(photos)
+
+    photo_file = await chosen.get_file()
+    data = bytes(await photo_file.download_as_bytearray())
+
+    loop = asyncio.get_running_loop()
+    try:
+        result = await loop.run_in_executor(_executor, shrink_image, data)
+        failed = False
+    except Exception as e:
+        print(f"Image preprocessing failed, sending the original: {e}")
+        result = data
+        failed = True
+
+    largest_bytes = largest.file_size or len(data)  # file_size is optional in the Bot API
+    _stats.record(largest_bytes, len(data), len(result), time.perf_counter() - start, failed)
+    return result
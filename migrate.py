@@ -0,0 +1,201 @@
+"""
+Versioned schema migrations for SQL Server.
+
+Migrations are the files in migrations/ named NNNN_description.sql, applied in
+order. Batches inside a file are separated by a line containing only `GO`.
+Every migration is written to be idempotent (IF NOT EXISTS ...), and each applied
+version is recorded in the SchemaMigrations table so it only runs once.
+
+Usage:
+    python migrate.py              # apply pending migrations
+    python migrate.py --status     # list applied / pending migrations
+    python migrate.py --dry-run    # show query plans of the hot queries before and after
+                                   # the pending migrations, then roll everything back
+
+--dry-run really executes the pending migrations (so their pre-checks run too)
+inside one transaction and rolls it back at the end. The "before" plans are
+taken in autocommit mode, outside that transaction. The "after" plans can only
+see the new indexes from inside it: they are the optimizer's estimated plans
+(SHOWPLAN compiles, nothing is read) against the uncommitted schema, and the
+uncommitted DDL holds schema locks on the touched tables until the rollback,
+so run it off-peak.
+"""
+import argparse
+import os
+import re
+
+import database
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+
+# Representative literals: SHOWPLAN only compiles the statement, nothing is read.
+HOT_QUERIES = [
+    ("check_availability / get_booked_slots", """
+        SELECT appointment_time FROM Appointments
+        WHERE appointment_date = '2030-01-02' AND appointment_time = '10:00' AND status = 'confirmed'
+    """),
+    ("slot index warm-up", """
+        SELECT appointment_date, appointment_time FROM Appointments
+        WHERE appointment_date >= '2030-01-01' AND appointment_date <= '2030-03-01' AND status = 'confirmed'
+    """),
+    ("get_appointments_by_patient", """
+        SELECT a.id, a.appointment_date, a.appointment_time, a.status, s.nombre, a.patient_name
+        FROM Appointments a
+        JOIN Services s ON a.service_id = s.id
+        WHERE a.patient_id = '1061000000' AND a.status = 'confirmed'
+        ORDER BY a.appointment_date, a.appointment_time
+    """),
+    ("get_appointments_by_range", """
+        SELECT a.id, a.patient_name, a.patient_id, s.nombre as service_name, s.precio, a.appointment_date, a.appointment_time, a.status, a.payment_status, a.payment_method, a.payment_amount
+        FROM Appointments a
+        JOIN Services s ON a.service_id = s.id
+        WHERE a.appointment_date >= '2030-01-01' AND a.appointment_date <= '2030-01-31'
+        ORDER BY a.appointment_date ASC, a.appointment_time ASC
+    """),
+    ("get_report_summary", """
+        SELECT COUNT(*), SUM(CASE WHEN a.status <> 'cancelled' THEN s.precio ELSE 0 END), SUM(COALESCE(a.payment_amount, 0))
+        FROM Appointments a
+        JOIN Services s ON a.service_id = s.id
+        WHERE a.appointment_date >= '2030-01-01' AND a.appointment_date <= '2030-01-31'
+    """),
+]
+
+def load_migrations():
+    """Returns [(version, name, [batches])] sorted by version."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = re.match(r"^(\d+)_(.+)\.sql$", filename)
+        if not match:
+            continue
+        with open(os.path.join(MIGRATIONS_DIR, filename), 'r', encoding='utf-8') as f:
+            sql = f.read()
+        batches = [b.strip() for b in re.split(r"^\s*GO\s*$", sql, flags=re.MULTILINE | re.IGNORECASE)]
+        migrations.append((match.group(1), match.group(2), [b for b in batches if b]))
+    return migrations
+
+def ensure_migrations_table(cursor):
+    cursor.execute("""
+    IF OBJECT_ID('dbo.SchemaMigrations', 'U') IS NULL
+    BEGIN
+        CREATE TABLE SchemaMigrations (
+            version NVARCHAR(20) PRIMARY KEY,
+            name NVARCHAR(255) NOT NULL,
+            applied_at DATETIME DEFAULT GETDATE()
+        );
+    END
+    """)
+
+def get_applied_versions(cursor):
+    cursor.execute("SELECT version FROM SchemaMigrations")
+    return {row.version for row in cursor.fetchall()}
+
+def apply_migration(cursor, version, name, batches):
+    for batch in batches:
+        cursor.execute(batch)
+        # Errors raised after the first statement of a batch (e.g. a RAISERROR in
+        # a pre-check) only surface while reading the remaining results
+        while cursor.nextset():
+            pass
+    cursor.execute("INSERT INTO SchemaMigrations (version, name) VALUES (?, ?)", (version, name))
+
+def get_query_plans(cursor):
+    """Returns {query name: plan text} using SHOWPLAN_TEXT (queries are compiled, not run)."""
+    plans = {}
+    cursor.execute("SET SHOWPLAN_TEXT ON")
+    try:
+        for name, sql in HOT_QUERIES:
+            cursor.execute(sql)
+            lines = []
+            # SHOWPLAN_TEXT returns the statement first, then the plan operators
+            while True:
+                lines.extend(row[0] for row in cursor.fetchall())
+                if not cursor.nextset():
+                    break
+            plans[name] = "\n".join(line.rstrip() for line in lines[1:])
+    finally:
+        cursor.execute("SET SHOWPLAN_TEXT OFF")
+    return plans
+
+def migrate(dry_run=False):
+    conn = database.get_db_connection()
+    if not conn:
+        print("Failed to connect.")
+        return False
+
+    try:
+        cursor = conn.cursor()
+        ensure_migrations_table(cursor)
+        conn.commit()
+
+        applied = get_applied_versions(cursor)
+        pending = [m for m in load_migrations() if m[0] not in applied]
+
+        if not pending:
+            print("Database is up to date.")
+            return True
+
+        if dry_run:
+            # Outside the migration transaction: the plans of the current schema
+            conn.autocommit = True
+            try:
+                before = get_query_plans(cursor)
+            finally:
+                conn.autocommit = False
+
+        for version, name, batches in pending:
+            print(f"{'[dry-run] ' if dry_run else ''}Applying {version}_{name}...")
+            apply_migration(cursor, version, name, batches)
+            if not dry_run:
+                conn.commit()
+
+        if dry_run:
+            # DDL is transactional in SQL Server: compiled inside the open
+            # transaction the plans see the new indexes, then the rollback
+            # leaves the database untouched.
+            after = get_query_plans(cursor)
+            conn.rollback()
+            for name, _ in HOT_QUERIES:
+                print(f"\n=== {name} ===")
+                print("--- before ---")
+                print(before[name])
+                print("--- after ---")
+                print(after[name])
+            print("\nDry run finished, nothing was applied.")
+        else:
+            print(f"Applied {len(pending)} migration(s).")
+        return True
+
+    except Exception as e:
+        print(f"Error running migrations: {e}")
+        conn.rollback()
+        return False
+    finally:
+        conn.close()
+
+def show_status():
+    conn = database.get_db_connection()
+    if not conn:
+        print("Failed to connect.")
+        return
+
+    try:
+        cursor = conn.cursor()
+        ensure_migrations_table(cursor)
+        conn.commit()
+        applied = get_applied_versions(cursor)
+        for version, name, _ in load_migrations():
+            state = "applied" if version in applied else "pending"
+            print(f"{version}_{name}: {state}")
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply versioned schema migrations.")
+    parser.add_argument("--dry-run", action="store_true", help="Show query plans before/after and roll back")
+    parser.add_argument("--status", action="store_true", help="List applied and pending migrations")
+    args = parser.parse_args()
+
+    if args.status:
+        show_status()
+    else:
+        migrate(dry_run=args.dry_run)
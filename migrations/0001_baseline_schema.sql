@@ -0,0 +1,45 @@
+-- Baseline: Services + Appointments as built by setup_database.sql + update_schema.sql.
+-- Safe on databases created by any of the older scripts.
+
+IF OBJECT_ID('dbo.Services', 'U') IS NULL
+BEGIN
+    CREATE TABLE Services (
+        id INT PRIMARY KEY,
+        nombre NVARCHAR(255) NOT NULL,
+        duracion INT NOT NULL, -- in minutes
+        precio DECIMAL(10, 2) NOT NULL,
+        description NVARCHAR(MAX)
+    );
+END
+GO
+
+IF OBJECT_ID('dbo.Appointments', 'U') IS NULL
+BEGIN
+    CREATE TABLE Appointments (
+        id NVARCHAR(50) PRIMARY KEY,
+        patient_name NVARCHAR(255) NOT NULL,
+        patient_id NVARCHAR(50) NOT NULL, -- Cédula
+        patient_phone NVARCHAR(50) NOT NULL,
+        service_id INT NOT NULL,
+        appointment_date DATE NOT NULL,
+        appointment_time TIME NOT NULL,
+        status NVARCHAR(20) NOT NULL CHECK (status IN ('confirmed', 'cancelled')),
+        reminded BIT DEFAULT 0,
+        created_at DATETIME DEFAULT GETDATE(),
+        FOREIGN KEY (service_id) REFERENCES Services(id)
+    );
+END
+GO
+
+-- Payment columns (update_schema.sql)
+IF COL_LENGTH('dbo.Appointments', 'payment_status') IS NULL
+    ALTER TABLE Appointments ADD payment_status VARCHAR(20) DEFAULT 'pending';
+GO
+IF COL_LENGTH('dbo.Appointments', 'payment_method') IS NULL
+    ALTER TABLE Appointments ADD payment_method VARCHAR(20);
+GO
+IF COL_LENGTH('dbo.Appointments', 'payment_proof') IS NULL
+    ALTER TABLE Appointments ADD payment_proof VARCHAR(255);
+GO
+IF COL_LENGTH('dbo.Appointments', 'payment_amount') IS NULL
+    ALTER TABLE Appointments ADD payment_amount DECIMAL(10, 2) DEFAULT 0;
@@ -0,0 +1,35 @@
+-- One confirmed appointment per slot (see database.create_appointment).
+-- Also serves check_availability / get_booked_slots / the slot index warm-up:
+-- all of them filter on date (+ time) and status = 'confirmed' and only read the time.
+
+-- Pre-check: slots that already hold more than one confirmed appointment would
+-- make CREATE UNIQUE INDEX fail with a bare duplicate-key error. Stop with the
+-- list instead; cancel or move the extra appointments and run migrate.py again.
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'UX_Appointments_ConfirmedSlot')
+   AND EXISTS (
+        SELECT 1 FROM Appointments
+        WHERE status = 'confirmed'
+        GROUP BY appointment_date, appointment_time
+        HAVING COUNT(*) > 1)
+BEGIN
+    SET NOCOUNT ON;
+    DECLARE @slots NVARCHAR(2000) = N'';
+    SELECT TOP 20 @slots = @slots + CHAR(10) + N'  '
+        + CONVERT(NVARCHAR(10), appointment_date, 23) + N' '
+        + CONVERT(NVARCHAR(5), appointment_time, 108)
+        + N': ' + CAST(COUNT(*) AS NVARCHAR(10)) + N' confirmed (ids '
+        + MIN(id) + N' ... ' + MAX(id) + N')'
+    FROM Appointments
+    WHERE status = 'confirmed'
+    GROUP BY appointment_date, appointment_time
+    HAVING COUNT(*) > 1
+    ORDER BY appointment_date, appointment_time;
+
+    RAISERROR(N'Duplicate confirmed appointments, resolve them before creating UX_Appointments_ConfirmedSlot:%s', 16, 1, @slots);
+END
+GO
+
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'UX_Appointments_ConfirmedSlot')
+    CREATE UNIQUE INDEX UX_Appointments_ConfirmedSlot
+    ON Appointments (appointment_date, appointment_time)
+    WHERE status = 'confirmed';
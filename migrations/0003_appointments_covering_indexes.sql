@@ -0,0 +1,14 @@
+-- Covering indexes for the hot Appointments queries in database.py.
+
+-- get_appointments_by_patient: WHERE patient_id = ? AND status = 'confirmed' ORDER BY date, time
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Appointments_Patient_Status')
+    CREATE INDEX IX_Appointments_Patient_Status
+    ON Appointments (patient_id, status, appointment_date, appointment_time)
+    INCLUDE (service_id, patient_name);
+GO
+
+-- get_daily_appointments / get_appointments_by_range: WHERE appointment_date BETWEEN ... ORDER BY date, time
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Appointments_Date')
+    CREATE INDEX IX_Appointments_Date
+    ON Appointments (appointment_date, appointment_time)
+    INCLUDE (patient_name, patient_id, service_id, status, payment_status, payment_method, payment_amount);
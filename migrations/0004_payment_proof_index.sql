@@ -0,0 +1,8 @@
+-- Duplicate receipt detection (invoice_cache.py): get_appointment_by_payment_proof
+-- WHERE payment_proof = ? AND payment_status = 'paid'
+IF NOT EXISTS (SELECT * FROM sys.indexes WHERE name = 'IX_Appointments_PaymentProof')
+    CREATE INDEX IX_Appointments_PaymentProof
+    ON Appointments (payment_proof)
+    INCLUDE (payment_status, service_id, appointment_date, appointment_time)
+    WHERE payment_proof IS NOT NULL;
+GO
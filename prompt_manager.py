@@ -0,0 +1,160 @@
+"""
+System prompt for gemini_service.py, built once and reused.
+
+The instruction (SYSTEM_INSTRUCTION + today's date + vision/audio rules) only
+changes when the day changes or the service catalog changes, so PromptManager
+builds it once per (date, catalog version) and hands out the same Prompt for
+every request in between. The service list inside it is rendered from the live
+Services table as a compact table (render_service_table), so it can't drift
+from what the bot actually books.
+
+When GEMINI_CONTEXT_CACHE is enabled the instruction is also uploaded as a
+Gemini cached content that expires shortly after midnight; requests then
+reference it by name instead of re-sending (and being billed for) the full
+prefix. If the model or the prompt size doesn't support explicit caching, the
+instruction is sent inline as before.
+"""
+import asyncio
+import datetime
+import hashlib
+import threading
+
+from google.genai import types
+
+import async_database
+import database
+from config import SYSTEM_INSTRUCTION, SERVICE_CATALOG_PLACEHOLDER, SERVICE_EMOJIS, PROMPT_EXCLUDED_SERVICE_IDS
+
+DAYS_ES = ["Lunes", "Martes", "Miércoles", "Jueves", "Viernes", "Sábado", "Domingo"]
+
+
+def render_service_table(services):
+    """
+    One line per bookable service: id|emoji|name|price. Services without a price
+    (courses, product sales) are not offered by the bot and are left out, and so
+    are PROMPT_EXCLUDED_SERVICE_IDS, which the original hand-written list omitted.
+    """
+    lines = ["SERVICIOS (id|emoji|nombre|precio COP):"]
+    for s in services:
+        if not s.precio or s.id in PROMPT_EXCLUDED_SERVICE_IDS:
+            continue
+        lines.append(f"{s.id}|{SERVICE_EMOJIS.get(s.id, '🏥')}|{s.nombre}|{s.precio:,.0f}")
+    return "\n".join(lines)
+
+def build_instruction(today, services):
+    """Full system instruction for the given date and service catalog."""
+    day_name_es = DAYS_ES[today.weekday()]
+    date_string = today.isoformat()
+    system_instruction = SYSTEM_INSTRUCTION.replace(SERVICE_CATALOG_PLACEHOLDER, render_service_table(services))
+
+    return f"""
+    {system_instruction}
+
+    CONTEXTO TEMPORAL OBLIGATORIO:
+    - HOY es: {day_name_es.upper()}, {date_string}.
+    - Si el usuario dice "mañana", se refiere al día siguiente.
+
+    INSTRUCCIONES DE VISIÓN Y AUDIO:
+    - Si recibes una IMAGEN de un comprobante de pago (Nequi, Daviplata, Bancolombia, efectivo), extrae el valor, la fecha y el número de referencia / comprobante (vacío si no aparece).
+      - Intent: 'invoice_analysis'
+      - extractedInvoiceData: {{ "amount": 50000, "date": "2023-10-27", "reference": "M1234567" }}
+    - Si recibes un AUDIO, transcríbelo y responde como si fuera texto.
+      - audioTranscription: "Texto transcrito del audio"
+    """
+
+
+class PromptUnavailable(Exception):
+    """No prompt can be built: the service catalog is empty (DB unreachable) and there is no previous one."""
+
+
+class Prompt:
+    """A built system instruction and, if it was uploaded, the name of its cached content."""
+    __slots__ = ("key", "instruction", "version", "cache_name")
+
+    def __init__(self, key, instruction):
+        self.key = key
+        self.instruction = instruction
+        self.version = hashlib.sha1(instruction.encode("utf-8")).hexdigest()[:12]
+        self.cache_name = None
+
+
+def _seconds_until_tomorrow(now):
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    # A few extra minutes so a request started at 23:59 can still use it
+    return int((tomorrow - now).total_seconds()) + 300
+
+
+class PromptManager:
+    def __init__(self, client, model_id, use_context_cache=True):
+        self.client = client
+        self.model_id = model_id
+        self.use_context_cache = use_context_cache
+        self._prompt = None
+        self._cache_failed_for = None  # key whose upload failed; don't retry it on every request
+        self._lock = threading.Lock()
+        self._async_lock = asyncio.Lock()
+
+    def _is_current(self, key):
+        return self._prompt is not None and self._prompt.key == key
+
+    def _install(self, key, services):
+        """
+        Builds and stores the Prompt for `key`. Without services (DB unreachable)
+        keeps the previous one; with none to keep it raises PromptUnavailable
+        rather than build (and upload) a prompt with an empty service table.
+        """
+        with self._lock:
+            if self._is_current(key):
+                return self._prompt
+            if not services:
+                if self._prompt is None:
+                    raise PromptUnavailable("Service catalog is empty and there is no previous prompt")
+                return self._prompt
+            self._prompt = Prompt(key, build_instruction(key[0], services))
+            return self._prompt
+
+    def _needs_upload(self, prompt):
+        return self.use_context_cache and prompt.cache_name is None and self._cache_failed_for != prompt.key
+
+    def _cache_config(self, prompt):
+        return types.CreateCachedContentConfig(
+            display_name=f"gon-system-{prompt.version}",
+            system_instruction=prompt.instruction,
+            ttl=f"{_seconds_until_tomorrow(datetime.datetime.now())}s",
+        )
+
+    def _upload_failed(self, prompt, error):
+        self._cache_failed_for = prompt.key
+        print(f"Gemini context cache unavailable, sending the prompt inline: {error}")
+
+    def get(self):
+        key = (datetime.date.today(), database.get_catalog_version())
+        prompt = self._prompt if self._is_current(key) else self._install(key, database.get_services())
+        if self._needs_upload(prompt):
+            with self._lock:
+                if self._needs_upload(prompt):
+                    try:
+                        cache = self.client.caches.create(model=self.model_id, config=self._cache_config(prompt))
+                        prompt.cache_name = cache.name
+                    except Exception as e:
+                        self._upload_failed(prompt, e)
+        return prompt
+
+    async def get_async(self):
+        key = (datetime.date.today(), await async_database.get_catalog_version())
+        prompt = self._prompt if self._is_current(key) else self._install(key, await async_database.get_services())
+        if self._needs_upload(prompt):
+            async with self._async_lock:
+                if self._needs_upload(prompt):
+                    try:
+                        cache = await self.client.aio.caches.create(model=self.model_id, config=self._cache_config(prompt))
+                        prompt.cache_name = cache.name
+                    except Exception as e:
+                        self._upload_failed(prompt, e)
+        return prompt
+
+    def generate_config(self, prompt, **kwargs):
+        """GenerateContentConfig that references the cached prompt, or carries it inline."""
+        if prompt.cache_name:
+            return types.GenerateContentConfig(cached_content=prompt.cache_name, **kwargs)
+        return types.GenerateContentConfig(system_instruction=prompt.instruction, **kwargs)
@@ -6,22 +6,46 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 import database
+from config import REPORT_DETAIL_MAX_ROWS, REPORT_DETAIL_CHUNK_ROWS
 from datetime import datetime
 import matplotlib.pyplot as plt
 import io
 
-def generate_financial_report(start_date, end_date=None):
+def _detail_row(app):
+    """Renders one appointment as a row of the detail table."""
+    dt_str = f"{app.date} {app.time.strftime('%H:%M')}"
+    
+    if app.status == 'cancelled':
+        payment_status_str = "CANCELADA"
+        price_str = f"(${app.price:,.0f})" # In brackets: doesn't count in the totals
+    else:
+        status_symbol = "✅" if app.payment_status == 'paid' else "⏳"
+        payment_status_str = f"{status_symbol} {app.payment_status}"
+        price_str = f"${app.price:,.0f}"
+
+    return [
+        app.patient_name,
+        app.service_name[:20] + "..." if len(app.service_name) > 20 else app.service_name,
+        dt_str,
+        price_str,
+        payment_status_str,
+        app.payment_method if app.payment_method else "-"
+    ]
+
+def generate_financial_report(start_date, end_date=None, include_details=True):
     """
     Generates a PDF financial report for a specific date or date range.
-    Includes charts and KPIs.
+    Includes charts and KPIs. The per-appointment detail table is only fetched
+    (streamed) when include_details is True, and lists at most
+    REPORT_DETAIL_MAX_ROWS appointments (with a note when there are more), so
+    memory stays bounded whatever the range; the KPIs and charts always cover
+    every appointment.
     """
     if end_date is None:
         end_date = start_date
         report_title = f"Reporte Financiero - {start_date}"
-        appointments = database.get_daily_appointments(start_date)
     else:
         report_title = f"Reporte Financiero: {start_date} al {end_date}"
-        appointments = database.get_appointments_by_range(start_date, end_date)
 
     # Directory Setup
     report_dir = "reportes"
@@ -41,28 +65,20 @@ def generate_financial_report(start_date, end_date=None):
     elements.append(Paragraph(report_title, styles['Heading2']))
     elements.append(Spacer(1, 0.2 * inch))
 
-    if not appointments:
+    # KPIs and chart data are aggregated by the database, so their cost doesn't
+    # depend on how many appointments fall in the range.
+    summary = database.get_report_summary(start_date, end_date)
+
+    if not summary or summary.appointment_count == 0:
         elements.append(Paragraph("No hay citas registradas para este periodo.", styles['Normal']))
         doc.build(elements)
         print(f"Reporte generado (vacío): {filepath}")
         return filepath
 
     # --- 2. Financial Summary (KPIs) ---
-    # Filter active appointments for expected total
-    active_appointments = [app for app in appointments if app['status'] != 'cancelled']
-    
-    total_expected = sum(app['price'] for app in active_appointments)
-    total_collected = sum(app['payment_amount'] for app in appointments) # Keep collected as is (audit trail)
-    pending_amount = total_expected - sum(app['payment_amount'] for app in active_appointments) # Pending only for active
-    
-    # Count only active for "Total Citas" or maybe show both? 
-    # Let's show Total Citas Activas
-    total_appointments = len(active_appointments)
-    cancelled_count = len(appointments) - total_appointments
-
     summary_data = [
         ["Citas Activas", "Total Esperado", "Total Recaudado", "Pendiente"],
-        [str(total_appointments), f"${total_expected:,.0f}", f"${total_collected:,.0f}", f"${pending_amount:,.0f}"]
+        [str(summary.active_count), f"${summary.total_expected:,.0f}", f"${summary.total_collected:,.0f}", f"${summary.pending_amount:,.0f}"]
     ]
 
     summary_table = Table(summary_data, colWidths=[1.5*inch, 1.5*inch, 1.5*inch, 1.5*inch])
@@ -79,37 +95,21 @@ def generate_financial_report(start_date, end_date=None):
     ]))
     elements.append(summary_table)
     
-    if cancelled_count > 0:
+    if summary.cancelled_count > 0:
         elements.append(Spacer(1, 0.1 * inch))
-        elements.append(Paragraph(f"⚠️ Hay {cancelled_count} citas canceladas en este periodo.", styles['Normal']))
+        elements.append(Paragraph(f"⚠️ Hay {summary.cancelled_count} citas canceladas en este periodo.", styles['Normal']))
         
     elements.append(Spacer(1, 0.3 * inch))
 
     # --- 3. Charts Generation ---
-    
-    # Data Preparation
-    payment_methods = {}
-    services_count = {}
-
-    for app in appointments:
-        # Payment Methods (Include all money collected)
-        method = app['payment_method'] if app['payment_method'] else "Pendiente"
-        amount = app['payment_amount']
-        if amount > 0:
-            payment_methods[method] = payment_methods.get(method, 0) + amount
-        
-        # Services (Only count active for popularity?)
-        # Usually better to count what was demanded, even if cancelled? 
-        # Let's count only active for "Services Provided"
-        if app['status'] != 'cancelled':
-            service = app['service_name']
-            services_count[service] = services_count.get(service, 0) + 1
+    payment_methods = database.get_payment_method_totals(start_date, end_date)
+    services_count = database.get_service_counts(start_date, end_date)
 
     # Pie Chart: Income by Payment Method
     pie_chart_buffer = io.BytesIO()
     if payment_methods:
         plt.figure(figsize=(4, 3))
-        plt.pie(payment_methods.values(), labels=payment_methods.keys(), autopct='%1.1f%%', startangle=140, colors=['#3498db', '#2ecc71', '#e74c3c', '#f1c40f'])
+        plt.pie([float(amount) for _, amount in payment_methods], labels=[method for method, _ in payment_methods], autopct='%1.1f%%', startangle=140, colors=['#3498db', '#2ecc71', '#e74c3c', '#f1c40f'])
         plt.title('Ingresos por Método de Pago')
         plt.savefig(pie_chart_buffer, format='png')
         plt.close()
@@ -122,7 +122,7 @@ def generate_financial_report(start_date, end_date=None):
     bar_chart_buffer = io.BytesIO()
     if services_count:
         plt.figure(figsize=(5, 3))
-        plt.barh(list(services_count.keys()), list(services_count.values()), color='#9b59b6')
+        plt.barh([name for name, _ in services_count], [count for _, count in services_count], color='#9b59b6')
         plt.xlabel('Cantidad')
         plt.title('Servicios Realizados (Activos)')
         plt.tight_layout()
@@ -141,55 +141,64 @@ def generate_financial_report(start_date, end_date=None):
     elements.append(Spacer(1, 0.3 * inch))
 
     # --- 4. Detailed Table ---
-    elements.append(Paragraph("Detalle de Citas", styles['Heading2']))
-    
-    table_data = [['Paciente', 'Servicio', 'Fecha/Hora', 'Precio', 'Pago', 'Método']]
-    
-    for app in appointments:
-        dt_str = f"{app.get('date', start_date)} {app['time'][:5]}"
-        
-        if app['status'] == 'cancelled':
-            status_symbol = "🚫"
-            payment_status_str = "CANCELADA"
-            price_str = f"(${app['price']:,.0f})" # Show price in brackets or strike?
-            # Let's just show it but maybe indicate it doesn't count
-            row_bg = colors.lightgrey
-        else:
-            status_symbol = "✅" if app['payment_status'] == 'paid' else "⏳"
-            payment_status_str = f"{status_symbol} {app['payment_status']}"
-            price_str = f"${app['price']:,.0f}"
-            row_bg = colors.beige
-
-        row = [
-            app['patient_name'],
-            app['service_name'][:20] + "..." if len(app['service_name']) > 20 else app['service_name'],
-            dt_str,
-            price_str,
-            payment_status_str,
-            app['payment_method'] if app['payment_method'] else "-"
-        ]
-        table_data.append(row)
-
-    table = Table(table_data, colWidths=[1.5*inch, 2*inch, 1.2*inch, 0.8*inch, 0.8*inch, 1*inch])
-    table.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 10),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
-        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-    ]))
-    
-    # Apply specific row colors for cancelled?
-    # ReportLab TableStyle can take list of tuples for row backgrounds, but simpler to just leave it or add conditional formatting if possible.
-    # For now, let's just mark them with text "CANCELADA".
-    
-    elements.append(table)
+    if include_details:
+        elements.append(Paragraph("Detalle de Citas", styles['Heading2']))
+        elements.extend(_detail_tables(start_date, end_date))
+        if summary.appointment_count > REPORT_DETAIL_MAX_ROWS:
+            elements.append(Spacer(1, 0.1 * inch))
+            elements.append(Paragraph(
+                f"Mostrando las primeras {REPORT_DETAIL_MAX_ROWS} de {summary.appointment_count} citas. "
+                "Genera el reporte por rangos más cortos para ver el detalle completo.",
+                styles['Normal']
+            ))
 
     # Build PDF
     doc.build(elements)
     print(f"Reporte generado con éxito: {filepath}")
     return filepath
+
+DETAIL_HEADER = ['Paciente', 'Servicio', 'Fecha/Hora', 'Precio', 'Pago', 'Método']
+DETAIL_STYLE = TableStyle([
+    ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+    ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+    ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+    ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+    ('FONTSIZE', (0, 0), (-1, 0), 10),
+    ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+    ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+    ('GRID', (0, 0), (-1, -1), 1, colors.black),
+    ('FONTSIZE', (0, 1), (-1, -1), 8),
+])
+
+def _detail_chunk(rows):
+    table = Table([DETAIL_HEADER] + rows, colWidths=[1.5*inch, 2*inch, 1.2*inch, 0.8*inch, 0.8*inch, 1*inch], repeatRows=1)
+    table.setStyle(DETAIL_STYLE)
+    return table
+
+def _detail_tables(start_date, end_date, max_rows=REPORT_DETAIL_MAX_ROWS, chunk_rows=REPORT_DETAIL_CHUNK_ROWS):
+    """
+    Detail of the first `max_rows` appointments in the range, as one Table per
+    `chunk_rows` rows (each with the header) so ReportLab never lays out one
+    huge table. Rows are streamed from the DB and the query stops at the cap.
+    """
+    tables = []
+    rows = []
+    appointments = database.iter_appointments_by_range(start_date, end_date)
+    try:
+        for count, app in enumerate(appointments, 1):
+            rows.append(_detail_row(app))
+            if len(rows) == chunk_rows:
+                tables.append(_detail_chunk(rows))
+                rows = []
+            if count >= max_rows:
+                break
+    finally:
+        appointments.close()  # Returns the pooled connection even when stopping early
+    if rows:
+        tables.append(_detail_chunk(rows))
+
+    # Apply specific row colors for cancelled?
+    # ReportLab TableStyle can take list of tuples for row backgrounds, but simpler to just leave it or add conditional formatting if possible.
+    # For now, let's just mark them with text "CANCELADA".
+
+    return tables
@@ -0,0 +1,66 @@
+-- SQLite schema for db_backends.SqliteBackend.
+-- Mirrors setup_database.sql + migrations/ (tables, payment columns and indexes).
+-- Idempotent: executed every time the bot opens the database for the first time.
+
+CREATE TABLE IF NOT EXISTS Services (
+    id INTEGER PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    duracion INTEGER NOT NULL, -- in minutes
+    precio DECIMAL(10, 2) NOT NULL,
+    description TEXT
+);
+
+CREATE TABLE IF NOT EXISTS Appointments (
+    id TEXT PRIMARY KEY,
+    patient_name TEXT NOT NULL,
+    patient_id TEXT NOT NULL, -- Cédula
+    patient_phone TEXT NOT NULL,
+    service_id INTEGER NOT NULL,
+    appointment_date DATE NOT NULL,
+    appointment_time TIME NOT NULL,
+    status TEXT NOT NULL CHECK (status IN ('confirmed', 'cancelled')),
+    reminded INTEGER DEFAULT 0,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    payment_status TEXT DEFAULT 'pending',
+    payment_method TEXT,
+    payment_proof TEXT,
+    payment_amount DECIMAL(10, 2) DEFAULT 0,
+    FOREIGN KEY (service_id) REFERENCES Services(id)
+);
+
+-- migrations/0002
+CREATE UNIQUE INDEX IF NOT EXISTS UX_Appointments_ConfirmedSlot
+ON Appointments (appointment_date, appointment_time)
+WHERE status = 'confirmed';
+
+-- migrations/0003 (SQLite has no INCLUDE columns: same keys, not covering)
+CREATE INDEX IF NOT EXISTS IX_Appointments_Patient_Status
+ON Appointments (patient_id, status, appointment_date, appointment_time);
+
+CREATE INDEX IF NOT EXISTS IX_Appointments_Date
+ON Appointments (appointment_date, appointment_time);
+
+-- migrations/0004
+CREATE INDEX IF NOT EXISTS IX_Appointments_PaymentProof
+ON Appointments (payment_proof)
+WHERE payment_proof IS NOT NULL;
+
+-- Seed Services (only missing rows; never overwrites edits)
+INSERT OR IGNORE INTO Services (id, nombre, duracion, precio, description) VALUES
+(1, 'Consulta General', 60, 65000, 'Evaluación completa inicial para diagnóstico fisioterapéutico.'),
+(2, 'Valoración por fisioterapia + ecografía especializada', 60, 85000, 'Diagnóstico preciso mediante tecnología de ultrasonido.'),
+(3, 'Sesión de descarga muscular en piernas', 90, 75000, 'Recuperación muscular profunda enfocada en extremidades inferiores.'),
+(4, 'Terapia física avanzada y manejo del dolor', 60, 65000, 'Tratamiento integral para aliviar dolor y recuperar movilidad.'),
+(5, 'Paquete 5 sesiones terapia física y manejo del dolor', 300, 250000, 'Plan completo de recuperación con descuento especial.'),
+(6, 'Sesión de ejercicio personalizado', 60, 50000, 'Rutinas guiadas adaptadas a tus necesidades físicas.'),
+(7, 'Sesión recovery y relajación', 80, 80000, 'Terapia regenerativa para reducir estrés físico.'),
+(8, 'Entrenamiento deportivo', 60, 60000, 'Mejora de rendimiento enfocado en tu disciplina.'),
+(9, 'Acondicionamiento físico en el embarazo', 60, 50000, 'Ejercicios seguros para la salud de la mamá y el bebé.'),
+(10, 'Sesión pilates piso', 60, 50000, 'Fortalecimiento del core y mejora de la postura.'),
+(11, 'Plasma rico en plaquetas', 60, 165000, 'Terapia regenerativa para lesiones articulares o musculares.'),
+(12, '3 sesiones plasma rico en plaquetas', 180, 450000, 'Tratamiento completo regenerativo.'),
+(13, 'Limpieza facial profunda', 90, 90000, 'Higiene facial clínica para renovar tu piel.'),
+(14, 'Limpieza facial profunda con alta hidratación', 120, 120000, 'Tratamiento intensivo de hidratación y limpieza.'),
+(15, 'Plasma rico en hidratación facial + plaquetas', 60, 160000, 'Rejuvenecimiento facial avanzado.'),
+(16, 'Educación continua', 0, 0, 'Talleres y formación especializada.'),
+(17, 'Venta de insumos y suministros médicos', 0, 0, 'Productos especializados para tu recuperación.');
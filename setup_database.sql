@@ -34,6 +34,11 @@ CREATE TABLE Appointments (
     FOREIGN KEY (service_id) REFERENCES Services(id)
 );
 
+-- Only one confirmed appointment per slot (cancelled rows don't count)
+CREATE UNIQUE INDEX UX_Appointments_ConfirmedSlot
+ON Appointments (appointment_date, appointment_time)
+WHERE status = 'confirmed';
+
 -- Seed Services Data
 -- Clear existing data to ensure consistency with constants.ts
 DELETE FROM Services;
@@ -0,0 +1,25 @@
+"""
+Text helpers shared across modules: normalization for the Gemini response cache
+and the local intent classifier, so "¿Dónde  QUEDAN?" and "donde quedan" are
+treated as the same message, and a rough token estimate for prompt and history
+budgets.
+"""
+import re
+import unicodedata
+
+_NON_WORD = re.compile(r"[^\w]+")
+
+def strip_accents(text):
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c))
+
+def normalize_text(text):
+    """Accent- and case-folds, drops punctuation and collapses whitespace."""
+    if not text:
+        return ""
+    text = strip_accents(text).casefold()
+    return " ".join(_NON_WORD.sub(" ", text).split())
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) for budgeting without an API call."""
+    return len(text) // 4 + 1
@@ -0,0 +1,166 @@
+"""
+Cache of voice-note transcriptions, keyed by Telegram's file_unique_id.
+
+file_unique_id is the same for a voice note however many times it is
+forwarded or resent, so a note only has to be downloaded and sent to Gemini
+once. Entries keep the transcription and the full Gemini response, plus the
+date it was produced on: the response may refer to "today", so callers that
+need the response (not just the text) should only reuse it on the same day.
+
+Two tiers:
+- memory: LRU of TRANSCRIPTION_CACHE_SIZE entries;
+- disk (optional, TRANSCRIPTION_CACHE_PATH): a SQLite file that survives
+  restarts, capped at TRANSCRIPTION_DISK_MAX_ENTRIES. Disk access runs on a
+  single worker thread so the event loop never blocks on it. Transcriptions
+  can contain patient data (names, cédulas): keep the file private.
+"""
+import asyncio
+import copy
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from config import TRANSCRIPTION_CACHE_SIZE, TRANSCRIPTION_CACHE_PATH, TRANSCRIPTION_DISK_MAX_ENTRIES
+
+# Inserts between two prunes of the disk tier
+PRUNE_EVERY = 100
+
+
+class _DiskTier:
+    """SQLite store; only ever used from the single thread of its executor."""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn = None
+        self._inserts = 0
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS transcriptions ("
+                "file_unique_id TEXT PRIMARY KEY, stored_at REAL NOT NULL, entry TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ix_transcriptions_stored_at ON transcriptions (stored_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, file_unique_id):
+        row = self._connection().execute(
+            "SELECT entry FROM transcriptions WHERE file_unique_id = ?", (file_unique_id,)
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, file_unique_id, entry):
+        conn = self._connection()
+        conn.execute(
+            "INSERT OR REPLACE INTO transcriptions (file_unique_id, stored_at, entry) VALUES (?, ?, ?)",
+            (file_unique_id, time.time(), json.dumps(entry, ensure_ascii=False))
+        )
+        self._inserts += 1
+        if self._inserts % PRUNE_EVERY == 0:
+            conn.execute(
+                "DELETE FROM transcriptions WHERE file_unique_id NOT IN "
+                "(SELECT file_unique_id FROM transcriptions ORDER BY stored_at DESC LIMIT ?)",
+                (self.max_entries,)
+            )
+        conn.commit()
+
+
+class TranscriptionCache:
+    def __init__(self, max_size, disk_path=None, disk_max_entries=0):
+        self.max_size = max_size
+        self._entries = OrderedDict()  # file_unique_id -> entry
+        self._lock = threading.Lock()
+        self._disk = _DiskTier(disk_path, disk_max_entries) if disk_path else None
+        self._disk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="transcriptions") if disk_path else None
+        self._stats = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "disk_errors": 0,
+        }
+
+    def _remember(self, file_unique_id, entry):
+        with self._lock:
+            self._entries[file_unique_id] = entry
+            self._entries.move_to_end(file_unique_id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    async def _on_disk(self, func, *args):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._disk_executor, func, *args)
+        except (sqlite3.Error, OSError, ValueError) as e:
+            with self._lock:
+                self._stats["disk_errors"] += 1
+            print(f"Transcription cache disk error: {e}")
+            return None
+
+    async def get(self, file_unique_id):
+        """{'transcription', 'response', 'date'} or None. Returns a copy."""
+        with self._lock:
+            entry = self._entries.get(file_unique_id)
+            if entry is not None:
+                self._entries.move_to_end(file_unique_id)
+                self._stats["memory_hits"] += 1
+                return copy.deepcopy(entry)
+
+        if self._disk is not None:
+            entry = await self._on_disk(self._disk.get, file_unique_id)
+            if entry is not None:
+                self._remember(file_unique_id, entry)
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                return copy.deepcopy(entry)
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    async def put(self, file_unique_id, response):
+        """Stores a Gemini response that carries an audioTranscription (others are ignored)."""
+        transcription = response.get('audioTranscription')
+        if not transcription:
+            return
+        entry = {
+            "transcription": transcription,
+            "response": copy.deepcopy(response),
+            "date": date.today().isoformat(),
+        }
+        self._remember(file_unique_id, entry)
+        with self._lock:
+            self._stats["stores"] += 1
+        if self._disk is not None:
+            await self._on_disk(self._disk.put, file_unique_id, entry)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            stats["max_size"] = self.max_size
+        stats["disk"] = self._disk is not None
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["memory_hits"] + stats["disk_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+_cache = TranscriptionCache(TRANSCRIPTION_CACHE_SIZE, TRANSCRIPTION_CACHE_PATH, TRANSCRIPTION_DISK_MAX_ENTRIES)
+
+async def get(file_unique_id):
+    return await _cache.get(file_unique_id)
+
+async def put(file_unique_id, response):
+    await _cache.put(file_unique_id, response)
+
+def get_transcription_cache_stats():
+    return _cache.stats()
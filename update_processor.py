@@ -0,0 +1,69 @@
+"""
+Concurrent Telegram updates, one at a time per chat.
+
+The bot is one big ConversationHandler, whose state per chat is only updated
+once a handler returns. Processing two updates of the same chat at once (a
+double tap on "Confirmar Cita", a message sent while the previous one is still
+being answered) would run both against the same state, e.g. create_appointment
+twice. PerChatUpdateProcessor keeps different chats concurrent (at most
+max_concurrent_updates at once) while the updates of each chat run in arrival
+order.
+
+A chat waiting for its own previous update doesn't take one of the global
+slots. on_busy(update) is called when an update has to wait, so the bot can cut
+short what is holding the chat (e.g. cancel its pending Gemini call).
+"""
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    def __init__(self, max_concurrent_updates, on_busy=None):
+        super().__init__(max_concurrent_updates)
+        self.on_busy = on_busy
+        self._chats = {}  # chat_id -> [asyncio.Lock, updates running or waiting]
+        self._stats = {
+            "updates": 0,
+            "waited": 0,
+        }
+
+    async def process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+
+        self._stats["updates"] += 1
+        entry = self._chats.setdefault(chat.id, [asyncio.Lock(), 0])
+        if entry[0].locked():
+            self._stats["waited"] += 1
+            if self.on_busy:
+                try:
+                    self.on_busy(update)
+                except Exception as e:
+                    print(f"Error in on_busy for chat {chat.id}: {e}")
+        entry[1] += 1
+        try:
+            # Chat lock first: a queued update doesn't hold a global slot
+            async with entry[0]:
+                await super().process_update(update, coroutine)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chats[chat.id]
+
+    async def do_process_update(self, update, coroutine):
+        await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats["busy_chats"] = len(self._chats)
+        return stats
@@ -1,6 +1,7 @@
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 import calendar
 from datetime import datetime, timedelta
+from config import SLOT_HOURS
 
 def create_calendar(year=None, month=None):
     """
@@ -50,10 +51,8 @@ def create_time_slots_keyboard(date_text, booked_slots):
     Creates an inline keyboard with time slots.
     Green (✅) for available, Red (🔴) for booked.
     """
-    # Define working hours: 9-12 and 14-19
-    # Morning: 9, 10, 11
-    # Afternoon: 14, 15, 16, 17, 18
-    slots = [9, 10, 11, 14, 15, 16, 17, 18]
+    # Working hours: 9-12 and 14-19 (see config.SLOT_HOURS)
+    slots = SLOT_HOURS
     
     keyboard = []
     row = []